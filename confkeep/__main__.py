@@ -1,4 +1,3 @@
-from . import settings
 import sys
 from . import confkeep_commands
 from . import VERSION
@@ -19,7 +18,8 @@ This will configure the repository you want to use for tracking the changes.
 2. `python3 -m confkeep {confkeep_commands.ADD_HOST_COMMAND}`
 This command will add the current host to the repository.
 3. `python3 -m confkeep {confkeep_commands.ADD_WATCH_COMMAND}`
-This is how you specify which file/directory you want to monitor for changes
+This is how you specify which file/directory you want to monitor for changes. Give it paths or glob patterns, - to read
+them from stdin or --from-file to add many at once in a single commit, and --sync to sync them right away.
 4. `python3 -m confkeep {confkeep_commands.INSTALL_CRON_COMMAND}` 
 This is a helper command that you can use to automatically install an entry to your crontab that will call the
 synchronization command.
@@ -27,21 +27,52 @@ synchronization command.
 (Optional) 5. `python3 -m confkeep {confkeep_commands.SYNC_COMMAND}`
 This is the command that `{confkeep_commands.INSTALL_CRON_COMMAND}` calls. You normally don't run this manually.
 
+(Optional) 6. `python3 -m confkeep {confkeep_commands.DAEMON_COMMAND}`
+Instead of syncing every minute, keep running and sync tracked paths as soon as they change (Linux only). Set
+INSTALL_SYSTEMD=TRUE when calling `{confkeep_commands.INSTALL_CRON_COMMAND}` to install a systemd unit for it.
+
+(Optional) `python3 -m confkeep {confkeep_commands.PUSH_COMMAND}`
+{confkeep_commands.SYNC_COMMAND} pushes at most every PUSH_INTERVAL seconds and retries failed pushes later. This pushes
+the queued commits right away.
+
+(Optional) `python3 -m confkeep {confkeep_commands.MAINTENANCE_COMMAND}`
+{confkeep_commands.SYNC_COMMAND} repacks the local repository and updates its commit-graph every MAINTENANCE_INTERVAL
+seconds if it is set. This does it right away.
+
+(Optional) `python3 -m confkeep {confkeep_commands.QUERY_COMMAND} [path] [--host HOST] [--since 7d] [--until DATE]`
+Lists which hosts changed a file or directory and when, from a local index of every host branch that is updated on each
+call. Run it with --help for every option.
+
+(Optional) `python3 -m confkeep {confkeep_commands.COLLECT_COMMAND} <inventory>`
+For hosts that can't run conf-keep: fetches their tracked paths over ssh with rsync from this machine and commits them
+to their branches. See confkeep/collect.py for the inventory format.
+
+(Optional) `python3 -m confkeep {confkeep_commands.DRIFT_COMMAND} <path>`
+Groups the hosts by the content of a file or directory and shows how the hosts that differ from the majority differ.
+
+(Optional) `python3 -m confkeep {confkeep_commands.RESTORE_COMMAND} <path> [--at 2h | --commit SHA] [--to DIR]`
+Puts a tracked path back as it was at a commit or time, in place or into another directory. --dry-run shows what would
+change and --delete also deletes the files that didn't exist then.
+
 Each command (except for `{confkeep_commands.SYNC_COMMAND}`) is interactive and will guide you through the configuration
 process.
 If you want to run the command non-interactively check confkeep/confkeep_commands.py to know all the possible 
 environment variables you can pass.
 """
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
+
+def main(argv=None):
+    argv = sys.argv if argv is None else argv
+    if len(argv) < 2:
         print(help_txt)
         exit(1)
-    command = sys.argv[1]
+    command = argv[1]
     if command in ("-h", "--help"):
         print(help_txt)
+        exit(0)
     if command in ("-v", "--version"):
         print(VERSION)
+        exit(0)
     ckwrapper = confkeep_commands.CKWrapper()
     try:
         if command == confkeep_commands.BOOTSTRAP_COMMAND:
@@ -49,11 +80,25 @@ if __name__ == "__main__":
         elif command == confkeep_commands.ADD_HOST_COMMAND:
             ckwrapper.config_host()
         elif command == confkeep_commands.ADD_WATCH_COMMAND:
-            ckwrapper.track_dir()
+            ckwrapper.watch(argv[2:])
         elif command == confkeep_commands.INSTALL_CRON_COMMAND:
             ckwrapper.install_cron()
         elif command == confkeep_commands.SYNC_COMMAND:
-            ckwrapper.watchdog()
+            ckwrapper.scheduled_sync()
+        elif command == confkeep_commands.DAEMON_COMMAND:
+            ckwrapper.daemon()
+        elif command == confkeep_commands.PUSH_COMMAND:
+            ckwrapper.push()
+        elif command == confkeep_commands.MAINTENANCE_COMMAND:
+            ckwrapper.maintenance()
+        elif command == confkeep_commands.QUERY_COMMAND:
+            ckwrapper.query(argv[2:])
+        elif command == confkeep_commands.COLLECT_COMMAND:
+            ckwrapper.collect(argv[2:])
+        elif command == confkeep_commands.DRIFT_COMMAND:
+            ckwrapper.drift(argv[2:])
+        elif command == confkeep_commands.RESTORE_COMMAND:
+            ckwrapper.restore(argv[2:])
         else:
             print(f"Unknown command {command}\n")
             print(help_txt)
@@ -66,3 +111,7 @@ if __name__ == "__main__":
         print("\nAborted by the user")
         exit(1)
     exit(0)
+
+
+if __name__ == "__main__":
+    main()
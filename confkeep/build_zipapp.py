@@ -0,0 +1,49 @@
+"""Build conf-keep as a single executable zipapp.
+
+    python3 -m confkeep.build_zipapp [output, default conf-keep.pyz]
+
+The archive only holds the confkeep package with its bytecode compiled, so hosts can run it with
+`python3 conf-keep.pyz sync` without a checkout and without compiling anything on every cron run. install-cron run from
+the archive points the cron job or systemd unit to it.
+"""
+
+import pathlib
+import py_compile
+import shutil
+import sys
+import tempfile
+import zipapp
+
+INTERPRETER = "/usr/bin/env python3"
+ENTRY_POINT = "confkeep.__main__:main"
+
+
+def build(output):
+    package = pathlib.Path(__file__).absolute().parent
+    with tempfile.TemporaryDirectory() as staging:
+        target = pathlib.Path(staging) / package.name
+        shutil.copytree(
+            package, target, ignore=shutil.ignore_patterns("__pycache__", "*.pyc")
+        )
+        for source in target.glob("*.py"):
+            # zipimport only loads legacy .pyc files placed next to their source
+            py_compile.compile(
+                str(source),
+                cfile=str(source) + "c",
+                dfile=f"{package.name}/{source.name}",
+                doraise=True,
+                invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH,
+            )
+        zipapp.create_archive(
+            staging,
+            output,
+            interpreter=INTERPRETER,
+            main=ENTRY_POINT,
+            compressed=False,
+        )
+    return output
+
+
+if __name__ == "__main__":
+    path = build(pathlib.Path(sys.argv[1] if len(sys.argv) > 1 else "conf-keep.pyz"))
+    print(f"Built {path}")
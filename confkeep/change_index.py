@@ -0,0 +1,245 @@
+"""Local SQLite index of the changes made on every host branch, used by the query command.
+
+Each row is one file changed by one commit: host, commit time, change, path and commit. Paths are stored relative to
+the host's directory, so /etc/ssh/sshd_config tracked as /etc is stored as etc/ssh/sshd_config. The index is updated
+incrementally: it remembers the tip it indexed for each host and only reads the commits added since then with a single
+`git log` per branch. A branch whose history was rewritten (see confkeep/compaction.py) is indexed again from scratch.
+
+The index lives in the repository's conf-keep state directory and can be deleted at any time, it is rebuilt by the next
+query.
+"""
+
+import argparse
+import datetime
+import os
+import sqlite3
+import subprocess
+
+from confkeep.git_status import NAME_STATUS, UNKNOWN, _split_records
+from confkeep.tracked import parse_interval
+from confkeep.util import ConfKeepError
+
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE branches (host TEXT PRIMARY KEY, tip TEXT NOT NULL);
+CREATE TABLE changes (
+    host TEXT NOT NULL, time INTEGER NOT NULL, change TEXT NOT NULL, path TEXT NOT NULL, sha TEXT NOT NULL
+);
+CREATE INDEX changes_path ON changes (path, time);
+CREATE INDEX changes_host ON changes (host, time);
+CREATE INDEX changes_time ON changes (time);
+"""
+LOCAL_PREFIX = "refs/heads/"
+REMOTE_PREFIX = "refs/remotes/origin/"
+COMMIT_MARKER = b"\x01"
+
+
+def parse_time(value, now):
+    """Convert a duration before now like 7d or 12h, or a date like 2026-01-31 or 2026-01-31 12:00, to a timestamp."""
+    try:
+        return now - parse_interval(value)
+    except ConfKeepError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ConfKeepError(
+            f"Invalid time {value}, use a date like 2026-01-31 or a duration like 7d."
+        )
+
+
+def parse_arguments(argv, prog):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description="List the changes made to tracked files on every host, newest first.",
+    )
+    parser.add_argument(
+        "path",
+        nargs="?",
+        help="file or directory, e.g. /etc/ssh/sshd_config. Every change if not given.",
+    )
+    parser.add_argument("--host", help="only the changes made on this host")
+    parser.add_argument(
+        "--since", help="only changes from this date or duration ago, e.g. 7d"
+    )
+    parser.add_argument("--until", help="only changes before this date or duration ago")
+    parser.add_argument("--limit", type=int, help="show at most this many changes")
+    parser.add_argument(
+        "--no-fetch",
+        dest="fetch",
+        action="store_false",
+        help="don't fetch the host branches from the remote first",
+    )
+    return parser.parse_args(argv)
+
+
+def path_suffixes(path):
+    """Where a host may store path in its directory, longest first: etc/ssh/sshd_config, ssh/sshd_config..."""
+    parts = path.strip("/").split("/")
+    return ["/".join(parts[start:]) for start in range(len(parts))]
+
+
+def branch_tips(ckwrapper, own_host):
+    """Return {host: tip} for every host branch, taken from origin except for this host's local branch."""
+    out = ckwrapper.git_command(
+        "for-each-ref",
+        "--format=%(refname) %(objectname)",
+        LOCAL_PREFIX,
+        REMOTE_PREFIX,
+        get_stdout=True,
+    ).decode()
+    local, remote = {}, {}
+    for line in out.splitlines():
+        ref, sha = line.rsplit(" ", 1)
+        if ref.startswith(LOCAL_PREFIX):
+            local[ref[len(LOCAL_PREFIX) :]] = sha
+        elif ref != REMOTE_PREFIX + "HEAD":
+            remote[ref[len(REMOTE_PREFIX) :]] = sha
+    # Other hosts' local branches are only left over from bootstrap or older clones, origin has their latest commits
+    tips = dict(local)
+    tips.update(remote)
+    if own_host in local:
+        tips[own_host] = local[own_host]
+    return tips
+
+
+def read_changes(repo_path, host, revisions):
+    """Yield (host, time, change, path, sha) for every file changed by the commits of revisions, oldest first.
+
+    Rows are inserted in that order, so the rowid orders changes made within the same second.
+    """
+    prefix = host + "/"
+    command = [
+        "git",
+        "log",
+        "--reverse",
+        "-z",
+        "--no-renames",
+        "--name-status",
+        "--format=%x01%H %ct",
+        *revisions,
+        "--",
+    ]
+    process = subprocess.Popen(command, cwd=repo_path, stdout=subprocess.PIPE)
+    try:
+        records = _split_records(process.stdout)
+        sha = timestamp = None
+        for record in records:
+            record = record.lstrip(b"\n")
+            if record.startswith(COMMIT_MARKER):
+                sha, timestamp = record[1:].decode().split()
+                continue
+            if not record:
+                continue
+            path = os.fsdecode(next(records))
+            if path.startswith(prefix):
+                path = path[len(prefix) :]
+            yield host, int(timestamp), NAME_STATUS.get(record[:1], UNKNOWN), path, sha
+    finally:
+        process.stdout.close()
+        return_code = process.wait()
+    if return_code:
+        raise subprocess.CalledProcessError(return_code, command)
+
+
+class ChangeIndex:
+    def __init__(self, path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(path))
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            with self.connection:
+                self.connection.execute("DROP TABLE IF EXISTS branches")
+                self.connection.execute("DROP TABLE IF EXISTS changes")
+            self.connection.executescript(SCHEMA)
+            self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.connection.close()
+
+    def update(self, ckwrapper, own_host=None):
+        """Index the commits added to every host branch since the last update. Return the number of new rows."""
+        tips = branch_tips(ckwrapper, own_host)
+        indexed = dict(self.connection.execute("SELECT host, tip FROM branches"))
+        added = 0
+        with self.connection:
+            for host in indexed.keys() - tips.keys():
+                self._forget(host)
+        for host, tip in sorted(tips.items()):
+            old_tip = indexed.get(host)
+            if old_tip == tip:
+                continue
+            incremental = old_tip and _is_ancestor(ckwrapper, old_tip, tip)
+            revisions = [tip, "--not", old_tip] if incremental else [tip]
+            with self.connection:
+                if not incremental:
+                    self._forget(host)
+                before = self.connection.total_changes
+                self.connection.executemany(
+                    "INSERT INTO changes VALUES (?, ?, ?, ?, ?)",
+                    read_changes(ckwrapper.repo_path, host, revisions),
+                )
+                added += self.connection.total_changes - before
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO branches VALUES (?, ?)", (host, tip)
+                )
+        return added
+
+    def _forget(self, host):
+        self.connection.execute("DELETE FROM changes WHERE host = ?", (host,))
+        self.connection.execute("DELETE FROM branches WHERE host = ?", (host,))
+
+    def query(self, path=None, host=None, since=None, until=None, limit=None):
+        """Return [(time, host, change, path, sha)], newest first.
+
+        A path matches the files stored under any of its trailing parts: /etc/ssh/sshd_config matches
+        etc/ssh/sshd_config, ssh/sshd_config and sshd_config, whichever way a host tracks it. A directory matches every
+        file under it.
+        """
+        conditions, parameters = [], []
+        if path:
+            matches = []
+            for suffix in path_suffixes(path):
+                # "0" follows "/" in the collation, so this is every path under suffix
+                matches.append("path = ? OR (path > ? AND path < ?)")
+                parameters += [suffix, suffix + "/", suffix + "0"]
+            conditions.append("(" + " OR ".join(matches) + ")")
+        if host:
+            conditions.append("host = ?")
+            parameters.append(host)
+        # With a path, sqlite may prefer scanning the whole time range over the rows of the path. The unary + keeps it
+        # from using the time index.
+        column = "+time" if path else "time"
+        if since is not None:
+            conditions.append(f"{column} >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append(f"{column} < ?")
+            parameters.append(until)
+        sql = "SELECT time, host, change, path, sha FROM changes"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY time DESC, rowid DESC"
+        if limit:
+            sql += " LIMIT ?"
+            parameters.append(limit)
+        return self.connection.execute(sql, parameters).fetchall()
+
+
+def _is_ancestor(ckwrapper, old_tip, tip):
+    # old_tip may not even exist anymore once a rewritten history was pruned
+    return not subprocess.run(
+        ["git", "merge-base", "--is-ancestor", old_tip, tip],
+        cwd=ckwrapper.repo_path,
+        stderr=subprocess.DEVNULL,
+    ).returncode
+
+
+def format_change(row):
+    timestamp, host, change, path, sha = row
+    when = datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+    return f"{when} {sha[:10]} {host}: {path} {change}"
@@ -0,0 +1,289 @@
+"""Agentless pull mode: one collector fetches the tracked paths of hosts that don't run conf-keep themselves.
+
+The inventory lists one host per line, blank lines and lines starting with # are ignored:
+
+    # name	address	[tracked path...]
+    web-1	root@web-1.example.com	/etc/nginx	/etc/ssh/sshd_config
+    appliance-7	admin@10.0.0.7
+
+The name is the host's branch and directory in the repository. Hosts listed without paths are collected with the
+tracked.txt already committed to their branch, which is also how paths get filters. With the ssh transport the address
+is an ssh destination and paths are fetched with rsync over ssh. With the local transport it is a local directory
+holding the host's root filesystem, e.g. a container's, and paths are mirrored from there.
+
+Every host is collected into its own staging directory kept in the conf-keep state directory, so later collections only
+transfer what changed. Its commit is built with a dedicated index file, commit-tree and update-ref, without touching the
+checkout of the repository, so hosts are collected and committed concurrently. The branches that changed are then
+pushed with a single push.
+"""
+
+import collections
+import os
+import pathlib
+import re
+import subprocess
+import time
+
+from confkeep import settings
+from confkeep.git_status import NAME_STATUS, UNKNOWN, StatusSummary
+from confkeep.metrics import SyncMetrics
+from confkeep.sync import mirror, remove_mirror
+from confkeep.tracked import TrackedPath, read_tracked, write_tracked
+from confkeep.util import ConfKeepError
+
+SSH_TRANSPORT = "ssh"
+LOCAL_TRANSPORT = "local"
+# New host branches start from the branch created by bootstrap, like the ones created by add-host
+BASE_BRANCH = "master"
+HOST_NAME = re.compile(r"[A-Za-z0-9_][A-Za-z0-9_.-]*\Z")
+SLOWEST_SHOWN = 5
+
+InventoryHost = collections.namedtuple("InventoryHost", "name address paths")
+HostResult = collections.namedtuple("HostResult", "name changed error seconds tip")
+
+
+def read_inventory(path):
+    hosts = []
+    names = set()
+    for number, line in enumerate(path.read_text().splitlines(), 1):
+        fields = line.split()
+        if not fields or fields[0].startswith("#"):
+            continue
+        if len(fields) < 2:
+            raise ConfKeepError(f"{path}:{number}: a host needs a name and an address.")
+        name, address, *paths = fields
+        if not HOST_NAME.match(name) or name.endswith(".lock"):
+            raise ConfKeepError(f"{path}:{number}: invalid host name {name}.")
+        if name in names:
+            raise ConfKeepError(f"{path}:{number}: {name} is listed twice.")
+        if any(not os.path.isabs(tracked) for tracked in paths):
+            raise ConfKeepError(f"{path}:{number}: tracked paths must be absolute.")
+        names.add(name)
+        hosts.append(InventoryHost(name, address, [TrackedPath(p) for p in paths]))
+    return hosts
+
+
+class SshRsyncTransport:
+    """Fetch the tracked paths with rsync over ssh. Paths without filters share a single connection."""
+
+    def __init__(self, ssh_command):
+        self.ssh_command = ssh_command
+
+    def fetch(self, address, paths, target, timeout):
+        plain = [tracked for tracked in paths if not tracked.has_filters]
+        transfers = []
+        if plain:
+            # Paths missing on the host are removed from the copy instead of failing the transfer
+            sources = [f"{address}:{tracked.path}" for tracked in plain]
+            transfers.append((["--delete-missing-args"], sources, target))
+        for tracked in paths:
+            if tracked.has_filters:
+                transfers.append(
+                    (
+                        ["--delete-excluded"] + tracked.rsync_options(),
+                        [f"{address}:{tracked.path}/"],
+                        target / tracked.path.name,
+                    )
+                )
+        deadline = time.monotonic() + timeout
+        for options, sources, destination in transfers:
+            subprocess.run(
+                ["rsync", "-az", "--delete", f"--timeout={int(timeout)}"]
+                + ["-e", self.ssh_command]
+                + options
+                + sources
+                + [f"{destination}/"],
+                check=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                timeout=max(1, deadline - time.monotonic()),
+            )
+
+
+class LocalTransport:
+    """Mirror the tracked paths from a directory holding the host's root filesystem.
+
+    The copy runs in-process: past the timeout it fails before the next directory entry, but a read that hangs can't be
+    interrupted.
+    """
+
+    def fetch(self, address, paths, target, timeout):
+        metrics = SyncMetrics()
+        deadline = time.monotonic() + timeout
+        for tracked in paths:
+            source = TrackedPath(
+                os.path.join(address, str(tracked.path).lstrip("/")),
+                tracked.exclude,
+                tracked.include,
+                tracked.max_size,
+            )
+            if source.path.exists():
+                mirror(source, target, metrics, deadline)
+            else:
+                remove_mirror(source.path, target)
+
+
+def get_transport(name):
+    if name == SSH_TRANSPORT:
+        return SshRsyncTransport(settings.COLLECT_SSH_COMMAND)
+    if name == LOCAL_TRANSPORT:
+        return LocalTransport()
+    raise ConfKeepError(f"Unknown COLLECT_TRANSPORT {name}.")
+
+
+class Collector:
+    def __init__(self, ckwrapper, transport, timeout):
+        self.repo_path = ckwrapper.repo_path
+        self.staging_path = ckwrapper.state_path / "collect"
+        self.transport = transport
+        self.timeout = timeout
+
+    def git(self, *args, index=None, work_tree=None):
+        environment = None
+        if index:
+            environment = dict(os.environ, GIT_INDEX_FILE=str(index))
+            environment["GIT_WORK_TREE"] = str(work_tree)
+        return (
+            subprocess.run(
+                ["git"] + [str(arg) for arg in args],
+                cwd=self.repo_path,
+                env=environment,
+                check=True,
+                stdout=subprocess.PIPE,
+            )
+            .stdout.decode()
+            .strip()
+        )
+
+    def resolve(self, ref):
+        try:
+            return self.git("rev-parse", "--verify", "-q", ref)
+        except subprocess.CalledProcessError:
+            return None
+
+    def collect_host(self, host, last_tip):
+        """Fetch and commit one host. Return a HostResult, errors are reported in it instead of raised."""
+        started = time.monotonic()
+        tip = self.resolve(f"refs/heads/{host.name}")
+        try:
+            changed, tip = self._collect(host, tip, last_tip)
+            error = None
+        except subprocess.TimeoutExpired:
+            changed, error = False, f"timed out after {int(self.timeout)} seconds"
+        except subprocess.CalledProcessError as failure:
+            message = (failure.stderr or b"").decode(errors="replace").strip()
+            changed = False
+            error = message.splitlines()[-1] if message else str(failure)
+        except (ConfKeepError, OSError) as failure:
+            changed, error = False, str(failure)
+        return HostResult(host.name, changed, error, time.monotonic() - started, tip)
+
+    def _collect(self, host, tip, last_tip):
+        work_tree = self.staging_path / host.name
+        target = work_tree / host.name
+        index = self.staging_path / f"{host.name}.index"
+        target.mkdir(parents=True, exist_ok=True)
+        paths = host.paths
+        tracked_file = target / "tracked.txt"
+        if paths:
+            write_tracked(tracked_file, paths)
+        elif tip:
+            tracked_file.write_bytes(
+                subprocess.run(
+                    ["git", "show", f"{tip}:{host.name}/tracked.txt"],
+                    cwd=self.repo_path,
+                    check=True,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                ).stdout
+            )
+            paths = read_tracked(tracked_file)
+        if not paths:
+            raise ConfKeepError("no tracked paths, list them in the inventory")
+        self.transport.fetch(host.address, paths, target, self.timeout)
+        parent = tip or self.resolve(BASE_BRANCH)
+        if tip != last_tip or not index.is_file():
+            # The branch moved since the last collection, start from its tree. Otherwise the index still matches it
+            # and its stat information spares add from hashing unchanged files again.
+            if parent:
+                self.git("read-tree", parent, index=index, work_tree=work_tree)
+            else:
+                self.git("read-tree", "--empty", index=index, work_tree=work_tree)
+        # The host's directory only holds what is collected, drop the copies of paths that are no longer tracked
+        kept = {tracked.path.name for tracked in paths} | {tracked_file.name}
+        with os.scandir(target) as entries:
+            extra = [entry.name for entry in entries if entry.name not in kept]
+        for name in extra:
+            remove_mirror(pathlib.Path(name), target)
+        self.git("add", "--all", "--", host.name, index=index, work_tree=work_tree)
+        tree = self.git("write-tree", index=index, work_tree=work_tree)
+        parent_tree = self.resolve(f"{parent}^{{tree}}") if parent else None
+        if tree == parent_tree:
+            return False, tip
+        summary = StatusSummary()
+        if parent_tree:
+            fields = self.git(
+                "diff-tree",
+                "-r",
+                "--no-renames",
+                "--name-status",
+                "-z",
+                parent_tree,
+                tree,
+            ).split("\0")
+            for status, path in zip(fields[0::2], fields[1::2]):
+                summary.add(NAME_STATUS.get(status[:1].encode(), UNKNOWN), path)
+        messages = ["-m", summary.head or f"Host {host.name} collected"]
+        if summary.body:
+            messages += ["-m", summary.body]
+        parents = ["-p", parent] if parent else []
+        commit = self.git("commit-tree", tree, *parents, *messages)
+        # Fails if the branch was changed by someone else in the meantime
+        self.git("update-ref", f"refs/heads/{host.name}", commit, tip or "")
+        return True, commit
+
+
+def collect(ckwrapper, hosts, last_tips):
+    """Collect every host with COLLECT_CONCURRENCY workers. Return their HostResult, in inventory order."""
+    import concurrent.futures
+
+    collector = Collector(
+        ckwrapper, get_transport(settings.COLLECT_TRANSPORT), settings.COLLECT_TIMEOUT
+    )
+    try:
+        checked_out = collector.git("symbolic-ref", "--short", "-q", "HEAD")
+    except subprocess.CalledProcessError:
+        checked_out = None
+    if any(host.name == checked_out for host in hosts):
+        raise ConfKeepError(
+            f"{checked_out} is checked out in {ckwrapper.repo_path}, check out {BASE_BRANCH} to collect it."
+        )
+    workers = max(1, min(settings.COLLECT_CONCURRENCY, len(hosts)))
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        return list(
+            executor.map(
+                lambda host: collector.collect_host(host, last_tips.get(host.name)),
+                hosts,
+            )
+        )
+
+
+def summarize(results, seconds):
+    changed = sum(result.changed for result in results)
+    failed = [result for result in results if result.error]
+    lines = [
+        f"Collected {len(results)} host(s) in {seconds:.1f}s: {changed} changed, "
+        f"{len(results) - changed - len(failed)} unchanged, {len(failed)} failed."
+    ]
+    for result in failed:
+        lines.append(f"  {result.name} failed: {result.error}")
+    if len(results) > 1:
+        slowest = sorted(results, key=lambda result: result.seconds, reverse=True)
+        lines.append(
+            "Slowest: "
+            + ", ".join(
+                f"{result.name} {result.seconds:.1f}s"
+                for result in slowest[:SLOWEST_SHOWN]
+            )
+        )
+    return "\n".join(lines)
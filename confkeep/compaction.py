@@ -0,0 +1,190 @@
+"""Opt-in retention policy that folds old minute-level commits of the host branch into hourly and daily snapshots.
+
+Commits younger than COMPACT_FULL_DAYS are kept as they are. Older consecutive commits made in the same hour (up to
+COMPACT_HOURLY_DAYS) or the same day (beyond that) are replaced by a single commit with the tree, author and dates of
+the last of them and a message listing the files changed over the whole period. Commits shared with other branches,
+like the initial commit of master, are never touched.
+
+The rewrite is deterministic: the same history compacted at the same time gives the same commits, and commits that are
+already compacted are kept as they are. The local branch is moved with a compare-and-swap and the next push replaces
+the remote branch with --force-with-lease, so a remote branch that changed in the meantime is never overwritten.
+"""
+
+import datetime
+import os
+import subprocess
+import tempfile
+
+from confkeep.git_status import NAME_STATUS, UNKNOWN, StatusSummary
+from confkeep.snapshot import ObjectWriter
+from confkeep.util import ConfKeepError
+
+HOUR = 3600
+DAY = 86400
+# Headers that can't be kept on a rewritten commit
+DROPPED_HEADERS = (b"parent", b"gpgsig", b"gpgsig-sha256", b"mergetag")
+
+
+def group_commits(commits, now, full_days, hourly_days):
+    """Split [(commit time, sha)], oldest first, into lists of consecutive commits that end up as one commit."""
+    groups = []
+    previous = None
+    for timestamp, sha in commits:
+        age = now - timestamp
+        if age < full_days * DAY:
+            bucket = None
+        elif age < hourly_days * DAY:
+            bucket = (HOUR, timestamp // HOUR)
+        else:
+            bucket = (DAY, timestamp // DAY)
+        if bucket is not None and bucket == previous:
+            groups[-1].append((timestamp, sha))
+        else:
+            groups.append([(timestamp, sha)])
+        previous = bucket
+    return groups
+
+
+class CommitReader:
+    """Reads raw commit objects through a single `git cat-file --batch` process."""
+
+    def __init__(self, repo_path):
+        self.process = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            cwd=repo_path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def read(self, sha):
+        self.process.stdin.write(sha.encode() + b"\n")
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) != 3 or header[1] != b"commit":
+            raise ConfKeepError(f"Could not read commit {sha}.")
+        raw = self.process.stdout.read(int(header[2]))
+        self.process.stdout.read(1)  # Trailing newline
+        return raw
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def rewrite_commit(raw, parent, message=None):
+    """Return raw with parent as its only parent and, if given, a new message."""
+    header, _, original_message = raw.partition(b"\n\n")
+    lines = []
+    dropping = False
+    for line in header.split(b"\n"):
+        if line.startswith(b" "):
+            if not dropping:
+                lines.append(line)  # Continuation of a multi-line header
+            continue
+        key = line.split(b" ", 1)[0]
+        dropping = key in DROPPED_HEADERS
+        if dropping:
+            continue
+        lines.append(line)
+        if key == b"tree" and parent:
+            lines.append(b"parent " + parent.encode())
+    if message is None:
+        message = original_message
+    return b"\n".join(lines) + b"\n\n" + message
+
+
+def squash_message(ckwrapper, group, parent):
+    """Message of the commit replacing group: its period and the files changed from parent to its last commit."""
+    summary = StatusSummary(limit=100)
+    command = ["diff-tree", "-r", "--no-renames", "--name-status", "-z"]
+    if parent:
+        command += [parent, group[-1][1]]
+    else:
+        command += ["--root", group[-1][1]]
+    fields = ckwrapper.git_command(*command, get_stdout=True).split(b"\0")
+    for status, path in zip(fields[0::2], fields[1::2]):
+        summary.add(NAME_STATUS.get(status[:1], UNKNOWN), os.fsdecode(path))
+    start, end = (
+        datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime(
+            "%Y-%m-%d %H:%M"
+        )
+        for timestamp in (group[0][0], group[-1][0])
+    )
+    head = summary.head or "Nothing changed"
+    return (
+        f"{len(group)} commits from {start} to {end} UTC squashed\n\n"
+        f"{head}{summary.body}\n"
+    ).encode()
+
+
+def compact_history(ckwrapper, now, full_days, hourly_days):
+    """Compact the host branch. Return (commits before, commits after), or None if there was nothing to fold."""
+    branch = ckwrapper.hostname
+    ref = f"refs/heads/{branch}"
+    own_history = [
+        ref,
+        "--not",
+        f"--exclude={branch}",
+        "--branches",
+        f"--exclude=origin/{branch}",
+        "--remotes=origin",
+    ]
+    out = ckwrapper.git_command(
+        "rev-list",
+        "--reverse",
+        "--first-parent",
+        "--timestamp",
+        *own_history,
+        get_stdout=True,
+    ).decode()
+    commits = [
+        (int(timestamp), sha)
+        for timestamp, sha in (line.split() for line in out.splitlines())
+    ]
+    groups = group_commits(commits, now, full_days, hourly_days)
+    if len(groups) == len(commits):
+        return None
+    if int(
+        ckwrapper.git_command(
+            "rev-list", "--merges", "--count", *own_history, get_stdout=True
+        )
+    ):
+        raise ConfKeepError(f"The history of {branch} has merges, not compacting it.")
+    old_tip = commits[-1][1]
+    try:
+        parent = (
+            ckwrapper.git_command(
+                "rev-parse", "--verify", "-q", f"{commits[0][1]}^", get_stdout=True
+            )
+            .decode()
+            .strip()
+        )
+    except subprocess.CalledProcessError:
+        parent = None  # The branch starts with a root commit
+    ckwrapper.state_path.mkdir(parents=True, exist_ok=True)
+    reader = CommitReader(ckwrapper.repo_path)
+    writer = ObjectWriter(ckwrapper.repo_path, "commit")
+    rewritten = False
+    try:
+        with tempfile.NamedTemporaryFile(dir=ckwrapper.state_path) as raw_file:
+            for group in groups:
+                if len(group) == 1 and not rewritten:
+                    parent = group[0][1]
+                    continue
+                message = None
+                if len(group) > 1:
+                    message = squash_message(ckwrapper, group, parent)
+                raw_file.seek(0)
+                raw_file.truncate()
+                raw_file.write(
+                    rewrite_commit(reader.read(group[-1][1]), parent, message)
+                )
+                raw_file.flush()
+                parent = writer.write(raw_file.name)
+                rewritten = True
+    finally:
+        reader.close()
+        writer.close()
+    # Fails if a commit was added to the branch in the meantime
+    ckwrapper.git_command("update-ref", ref, parent, old_tip)
+    return len(commits), len(groups)
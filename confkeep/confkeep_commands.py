@@ -1,60 +1,168 @@
+import functools
 import json
 import os
 import pathlib
-import re
-import shutil
 import subprocess
 import sys
+import time
 
 from confkeep import settings
+from confkeep.context import HOSTNAME_FILE, RuntimeContext
+from confkeep.git_status import StatusSummary, iter_status
+from confkeep.lock import RepositoryLock
+from confkeep.manifest import StatManifest
+from confkeep.metrics import SyncMetrics
+from confkeep.snapshot import DIRECT_MODE, MIRROR_MODE, commit_snapshot
+from confkeep.sync import sync_paths
+from confkeep.tracked import (
+    TrackedPath,
+    expand_paths,
+    parse_interval,
+    parse_size,
+    read_path_list,
+    read_tracked,
+    write_tracked,
+)
+from confkeep.util import ConfKeepError
 
 SCRIPT_TEMPLATE = """#!/bin/sh
 export PATH="/bin:/sbin:/usr/bin:/usr/sbin:/usr/local/bin:/usr/local/sbin/:$HOME/.local/bin:$HOME/bin:$PATH"
 export REPO_PATH='{repo_path}'
-{ignore_sync_errors}
-{ignore_ip_changes}
-cd {project_path}
-{python_interpreter} -m confkeep sync > /var/log/conf-keep-sync.log 2>&1
+{environment}
+{delay}cd {project_path}
+{command} sync > /var/log/conf-keep-sync.log 2>&1
 """
 
+# Adaptive syncs wait this long after the first sync that found nothing, then twice as long after each one, see
+# scheduled_sync
+ADAPTIVE_FIRST_INTERVAL = 60
+# Runs starting less than this many seconds before a sync or a path is due count as due, cron start times jitter
+SCHEDULE_SLACK = 5
+
 SERVICE_NAME = "conf-keep"
 ADD_WATCH_COMMAND = "watch"
 ADD_HOST_COMMAND = "add-host"
 BOOTSTRAP_COMMAND = "bootstrap"
 SYNC_COMMAND = "sync"
+DAEMON_COMMAND = "daemon"
+PUSH_COMMAND = "push"
+MAINTENANCE_COMMAND = "maintenance"
+QUERY_COMMAND = "query"
+COLLECT_COMMAND = "collect"
+DRIFT_COMMAND = "drift"
+RESTORE_COMMAND = "restore"
 INSTALL_CRON_COMMAND = "install-cron"
 CRON_FILE_PATH = pathlib.Path("/etc/cron.d/conf-keep")
+SYSTEMD_UNIT_PATH = pathlib.Path("/etc/systemd/system/conf-keep.service")
+# Settings that install-cron copies from its own environment into the sync script
+SCRIPT_ENVIRONMENT = (
+    "DISABLE_MANIFEST",
+    "SYNC_CONCURRENCY",
+    "SYNC_BATCH",
+    "SYNC_ENGINE",
+    "SYNC_PIPELINE",
+    "SYNC_TIMEOUT",
+    "DAEMON_DEBOUNCE",
+    "DAEMON_MAX_DELAY",
+    "DAEMON_RESCAN_INTERVAL",
+    "PUSH_INTERVAL",
+    "PUSH_RETRY_DELAY",
+    "PUSH_RETRY_MAX",
+    "PUSH_TIMEOUT",
+    "ADAPTIVE_SYNC",
+    "ADAPTIVE_MAX_INTERVAL",
+    "MAINTENANCE_INTERVAL",
+    "COMPACT_HISTORY",
+    "COMPACT_FULL_DAYS",
+    "COMPACT_HOURLY_DAYS",
+    "SHARED_OBJECT_STORE",
+    "SNAPSHOT_MODE",
+    "IDENTITY_SOURCE",
+    "LOCK_STALE_AFTER",
+    "METRICS_LOG",
+    "METRICS_TEXTFILE",
+)
+
+SYSTEMD_UNIT_TEMPLATE = """[Unit]
+Description=conf-keep configuration tracking daemon
+After=network-online.target
+
+[Service]
+User={user}
+{environment}
+WorkingDirectory={project_path}
+ExecStart={command} daemon
+Restart=on-failure
+RestartSec=30
+
+[Install]
+WantedBy=multi-user.target
+"""
 
 
-class ConfKeepError(Exception):
-    pass
+def with_test_repo(func=None, coalesce=False, overlap_identity=False):
+    """Run the command holding the repository lock, after checking that this is still the same host.
 
+    With coalesce, finding the lock taken isn't an error: a new sync is requested from the running command instead.
+    Whatever command holds the lock runs that sync before exiting. With overlap_identity and SYNC_PIPELINE the host is
+    checked in the background while the command runs, the command must call await_identity before committing.
+    """
+    if func is None:
+        return functools.partial(
+            with_test_repo, coalesce=coalesce, overlap_identity=overlap_identity
+        )
 
-def with_test_repo(func):
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
         if "self" in kwargs:
             obj = kwargs["self"]
         else:
             obj = args[0]
-        lock_file_path = obj.repo_path / "conf-keep.lock"
-        if obj.is_ip_changed():
-            raise ConfKeepError()  # Notifications already printed
-        elif lock_file_path.is_file():
-            print("Another command is running in this repository.")
-            raise ConfKeepError()
-        else:
-            lock_file_path.touch()
+        lock = obj.lock
+        if not lock.acquire(func.__name__):
+            lock.recover_stale(settings.LOCK_STALE_AFTER)
+            if not coalesce:
+                print(lock.describe_holder())
+                raise ConfKeepError()
+            if not lock.acquire_or_request_rerun(func.__name__):
+                print(f"{lock.describe_holder()} It will sync again once done.")
+                return
+        obj.metrics = SyncMetrics()
+        try:
+            if overlap_identity and settings.SYNC_PIPELINE:
+                obj.start_identity_check()
+            else:
+                with obj.metrics.phase("identity"):
+                    ip_changed = obj.is_ip_changed()
+                if ip_changed:
+                    raise ConfKeepError()  # Notifications already printed
+            result = func(*args, **kwargs)
+        finally:
+            obj.cancel_identity_check()
+            lock.release()
+        while lock.take_rerun_request():
+            if not lock.acquire_or_request_rerun(SYNC_COMMAND):
+                break  # Handed over to whoever just took the lock
+            print("A sync was requested while the lock was held. Syncing.")
+            obj.metrics = SyncMetrics()
             try:
-                func(*args, **kwargs)
+                obj.sync()
             finally:
-                os.remove(lock_file_path)
+                lock.release()
+        return result
 
     return wrapper
 
 
 class CKWrapper:
     def __init__(self):
-        self._host_name = None
+        self._context = None
+        self._identity = None
+        self._identity_check = None
+        self._push_process = None
+        # Set by the daemon: pushes run while it waits for the next change instead of delaying the sync
+        self.background_push = False
+        self.metrics = SyncMetrics()
 
     @property
     def repo_path(self):
@@ -74,40 +182,79 @@ class CKWrapper:
 
     @property
     def hostname_path(self):
-        return self.repo_path / "hostname.txt"
+        return self.repo_path / HOSTNAME_FILE
+
+    @property
+    def context(self):
+        """The RuntimeContext of the configured host, loaded on first use."""
+        if self._context is None:
+            self._context = RuntimeContext.load(self.repo_path)
+        return self._context
 
     @property
     def hostname(self):
-        if not self._host_name:
-            if self.hostname_path.is_file():
-                self._host_name = self.hostname_path.read_text()
-            else:
-                raise ConfKeepError("hostname.txt does not exist. Host not configured.")
-        return self._host_name
+        return self.context.hostname
 
     def initial_hostname_setup(self):
         """Setup the hostname property and write it to the hostname file."""
         if settings.ASSUME_YES or settings.ASSUME_NO:
-            self._host_name = settings.HOST_NAME
+            host_name = settings.HOST_NAME
         else:
-            self._host_name = input(
+            host_name = input(
                 f"Please input the host, hostname. Press enter for {settings.HOST_NAME}: "
             )
-            if not self._host_name:
-                self._host_name = settings.HOST_NAME
-        self.hostname_path.write_text(self._host_name)
+            if not host_name:
+                host_name = settings.HOST_NAME
+        self.hostname_path.write_text(host_name)
+        self._context = None
 
     @property
     def work_path(self):
         """Path that is equal to "local_repository/hostname" """
-        if self.hostname_path.is_file():
-            return self.repo_path / self.hostname_path.read_text()
-        else:
-            raise ConfKeepError("hostname.txt does not exist. Host not configured.")
+        return self.context.work_path
 
     @property
     def tracked_file_path(self):
-        return self.work_path / "tracked.txt"
+        return self.context.tracked_file_path
+
+    @property
+    def state_path(self):
+        """Directory for local state that must never be committed, kept inside .git for that reason."""
+        return self.repo_path / ".git" / "conf-keep"
+
+    @property
+    def manifest_path(self):
+        return self.state_path / "manifest.json"
+
+    @property
+    def push_state_path(self):
+        return self.state_path / "push.json"
+
+    @property
+    def maintenance_state_path(self):
+        return self.state_path / "maintenance.json"
+
+    @property
+    def change_index_path(self):
+        return self.state_path / "index.sqlite"
+
+    @property
+    def collect_state_path(self):
+        return self.state_path / "collect.json"
+
+    @property
+    def schedule_state_path(self):
+        return self.state_path / "schedule.json"
+
+    @property
+    def sync_state_path(self):
+        return self.state_path / "sync-state.json"
+
+    @property
+    def lock(self):
+        return RepositoryLock(
+            self.repo_path / "conf-keep.lock", self.state_path / "rerun-requested"
+        )
 
     @property
     def remote(self):
@@ -115,50 +262,93 @@ class CKWrapper:
             settings.REMOTE = input("Please type the remote repository url: ")
         return settings.REMOTE
 
+    @property
+    def identity(self):
+        if self._identity is None:
+            from confkeep.identity import HostIdentity
+
+            self._identity = HostIdentity(settings.IDENTITY_SOURCE)
+        return self._identity
+
+    def start_identity_check(self):
+        """Run is_ip_changed in a background thread, its result is checked by await_identity."""
+        import concurrent.futures
+
+        def check():
+            with self.metrics.phase("identity"):
+                return self.is_ip_changed()
+
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._identity_check = executor.submit(check)
+        executor.shutdown(wait=False)
+
+    def await_identity(self):
+        """Wait for the check started by start_identity_check, unless there is none or it was already awaited. Raise
+        ConfKeepError if this isn't the same host anymore."""
+        check, self._identity_check = self._identity_check, None
+        if check and check.result():
+            raise ConfKeepError()  # Notifications already printed
+
+    def cancel_identity_check(self):
+        """Wait for a check that was never awaited, e.g. because the command failed first, ignoring its result."""
+        check, self._identity_check = self._identity_check, None
+        if check:
+            check.exception()
+
     def is_ip_changed(self):
         if settings.IGNORE_IP_CHANGES:
             return False
-        original_ip_out = json.loads(self.original_ip_path.read_text())
-        new_ip_out = get_ip_interfaces()
         if not self.original_ip_path.is_file():
             print("Original was removed. Adding a new one")
-            self.original_ip_path.write_text(json.dumps(new_ip_out))
+            self.original_ip_path.write_text(self.identity.fingerprint())
+            return False
+        original = self.original_ip_path.read_text().strip()
+        current = self.identity.fingerprint()
+        if original == current:
+            print("ip output haven't changed.")
+            return False
+        elif self.identity.matches_legacy(original):
+            print(
+                "Converting the ip output saved by an older version to a fingerprint."
+            )
+            self.original_ip_path.write_text(current)
             return False
         else:
-            if original_ip_out == new_ip_out:
-                print("ip output haven't changed.")
-                return False
-            else:
-                print(
-                    f"ip output changed! Please ensure that {self.work_path} is the name of this host, change"
-                    f" {self.hostname_path} accordingly and remove {self.original_ip_path} once you are done."
-                )
-                self.new_ip_path.write_text(json.dumps(new_ip_out))
-                subprocess.run(
-                    [
-                        "diff",
-                        self.original_ip_path.absolute(),
-                        self.new_ip_path.absolute(),
-                    ]
-                )
-                return True
+            print(
+                f"ip output changed! Please ensure that {self.work_path} is the name of this host, change"
+                f" {self.hostname_path} accordingly and remove {self.original_ip_path} once you are done."
+            )
+            self.new_ip_path.write_text(
+                json.dumps(self.identity.description(), indent=2, sort_keys=True)
+            )
+            print(f"Saved fingerprint: {original}")
+            print(f"Current fingerprint: {current}, computed from {self.new_ip_path}:")
+            print(self.new_ip_path.read_text())
+            return True
 
     def config_host(self):
         """To add another host to the repository"""
         print("Configuring host")
         repo_path = self.repo_path
+        cloned = False
         if not repo_path.is_dir():
             remote_url = self.remote
             print(f"Cloning repository {remote_url}.")
-            subprocess.run(["git", "clone", remote_url, repo_path], check=True)
+            self.clone(remote_url, repo_path)
+            cloned = True
         else:
-            pass  # No need to pull until we know the branch
+            # No need to pull until we know the branch
+            self.attach_object_store()
         self.initial_hostname_setup()
+        if cloned and not settings.FULL_CLONE:
+            self.scope_to_host()
         print(self.work_path)
         if self.work_path.is_dir():
             if is_yes(
                 f"Theres already a configuration directory for the host {self.hostname}. Do you want to delete it"
             ):
+                import shutil
+
                 shutil.rmtree(self.work_path)
                 print("Removed.")
             else:
@@ -177,18 +367,91 @@ class CKWrapper:
         self.work_path.mkdir()
         tracked_path = self.tracked_file_path
         tracked_path.touch()
-        with self.original_ip_path.open("w") as original_ip:
-            original_ip.write(json.dumps(get_ip_interfaces()))
+        self.original_ip_path.write_text(self.identity.fingerprint())
         self.git_add(tracked_path.absolute())
         self.git_add(self.original_ip_path.absolute())
         self.git_commit_am(f"Host {self.hostname} added to the repo")
-        self.git_push(self.hostname)
+        self.push_now()
         print(
             f"The host {self.hostname} has been setup for tracking configuration "
             f"changes. Add new files or directories to track with the command "
             f"{ADD_WATCH_COMMAND}."
         )
 
+    def clone(self, remote_url, repo_path):
+        """Clone only the default branch, without file contents or a checkout beyond the top-level files.
+
+        The rest is fetched once the host is known, see scope_to_host. Falls back to a plain clone when FULL_CLONE is
+        set or git can't do it. With SHARED_OBJECT_STORE the store is fetched first and the objects it has are borrowed
+        from it instead of being fetched again.
+        """
+        reference = []
+        if settings.SHARED_OBJECT_STORE:
+            from confkeep.object_store import init_store, refresh
+
+            init_store(settings.SHARED_OBJECT_STORE, remote_url)
+            refresh(settings.SHARED_OBJECT_STORE)
+            reference = ["--reference-if-able", str(settings.SHARED_OBJECT_STORE)]
+        if not settings.FULL_CLONE:
+            try:
+                subprocess.run(
+                    [
+                        "git",
+                        "clone",
+                        "--filter=blob:none",
+                        "--single-branch",
+                        "--sparse",
+                        *reference,
+                        remote_url,
+                        repo_path,
+                    ],
+                    check=True,
+                )
+                return
+            except subprocess.CalledProcessError:
+                import shutil
+
+                print("Partial clone failed, falling back to a full clone.")
+                shutil.rmtree(repo_path, ignore_errors=True)
+        subprocess.run(["git", "clone", *reference, remote_url, repo_path], check=True)
+
+    def attach_object_store(self):
+        """Borrow the objects of SHARED_OBJECT_STORE, creating it if needed. Return whether the store is set."""
+        if not settings.SHARED_OBJECT_STORE:
+            return False
+        from confkeep.object_store import attach, init_store
+
+        remote_url = self.git_command(
+            "config", "--get", "remote.origin.url", get_stdout=True
+        ).decode()
+        init_store(settings.SHARED_OBJECT_STORE, remote_url.strip())
+        attach(self.repo_path, settings.SHARED_OBJECT_STORE)
+        return True
+
+    def scope_to_host(self):
+        """Limit the checkout to the host's directory and fetches and pushes to the host branch."""
+        branch = self.hostname
+        self.git_command(
+            "config",
+            "--replace-all",
+            "remote.origin.fetch",
+            f"+refs/heads/{branch}:refs/remotes/origin/{branch}",
+        )
+        self.git_command(
+            "config", "remote.origin.push", f"refs/heads/{branch}:refs/heads/{branch}"
+        )
+        self.git_command("config", "remote.origin.tagOpt", "--no-tags")
+        try:
+            self.git_command("sparse-checkout", "set", branch)
+        except subprocess.CalledProcessError:
+            print(
+                "Sparse checkout isn't available, the whole branch will be checked out."
+            )
+        if self.git_command(
+            "ls-remote", "--heads", "origin", f"refs/heads/{branch}", get_stdout=True
+        ).strip():
+            self.git_command("fetch", "origin")
+
     def bootstrap_repository(self):
         """To create the repository"""
         print("Bootstrapping repository")
@@ -205,6 +468,7 @@ class CKWrapper:
         self.git_add(gitignore_path)
         remote_url = self.remote
         self.git_command("remote", "add", "origin", remote_url)
+        self.attach_object_store()
         self.git_commit_am("Initial commit")
         self.git_push("master")
         print(
@@ -217,99 +481,347 @@ class CKWrapper:
         print(f"export REPO_PATH={self.repo_path}")
         print(f"export REMOTE={self.remote}")
 
+    def watch(self, argv):
+        """The watch command: track_dir for the paths given as arguments, listed in a file or on stdin ("-")."""
+        if not argv:
+            self.track_dir()
+            return
+        import argparse
+
+        parser = argparse.ArgumentParser(
+            prog=f"conf-keep {ADD_WATCH_COMMAND}",
+            description="Track files and directories, recording them in a single commit.",
+        )
+        parser.add_argument(
+            "paths",
+            nargs="*",
+            help="absolute paths or glob patterns, - to read them from stdin",
+        )
+        parser.add_argument(
+            "--from-file", help="file listing one path or pattern per line"
+        )
+        parser.add_argument(
+            "--sync",
+            action="store_true",
+            help="sync the new paths right away instead of waiting for the next sync",
+        )
+        options = parser.parse_args(argv)
+        arguments = []
+        for argument in options.paths:
+            if argument == "-":
+                arguments += read_path_list(sys.stdin)
+            else:
+                arguments.append(argument)
+        if options.from_file:
+            with open(options.from_file) as path_list:
+                arguments += read_path_list(path_list)
+        if not arguments:
+            raise ConfKeepError("No path to track.")
+        # Lists are meant for scripts and stdin was read to the end, nobody can answer the prompts for options
+        prompt = (
+            "-" not in options.paths and not options.from_file and sys.stdin.isatty()
+        )
+        self.track_dir(expand_paths(arguments), options.sync, prompt)
+
     @with_test_repo
-    def track_dir(self):
-        if not settings.MONITORED_PATH:
-            directory = pathlib.Path(input("What do you want to start tracking? "))
+    def track_dir(self, directories=None, first_sync=False, prompt=True):
+        """Track directories (absolute paths), MONITORED_PATH or a path typed by the user with a single commit.
+
+        The options from the settings or typed once apply to all of them, though filters only to directories. Paths
+        tracked already are left as they are, unless options were given, which replace theirs. With first_sync the new
+        and changed paths are synced right away. Without prompt only the options from the settings are used.
+        """
+        if directories:
+            pass
+        elif not settings.MONITORED_PATH:
+            directories = [pathlib.Path(input("What do you want to start tracking? "))]
         else:
-            directory = settings.MONITORED_PATH
-        if not directory.is_absolute():
-            raise AttributeError(f"The directory {directory} must be an absolute path.")
-        if any(
-            str(directory.absolute()) == path
-            for path in self.tracked_file_path.read_text().splitlines()
-        ):
-            print(f"The directory {directory} is already being tracked. Nothing to do.")
+            directories = [settings.MONITORED_PATH]
+        for directory in directories:
+            if not directory.is_absolute():
+                raise AttributeError(
+                    f"The directory {directory} must be an absolute path."
+                )
+        options, options_given = self.ask_options(
+            next((path for path in directories if path.is_dir()), directories[0]),
+            prompt,
+        )
+        tracked = read_tracked(self.tracked_file_path)
+        positions = {str(entry): position for position, entry in enumerate(tracked)}
+        added, changed = [], []
+        for directory in directories:
+            if directory.is_dir():
+                entry = TrackedPath(
+                    directory,
+                    options.exclude,
+                    options.include,
+                    options.max_size,
+                    options.interval,
+                )
+            else:
+                entry = TrackedPath(directory, interval=options.interval)
+            position = positions.get(str(directory))
+            if position is None:
+                positions[str(directory)] = len(tracked)
+                tracked.append(entry)
+                added.append(entry)
+            elif options_given and tracked[position] != entry:
+                tracked[position] = entry
+                changed.append(entry)
+        if not added and not changed:
+            if len(directories) == 1:
+                print(
+                    f"The directory {directories[0]} is already being tracked. Nothing to do."
+                )
+            else:
+                print("All these paths are already being tracked. Nothing to do.")
             return
-        with self.tracked_file_path.open("at") as tracked:
-            tracked.write(str(directory) + "\n")
+        if len(directories) == 1:
+            message = (
+                f"New directory {directories[0]} being tracked."
+                if added
+                else f"Options of {directories[0]} changed."
+            )
+            body = []
+        else:
+            message = f"{len(added)} new path(s) being tracked, options of {len(changed)} changed."
+            body = ["-m", "".join(f"{entry}\n" for entry in added + changed)]
+        write_tracked(self.tracked_file_path, tracked)
         self.git_add(self.tracked_file_path.absolute())
-        self.git_commit_am(f"New directory {directory} being tracked.")
-        self.git_push(self.work_path.name)
+        self.git_command("commit", "-m", message, *body)
+        self.push_now()
+        print(message)
+        if first_sync:
+            self.sync([str(entry) for entry in added + changed])
 
-    @with_test_repo
-    def watchdog(self):
-        to_sync = self.tracked_file_path.read_text().splitlines()
-        if not to_sync:
+    def ask_options(self, directory, prompt=True):
+        """Return the TrackedPath of directory with the options from the settings or typed by the user, and whether any
+        were given that way. Without settings nor prompt (ASSUME_YES or prompt False) it has no options and none were
+        given.
+        """
+        exclude = settings.MONITORED_EXCLUDE
+        include = settings.MONITORED_INCLUDE
+        max_size = settings.MONITORED_MAX_SIZE
+        interval = settings.MONITORED_INTERVAL
+        interactive = prompt and not (
+            settings.ASSUME_YES
+            or settings.ASSUME_NO
+            or exclude
+            or include
+            or max_size
+            or interval
+        )
+        try:
+            if interactive and directory.is_dir():
+                exclude = input(
+                    "Space separated patterns to leave out (e.g. *.swp cache/). Press enter for none: "
+                ).split()
+                if exclude:
+                    include = input(
+                        "Space separated exceptions to those patterns. Press enter for none: "
+                    ).split()
+                max_size = input(
+                    "Leave out files larger than (e.g. 10M). Press enter for no limit: "
+                )
+            if interactive:
+                interval = input(
+                    "Sync it at most every (e.g. 30m, 1h or 1d). Press enter to sync it on every run: "
+                )
+        except EOFError:
+            raise ConfKeepError(
+                "No answer on stdin, set ASSUME_YES or the MONITORED_ options to track paths non-interactively."
+            )
+        given = interactive or bool(exclude or include or max_size or interval)
+        entry = TrackedPath(
+            directory,
+            exclude,
+            include,
+            parse_size(max_size) if max_size else None,
+            parse_interval(interval) if interval else None,
+        )
+        return entry, given
+
+    def scheduled_sync(self):
+        """The sync command run by cron: watchdog, unless ADAPTIVE_SYNC backs off because nothing changed lately."""
+        if not settings.ADAPTIVE_SYNC:
+            self.watchdog()
+            return
+        started = time.time()
+        try:
+            schedule = json.loads(self.schedule_state_path.read_text())
+        except (FileNotFoundError, ValueError):
+            schedule = {}
+        # Runs of a cron job don't start exactly on the second, don't push a due sync back by a whole period
+        if started < schedule.get("next_run", 0) - SCHEDULE_SLACK:
+            print(
+                f"Nothing changed lately, next sync in {int(schedule['next_run'] - started)} seconds."
+            )
+            return
+        changed = self.watchdog()
+        if changed is None:
+            return  # Another command held the lock
+        interval = next_interval(
+            schedule.get("interval", 0), changed, settings.ADAPTIVE_MAX_INTERVAL
+        )
+        self.state_path.mkdir(parents=True, exist_ok=True)
+        self.schedule_state_path.write_text(
+            json.dumps({"interval": interval, "next_run": started + interval})
+        )
+
+    @with_test_repo(coalesce=True, overlap_identity=True)
+    def watchdog(self, paths=None):
+        """Copy the tracked paths that are due (or the tracked ones among paths), commit what changed and push if it's
+        time. Return whether something was committed."""
+        return self.sync(paths)
+
+    def sync(self, paths=None):
+        """watchdog without the locking and the host checks."""
+        profile = None
+        if settings.PROFILE_PATH:
+            import cProfile
+
+            profile = cProfile.Profile()
+            profile.enable()
+        success = False
+        try:
+            changed = self.commit_changes(paths)
+            # Nothing was committed if it returned early, but pushes and maintenance need a known host too
+            self.await_identity()
+            with self.metrics.phase("push"):
+                self.push_pending()
+            if self.maintenance_due():
+                self.run_maintenance()
+            success = True
+            return changed
+        finally:
+            if profile:
+                profile.disable()
+                profile.dump_stats(settings.PROFILE_PATH)
+                print(f"Profile written to {settings.PROFILE_PATH}")
+            print(self.metrics.summary())
+            try:
+                self.metrics.write(
+                    success, settings.METRICS_LOG, settings.METRICS_TEXTFILE
+                )
+            except OSError as error:
+                print(f"Could not write the metrics: {error}")
+
+    def commit_changes(self, paths=None):
+        """Commit the changes of the tracked paths that are due, or of the tracked ones among paths. Return whether
+        something was committed.
+
+        A tracked path with an interval is due when it wasn't synced in the last interval seconds. Paths given
+        explicitly (e.g. by the daemon, which saw them change) are always synced.
+        """
+        started = time.time()
+        tracked = read_tracked(self.tracked_file_path)
+        if not tracked:
             raise ConfKeepError(
                 f"No files being monitored yet, use the command {ADD_WATCH_COMMAND} before calling"
                 f" {SYNC_COMMAND}."
             )
-        for path in to_sync:
-            path = pathlib.Path(path)
-            if not path.exists():
-                try:
-                    os.remove(self.work_path / path.name)
-                except IsADirectoryError:
-                    shutil.rmtree(self.work_path / path.name)
-                except FileNotFoundError:
-                    pass  # No problem if what you tried to remove is already gone
-            else:
-                subprocess.run(
-                    ["rsync", "-EWavz", "--delete", str(path), self.work_path],
-                    check=not settings.IGNORE_SYNC_ERRORS,
+        if settings.SNAPSHOT_MODE not in (MIRROR_MODE, DIRECT_MODE):
+            raise ConfKeepError(f"Unknown SNAPSHOT_MODE {settings.SNAPSHOT_MODE}.")
+        sync_state = self.load_sync_state()
+        if paths is None:
+            # Like scheduled_sync, a run starting a little early doesn't push a due path back by a whole period
+            to_sync = [
+                entry
+                for entry in tracked
+                if started - sync_state.get(str(entry), 0)
+                >= (entry.interval or 0) - SCHEDULE_SLACK
+            ]
+        else:
+            to_sync = [entry for entry in tracked if str(entry) in paths]
+        self.metrics.count("paths_not_due", len(tracked) - len(to_sync))
+        if not to_sync:
+            print("No tracked path is due")
+            return False
+        changed = self.commit_paths(to_sync, tracked)
+        for entry in to_sync:
+            sync_state[str(entry)] = started
+        self.save_sync_state(
+            {path: sync_state[path] for path in map(str, tracked) if path in sync_state}
+        )
+        return changed
+
+    def commit_paths(self, to_sync, tracked):
+        filters = {str(entry): entry for entry in tracked}
+        direct = settings.SNAPSHOT_MODE == DIRECT_MODE
+        manifest = None
+        failed = []
+        if direct or not settings.DISABLE_MANIFEST:
+            with self.metrics.phase("scan"):
+                manifest = StatManifest(self.manifest_path).load()
+                to_sync = [filters[root] for root in manifest.refresh(to_sync, filters)]
+            self.metrics.count(
+                "files_scanned",
+                sum(len(entries) for entries in manifest.pending.values()),
+            )
+            self.metrics.count("paths_changed", len(to_sync))
+            if not to_sync:
+                print("Nothing changed")
+                return False
+        if direct:
+            self.await_identity()
+            with self.metrics.phase("snapshot"):
+                summary = commit_snapshot(
+                    self, manifest, to_sync, settings.IGNORE_SYNC_ERRORS
                 )
-        status = self.git_command("status", "-s", get_stdout=True).splitlines()
-        commit_message_body = ""
-        some_added = False
-        some_changed = False
-        some_deleted = False
-        something_else = False
-        for change in status[:5]:
-            change = str(change.strip(), "utf-8").split(maxsplit=1)
-            if change[0] == "??":
-                some_added = True
-                commit_message_body += f"\nFile {change[1]} added to the repository"
-            elif change[0] == "M":
-                some_changed = True
-                commit_message_body += f"\nFile {change[1]} was changed"
-            elif change[0] == "D":
-                some_deleted = True
-                commit_message_body += f"\nFile {change[1]} was deleted"
-            else:
-                something_else = True
-                commit_message_body += f"\nSomething happened to {change[1]} but conf-keep doesn't know what it was"
-        if len(status) > 5:
-            commit_message_body += f"\nThere are more {len(status) - 5} changes..."
-        if some_added + some_changed + some_deleted + something_else > 1:
-            commit_message_head = "Several files were changed added or deleted"
-        elif some_added:
-            commit_message_head = "Some file(s) were added"
-        elif some_changed:
-            commit_message_head = "Some file(s) were changed"
-        elif some_deleted:
-            commit_message_head = "Some file(s) were deleted"
-        elif something_else:
-            commit_message_head = "Some file(s) changed in an unexpected way"
         else:
+            with self.metrics.phase("copy"):
+                if settings.SYNC_PIPELINE:
+                    from confkeep.pipeline import copy_and_stage
+
+                    failed = copy_and_stage(self, to_sync)
+                else:
+                    failed = sync_paths(to_sync, self.work_path, self.metrics)
+            with self.metrics.phase("status"):
+                # Only look at the synced paths, plus the files commands and manual edits may have changed
+                host = self.work_path.name
+                pathspecs = [f"{host}/{entry.path.name}" for entry in to_sync]
+                pathspecs += [f"{host}/{self.tracked_file_path.name}"]
+                pathspecs += [self.original_ip_path.name]
+                summary = StatusSummary()
+                changed = set()
+                for change in iter_status(self.repo_path, *pathspecs):
+                    summary.add(*change)
+                    for path in change[1:]:
+                        if path:
+                            changed.add("/".join(path.split("/")[:2]))
+        for change, count in summary.counts.items():
+            if count:
+                self.metrics.count(f"changes_{change.replace(' ', '_')}", count)
+        if not summary.total:
             print("Nothing changed")
-            return
-        self.git_add(".")
-        self.git_command("commit", "-m", commit_message_head, "-m", commit_message_body)
-        self.git_push(self.work_path.name)
-        print(f"{len(status)} changes commited")
+            if manifest:
+                manifest.save(tracked, failed)
+            return False
+        if not direct:
+            with self.metrics.phase("commit"):
+                self.git_command("add", "--all", "--", *sorted(changed))
+                self.git_command("commit", "-m", summary.head, "-m", summary.body)
+        if manifest:
+            # Paths whose copy had ignored errors are synced again by the next run
+            manifest.save(tracked, failed)
+        self.queue_push()
+        print(f"{summary.total} changes commited")
+        return True
 
-    def git_command(self, *args, get_stdout=False):
+    def git_command(self, *args, get_stdout=False, timeout=None):
         ls = ["git"]
         ls.extend(args)
         if not get_stdout:
-            subprocess.run([str(x) for x in ls], check=True, cwd=self.repo_path)
+            subprocess.run(
+                [str(x) for x in ls], check=True, cwd=self.repo_path, timeout=timeout
+            )
         else:
             cp = subprocess.run(
                 [str(x) for x in ls],
                 check=True,
                 cwd=self.repo_path,
                 stdout=subprocess.PIPE,
+                timeout=timeout,
             )
             return cp.stdout
 
@@ -322,53 +834,504 @@ class CKWrapper:
     def git_add(self, file):
         self.git_command("add", "--all", file)
 
+    def load_push_state(self):
+        try:
+            return json.loads(self.push_state_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_push_state(self, state):
+        self.state_path.mkdir(parents=True, exist_ok=True)
+        self.push_state_path.write_text(json.dumps(state))
+
+    def load_sync_state(self):
+        """Return {tracked path: time its last sync started}."""
+        try:
+            return json.loads(self.sync_state_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_sync_state(self, state):
+        self.state_path.mkdir(parents=True, exist_ok=True)
+        self.sync_state_path.write_text(json.dumps(state))
+
+    def queue_push(self):
+        """Mark the host branch as having commits the remote doesn't have yet."""
+        state = self.load_push_state()
+        state["pending"] = True
+        self.save_push_state(state)
+
+    def push_now(self):
+        """Push the host branch right away, with the lease of a compacted history if there is one."""
+        self.queue_push()
+        self.push_pending(force=True)
+
+    def queued_commits(self):
+        return int(
+            self.git_command(
+                "rev-list",
+                "--count",
+                self.work_path.name,
+                "--not",
+                "--remotes=origin",
+                "--",
+                get_stdout=True,
+            )
+        )
+
+    def push_pending(self, force=False):
+        """Push the queued commits of the host branch if the push interval and retry backoff allow it.
+
+        Failures are reported and retried later with an exponential backoff instead of failing the sync, unless force
+        is set, which also ignores the interval and backoff. With background_push the push is started and left running,
+        it is waited for by the next push_pending or finish_push.
+        """
+        self.finish_push()
+        state = self.load_push_state()
+        if not state.get("pending") and not force:
+            return
+        now = time.time()
+        next_attempt = state.get("next_attempt", 0)
+        if not force and now < next_attempt:
+            print(
+                f"{self.queued_commits()} commit(s) queued, next push in {int(next_attempt - now)} seconds."
+            )
+            return
+        branch = self.work_path.name
+        lease = state.get("lease")
+        options = [f"--force-with-lease={branch}:{lease}"] if lease else []
+        if self.background_push and not force:
+            # The commit is named so that commits made in the meantime stay queued
+            tip = (
+                self.git_command("rev-parse", branch, get_stdout=True).decode().strip()
+            )
+            process = subprocess.Popen(
+                ["git", "push", *options, "origin", f"{tip}:refs/heads/{branch}"],
+                cwd=self.repo_path,
+            )
+            self._push_process = (process, now, tip)
+            return
+        try:
+            self.git_command(
+                "push", *options, "origin", branch, timeout=settings.PUSH_TIMEOUT
+            )
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            self.push_failed(state, now, force)
+            return
+        self.push_succeeded(now, pending=False)
+
+    def finish_push(self):
+        """Wait for the push started in the background by push_pending, if any, killing it after PUSH_TIMEOUT
+        seconds."""
+        if self._push_process is None:
+            return
+        process, started, tip = self._push_process
+        self._push_process = None
+        try:
+            return_code = process.wait(
+                timeout=max(0, started + settings.PUSH_TIMEOUT - time.time())
+            )
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            return_code = None
+        if return_code != 0:
+            self.push_failed(self.load_push_state(), started, False)
+            return
+        branch = self.work_path.name
+        pushed_all = (
+            self.git_command("rev-parse", branch, get_stdout=True).decode().strip()
+            == tip
+        )
+        self.push_succeeded(started, pending=not pushed_all)
+
+    def push_succeeded(self, now, pending):
+        self.save_push_state(
+            {
+                "pending": pending,
+                "failures": 0,
+                "next_attempt": now + settings.PUSH_INTERVAL,
+                "last_push": now,
+            }
+        )
+
+    def push_failed(self, state, now, force):
+        """Record a failed push and schedule the next attempt. Raise ConfKeepError if force is set."""
+        branch = self.work_path.name
+        lease = state.get("lease")
+        failures = state.get("failures", 0) + 1
+        delay = min(
+            settings.PUSH_RETRY_MAX, settings.PUSH_RETRY_DELAY * 2 ** (failures - 1)
+        )
+        state.update(pending=True, failures=failures, next_attempt=now + delay)
+        self.save_push_state(state)
+        message = f"Push failed, {self.queued_commits()} commit(s) queued."
+        if lease:
+            message += f" The compacted history replaces origin/{branch} only if it is still at {lease}."
+        if force:
+            raise ConfKeepError(message)
+        print(f"{message} Retrying in {int(delay)} seconds.")
+
+    def maintenance_due(self):
+        if not settings.MAINTENANCE_INTERVAL:
+            return False
+        try:
+            last_run = json.loads(self.maintenance_state_path.read_text())["last_run"]
+        except (FileNotFoundError, ValueError, KeyError):
+            last_run = 0
+        return time.time() - last_run >= settings.MAINTENANCE_INTERVAL
+
+    def run_maintenance(self):
+        """Run the maintenance stage. Failures are reported without failing the command, it is retried next time."""
+        from confkeep.maintenance import run_maintenance
+
+        # Compacting would rewrite commits a background push may still be sending
+        self.finish_push()
+        started = time.time()
+        try:
+            with self.metrics.phase("maintenance"):
+                print(run_maintenance(self, self.metrics))
+        except (subprocess.CalledProcessError, ConfKeepError) as error:
+            print(f"Maintenance failed: {error}")
+        self.state_path.mkdir(parents=True, exist_ok=True)
+        self.maintenance_state_path.write_text(json.dumps({"last_run": started}))
+
+    def compact_history(self):
+        """Fold the old commits of the host branch, see confkeep/compaction.py, and queue the push that replaces the
+        remote branch. Return (commits before, commits after) or None if there was nothing to fold.
+        """
+        from confkeep.compaction import compact_history
+
+        try:
+            remote = (
+                self.git_command(
+                    "rev-parse",
+                    "--verify",
+                    "-q",
+                    f"refs/remotes/origin/{self.hostname}",
+                    get_stdout=True,
+                )
+                .decode()
+                .strip()
+            )
+        except subprocess.CalledProcessError:
+            remote = None  # Never pushed, a plain push is enough
+        result = compact_history(
+            self, time.time(), settings.COMPACT_FULL_DAYS, settings.COMPACT_HOURLY_DAYS
+        )
+        if result is None:
+            return None
+        state = self.load_push_state()
+        if remote:
+            # Only replace the remote branch if it still is what this history was compacted from
+            state.setdefault("lease", remote)
+        state["pending"] = True
+        self.save_push_state(state)
+        # Plain pushes of the branch are rejected until the remote has the new history, don't wait for the next sync
+        try:
+            self.push_pending(force=True)
+        except ConfKeepError as error:
+            print(error)
+        return result
+
+    @with_test_repo
+    def maintenance(self):
+        """Run the maintenance stage right away."""
+        self.run_maintenance()
+
+    @with_test_repo
+    def push(self):
+        """Push the queued commits right away."""
+        self.push_pending(force=True)
+
+    def fetch_host_branches(self):
+        """Fetch every host branch, even in a clone limited to this host's branch."""
+        try:
+            self.git_command(
+                "fetch",
+                "--quiet",
+                "origin",
+                "+refs/heads/*:refs/remotes/origin/*",
+                timeout=settings.PUSH_TIMEOUT,
+            )
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            print("Fetch failed, using the branches fetched before.")
+
+    def own_host(self):
+        """The host of this repository, or None in a repository that was only bootstrapped (e.g. a collector)."""
+        try:
+            return self.hostname
+        except ConfKeepError:
+            return None
+
+    def query(self, argv):
+        """Print the changes made to tracked files on every host, see confkeep/change_index.py."""
+        from confkeep.change_index import (
+            ChangeIndex,
+            format_change,
+            parse_arguments,
+            parse_time,
+        )
+
+        options = parse_arguments(argv, f"conf-keep {QUERY_COMMAND}")
+        now = time.time()
+        since = None if options.since is None else parse_time(options.since, now)
+        until = None if options.until is None else parse_time(options.until, now)
+        if options.fetch:
+            self.fetch_host_branches()
+        with ChangeIndex(self.change_index_path) as index:
+            index.update(self, self.own_host())
+            rows = index.query(options.path, options.host, since, until, options.limit)
+        for row in rows:
+            print(format_change(row))
+        if not rows:
+            print("No changes found")
+
+    def drift(self, argv):
+        """Print which hosts differ from the majority for a file or directory, see confkeep/drift.py."""
+        from confkeep.drift import parse_arguments, report
+
+        options = parse_arguments(argv, f"conf-keep {DRIFT_COMMAND}")
+        if options.fetch:
+            self.fetch_host_branches()
+        print("\n".join(report(self, options.path, self.own_host(), options.diff)))
+
+    def restore(self, argv):
+        """Restore a tracked path as it was at a commit or time, see confkeep/restore.py."""
+        import tempfile
+
+        from confkeep.change_index import branch_tips, parse_time
+        from confkeep.restore import (
+            delete_extra,
+            describe,
+            extract,
+            find_source,
+            parse_arguments,
+            resolve_commit,
+        )
+
+        options = parse_arguments(argv, f"conf-keep {RESTORE_COMMAND}")
+        path = pathlib.Path(os.path.abspath(options.path))
+        own_host = self.own_host()
+        host = options.host or own_host
+        if not host:
+            raise ConfKeepError(
+                "This host isn't configured, give the host with --host."
+            )
+        before = None if options.at is None else parse_time(options.at, time.time())
+        if options.fetch and host != own_host:
+            self.fetch_host_branches()
+        tip = branch_tips(self, own_host).get(host)
+        if not tip:
+            raise ConfKeepError(f"There is no branch for the host {host}.")
+        commit = resolve_commit(self, tip, before, options.commit)
+        source, tracked, relative = find_source(self, commit, host, str(path))
+        destination = (
+            pathlib.Path(options.to).absolute() / path.name if options.to else path
+        )
+        version = f"{host}'s {path} at {describe(self, commit)}"
+        written = set()
+        if options.dry_run:
+            with tempfile.TemporaryDirectory() as staging:
+                restored = pathlib.Path(staging) / path.name
+                extract(self.repo_path, commit, source, restored, written)
+                current = destination
+                if not destination.exists() and not destination.is_symlink():
+                    current = pathlib.Path(
+                        tempfile.mkdtemp(dir=staging)
+                        if restored.is_dir()
+                        else os.devnull
+                    )
+                # Files that exist now but not in the restored version are left alone, don't show them as deleted. The
+                # ones --delete would delete are listed below instead, since it keeps what the filters leave out
+                differences = subprocess.run(
+                    ["git", "diff", "--no-index", "--no-color", "--no-renames"]
+                    + ["--diff-filter=d", "--", current, restored]
+                ).returncode
+            if options.delete and restored.is_dir() and current == destination:
+                deleted = delete_extra(
+                    destination, written, tracked, relative, dry_run=True
+                )
+                for deleted_path in deleted:
+                    print(f"Would delete {deleted_path}")
+                differences = differences or deleted
+            if not differences:
+                print(f"Restoring {version} would change nothing in {destination}.")
+            return
+        count = extract(self.repo_path, commit, source, destination, written)
+        print(f"{count} file(s) of {version} restored to {destination}.")
+        if options.delete and destination.is_dir() and not destination.is_symlink():
+            deleted = delete_extra(destination, written, tracked, relative)
+            print(f"{len(deleted)} path(s) that didn't exist at that time deleted.")
+
+    def collect(self, argv):
+        """Fetch the tracked paths of the hosts of an inventory and commit them to their branches, see
+        confkeep/collect.py."""
+        from confkeep.collect import collect, read_inventory, summarize
+
+        if argv:
+            inventory = pathlib.Path(argv[0]).absolute()
+        elif settings.COLLECT_INVENTORY:
+            inventory = settings.COLLECT_INVENTORY
+        else:
+            raise ConfKeepError(
+                f"Give the inventory file: {COLLECT_COMMAND} <inventory>, or set COLLECT_INVENTORY."
+            )
+        hosts = read_inventory(inventory)
+        lock = self.lock
+        if not lock.acquire(COLLECT_COMMAND):
+            lock.recover_stale(settings.LOCK_STALE_AFTER)
+            print(lock.describe_holder())
+            raise ConfKeepError()
+        try:
+            try:
+                last_tips = json.loads(self.collect_state_path.read_text())
+            except (FileNotFoundError, ValueError):
+                last_tips = {}
+            started = time.monotonic()
+            results = collect(self, hosts, last_tips)
+            last_tips.update(
+                (result.name, result.tip) for result in results if result.tip
+            )
+            self.state_path.mkdir(parents=True, exist_ok=True)
+            self.collect_state_path.write_text(json.dumps(last_tips))
+            remote_tips = dict(
+                line.split()
+                for line in self.git_command(
+                    "for-each-ref",
+                    "--format=%(refname:lstrip=3) %(objectname)",
+                    "refs/remotes/origin/",
+                    get_stdout=True,
+                )
+                .decode()
+                .splitlines()
+            )
+            unpushed = [
+                result.name
+                for result in results
+                if result.tip and result.tip != remote_tips.get(result.name)
+            ]
+            if unpushed:
+                try:
+                    self.git_command(
+                        "push", "origin", *unpushed, timeout=settings.PUSH_TIMEOUT
+                    )
+                except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+                    print(
+                        f"Push failed, {len(unpushed)} branch(es) will be pushed by the next {COLLECT_COMMAND}."
+                    )
+            print(summarize(results, time.monotonic() - started))
+        finally:
+            lock.release()
+        failed = sum(1 for result in results if result.error)
+        if failed:
+            raise ConfKeepError(f"{failed} host(s) could not be collected.")
+
+    def script_environment(self):
+        """Environment variables the scheduled sync needs, taken from the current settings."""
+        environment = {"REPO_PATH": str(self.repo_path)}
+        if settings.IGNORE_SYNC_ERRORS:
+            environment["IGNORE_SYNC_ERRORS"] = "TRUE"
+        if settings.IGNORE_IP_CHANGES:
+            environment["IGNORE_IP_CHANGES"] = "TRUE"
+        for name in SCRIPT_ENVIRONMENT:
+            if name in os.environ:
+                environment[name] = os.environ[name]
+        return environment
+
     def install_cron(self):
+        if settings.INSTALL_SYSTEMD:
+            self.install_systemd()
+            return
+        from shlex import quote
+
         print("Installing cron file")
         script_path = pathlib.Path("/usr/local/bin/conf-keep-sync")
-        if settings.IGNORE_SYNC_ERRORS:
-            ignore_sync_errors = "export IGNORE_SYNC_ERRORS=TRUE"
-        else:
-            ignore_sync_errors = ""
-        if settings.IGNORE_IP_CHANGES:
-            ignore_ip_changes = "export IGNORE_IP_CHANGES=TRUE"
-        else:
-            ignore_ip_changes = ""
+        environment = self.script_environment()
+        del environment["REPO_PATH"]
+        project_path, command = launch_command()
+        try:
+            hostname = self.hostname
+        except ConfKeepError:
+            hostname = settings.HOST_NAME
+        delay = host_delay(hostname, settings.CRON_SPREAD)
         script_path.write_text(
             SCRIPT_TEMPLATE.format(
                 repo_path=self.repo_path,
-                python_interpreter=sys.executable,
-                project_path=pathlib.Path(__file__).parent.parent,
-                ignore_sync_errors=ignore_sync_errors,
-                ignore_ip_changes=ignore_ip_changes,
+                delay=f"sleep {delay}\n" if delay else "",
+                command=" ".join(quote(part) for part in command),
+                project_path=quote(str(project_path)),
+                environment="\n".join(
+                    f"export {name}={quote(value)}"
+                    for name, value in environment.items()
+                ),
             )
         )
         script_path.chmod(0o755)
         CRON_FILE_PATH.write_text(
             f"{settings.CRON_SCHEDULE} {settings.CK_USER} {script_path}\n"
         )
+        self.check_user()
+        print(f"Cronfile installed at {CRON_FILE_PATH}")
+
+    def install_systemd(self):
+        print("Installing systemd unit")
+        project_path, command = launch_command()
+        SYSTEMD_UNIT_PATH.write_text(
+            SYSTEMD_UNIT_TEMPLATE.format(
+                user=settings.CK_USER,
+                command=" ".join(command),
+                project_path=project_path,
+                environment="\n".join(
+                    f'Environment="{name}={value}"'
+                    for name, value in self.script_environment().items()
+                ),
+            )
+        )
+        self.check_user()
+        print(f"Systemd unit installed at {SYSTEMD_UNIT_PATH}")
+        if CRON_FILE_PATH.is_file() and CRON_FILE_PATH.read_text().strip():
+            print(
+                f"Remove {CRON_FILE_PATH} so that the cron job doesn't run alongside the daemon."
+            )
+        print(
+            f"Start it with: systemctl daemon-reload && systemctl enable --now {SYSTEMD_UNIT_PATH.stem}"
+        )
+
+    def check_user(self):
         if settings.CK_USER not in pathlib.Path("/etc/passwd").read_text():
             print(
                 f"""Warning! No user "{settings.CK_USER}" detected!
 Please add one with: useradd -m -s /bin/bash {settings.CK_USER}
 Or change the generated cronfile."""
             )
-        print(f"Cronfile installed at {CRON_FILE_PATH}")
 
+    def daemon(self):
+        from confkeep.daemon import Daemon
 
-def get_ip_interfaces():
-    out = subprocess.run(["ip", "a"], stdout=subprocess.PIPE, encoding="utf-8").stdout
-    interfaces = {}
-    ips = None
-    for line in out.splitlines():
-        line = line.strip()
-        match = re.match(r"\d+: (\w+): ", line)
-        if match:
-            ips = []
-            interfaces[match.group(1)] = ips
-        else:
-            if line.startswith("inet"):
-                ips.append(line.split(maxsplit=2)[1])
-    return interfaces
+        Daemon(self).run()
+
+
+def host_delay(hostname, spread):
+    """Seconds between 0 and spread, always the same for a given host name."""
+    import zlib
+
+    return zlib.crc32(hostname.encode()) % (spread + 1) if spread > 0 else 0
+
+
+def next_interval(interval, changed, max_interval):
+    """Seconds to wait before the next adaptive sync, after waiting interval before the last one."""
+    if changed:
+        return 0
+    return min(max(interval * 2, ADAPTIVE_FIRST_INTERVAL), max_interval)
+
+
+def launch_command():
+    """Return the directory to run conf-keep from and the command that runs it, from its sources or from a zipapp."""
+    location = pathlib.Path(__file__).absolute().parent.parent
+    if location.is_file():
+        return location.parent, [sys.executable, str(location)]
+    return location, [sys.executable, "-m", "confkeep"]
 
 
 def get_gitignore():
@@ -0,0 +1,34 @@
+"""Configuration of the local repository and of this host, read once per command.
+
+Commands run every minute from cron, so the files describing the setup are read a single time and the paths derived
+from them are kept in an immutable object instead of being recomputed on every access.
+"""
+
+import collections
+
+from confkeep.util import ConfKeepError
+
+HOSTNAME_FILE = "hostname.txt"
+TRACKED_FILE = "tracked.txt"
+
+
+class RuntimeContext(
+    collections.namedtuple(
+        "RuntimeContext", "repo_path hostname work_path tracked_file_path"
+    )
+):
+    __slots__ = ()
+
+    @classmethod
+    def load(cls, repo_path):
+        try:
+            hostname = (repo_path / HOSTNAME_FILE).read_text()
+        except FileNotFoundError:
+            raise ConfKeepError(f"{HOSTNAME_FILE} does not exist. Host not configured.")
+        work_path = repo_path / hostname
+        return cls(
+            repo_path=repo_path,
+            hostname=hostname,
+            work_path=work_path,
+            tracked_file_path=work_path / TRACKED_FILE,
+        )
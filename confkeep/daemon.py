@@ -0,0 +1,257 @@
+"""Long running alternative to the cron job that syncs tracked paths as soon as they change.
+
+Changes are detected with Linux's inotify, called through ctypes. Bursts of events are debounced into a single sync of
+the tracked paths they touched. With SYNC_PIPELINE the push of a sync runs in the background while the daemon waits for
+the next change, and is waited for by the next sync before it pushes again, so pushes of the host branch never overlap.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import subprocess
+import time
+
+from confkeep import settings
+from confkeep.tracked import read_tracked
+from confkeep.util import ConfKeepError
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+CHANGE_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+EVENT_HEADER = struct.Struct("iIII")
+# The longest the select loop sleeps, so that stop requests are noticed quickly
+MAX_WAIT = 1.0
+
+
+class Inotify:
+    """Minimal ctypes binding of inotify_init1/inotify_add_watch/inotify_rm_watch."""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(
+            ctypes.util.find_library("c") or "libc.so.6", use_errno=True
+        )
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self, path=None):
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code), path)
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self._raise(path)
+        return wd
+
+    def remove_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Return the pending (watch descriptor, mask, name) events, or an empty list if there are none."""
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Daemon:
+    """Watches every tracked path and calls sync for the ones that changed.
+
+    Directories are watched recursively. Every tracked path's parent is also watched, which catches tracked files that
+    are replaced through a rename and tracked paths that are created or removed. Edits to tracked.txt are picked up
+    without a restart.
+    """
+
+    def __init__(self, ckwrapper):
+        self.ckwrapper = ckwrapper
+        self.inotify = Inotify()
+        self.tracked = []
+        # wd -> (directory, tracked paths it belongs to) for the recursive watches
+        self.tree_watches = {}
+        # wd -> {name: tracked path} for the watches on the parents of tracked paths
+        self.parent_watches = {}
+        self.pending = set()
+        self.full_sync_needed = True
+
+    def run(self, stop=None):
+        """Loop until stop (a threading.Event) is set or the process is interrupted."""
+        self.ckwrapper.background_push = bool(settings.SYNC_PIPELINE)
+        try:
+            self.reload()
+            first_event = last_event = None
+            last_full_sync = 0
+            while not (stop and stop.is_set()):
+                now = time.monotonic()
+                if self.full_sync_needed or (
+                    now - last_full_sync >= settings.DAEMON_RESCAN_INTERVAL
+                ):
+                    self.full_sync_needed = False
+                    self.pending.clear()
+                    first_event = None
+                    self.sync(None)
+                    last_full_sync = time.monotonic()
+                elif self.pending and (
+                    now - last_event >= settings.DAEMON_DEBOUNCE
+                    or now - first_event >= settings.DAEMON_MAX_DELAY
+                ):
+                    paths = sorted(self.pending)
+                    self.pending.clear()
+                    first_event = None
+                    self.sync(paths)
+                if self.pending:
+                    wait = min(
+                        settings.DAEMON_DEBOUNCE - (now - last_event),
+                        settings.DAEMON_MAX_DELAY - (now - first_event),
+                    )
+                else:
+                    wait = settings.DAEMON_RESCAN_INTERVAL - (now - last_full_sync)
+                readable, _, _ = select.select(
+                    [self.inotify.fd], [], [], max(0, min(wait, MAX_WAIT))
+                )
+                if readable and self.handle_events(self.inotify.read_events()):
+                    last_event = time.monotonic()
+                    if first_event is None:
+                        first_event = last_event
+        finally:
+            self.inotify.close()
+            self.finish_push()
+
+    def sync(self, paths):
+        if paths is None:
+            print("Syncing every tracked path")
+        else:
+            print(f"Syncing {', '.join(paths)}")
+        try:
+            self.ckwrapper.watchdog(paths)
+        except (ConfKeepError, subprocess.CalledProcessError, OSError) as error:
+            # Keep running, the next change or rescan tries again
+            if error.args:
+                print(f"Sync failed: {error}")
+
+    def finish_push(self):
+        """Wait for the last push started in the background, it records its result in the push state under the lock."""
+        self.ckwrapper.background_push = False
+        lock = self.ckwrapper.lock
+        if not lock.acquire("daemon"):
+            return  # The push is left to finish on its own and is retried by the next sync
+        try:
+            self.ckwrapper.finish_push()
+        finally:
+            lock.release()
+
+    def reload(self):
+        """(Re)read tracked.txt and watch every path in it."""
+        for wd in list(self.tree_watches) + list(self.parent_watches):
+            self.inotify.remove_watch(wd)
+        self.tree_watches.clear()
+        self.parent_watches.clear()
+        self.tracked = [
+            str(tracked) for tracked in read_tracked(self.ckwrapper.tracked_file_path)
+        ]
+        self._watch_parent(self.ckwrapper.tracked_file_path, None)
+        for path in self.tracked:
+            self._watch_parent(path, path)
+            self._watch_tree(path, path)
+
+    def _watch_parent(self, path, tracked):
+        parent, name = os.path.split(str(path))
+        try:
+            wd = self.inotify.add_watch(parent, CHANGE_MASK | IN_ONLYDIR)
+        except OSError as error:
+            print(f"Can't watch {parent}: {error.strerror}")
+            return
+        self.parent_watches.setdefault(wd, {})[name] = tracked
+
+    def _watch_tree(self, directory, tracked):
+        pending = [str(directory)]
+        while pending:
+            directory = pending.pop()
+            try:
+                wd = self.inotify.add_watch(
+                    directory, CHANGE_MASK | IN_ONLYDIR | IN_DONT_FOLLOW
+                )
+            except NotADirectoryError:
+                continue
+            except FileNotFoundError:
+                continue  # Removed in the meantime
+            except OSError as error:
+                # Usually fs.inotify.max_user_watches being too low, the periodic rescan still catches the change
+                print(f"Can't watch {directory}: {error.strerror}")
+                continue
+            self.tree_watches.setdefault(wd, (directory, set()))[1].add(tracked)
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+            except OSError:
+                pass
+
+    def handle_events(self, events):
+        """Record which tracked paths the events touched. Return True if any did."""
+        touched = False
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, fall back to syncing everything
+                self.full_sync_needed = True
+                continue
+            if mask & IN_IGNORED:
+                self.tree_watches.pop(wd, None)
+                self.parent_watches.pop(wd, None)
+                continue
+            # The same directory can be both inside a tracked tree and the parent of another tracked path
+            if wd in self.tree_watches:
+                directory, tracked_paths = self.tree_watches[wd]
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    for tracked in tracked_paths:
+                        self._watch_tree(os.path.join(directory, name), tracked)
+                self.pending.update(tracked_paths)
+                touched = True
+            if name in self.parent_watches.get(wd, {}):
+                tracked = self.parent_watches[wd][name]
+                if tracked is None:
+                    # tracked.txt was edited, new paths are synced in full by the next iteration
+                    self.reload()
+                    self.full_sync_needed = True
+                    continue
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(tracked, tracked)
+                self.pending.add(tracked)
+                touched = True
+        return touched
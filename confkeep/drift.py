@@ -0,0 +1,112 @@
+"""Which hosts differ from the rest of the fleet for a file or directory, used by the drift command.
+
+The object id of the path on every host branch is read with a single `git cat-file --batch-check` that only asks for
+object names, so git resolves them from the trees without reading, or in a partial clone fetching, any file. Hosts are
+grouped by object id, identical content having the same id. The largest group is the reference and only the other
+groups are diffed against it. Nothing is checked out, the working tree used by sync is left alone.
+"""
+
+import argparse
+import subprocess
+
+from confkeep.change_index import branch_tips, path_suffixes
+
+SHORT_ID = 10
+
+
+def parse_arguments(argv, prog):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description="Group the hosts by the content of a file or directory and show how the minority differs.",
+    )
+    parser.add_argument("path", help="file or directory, e.g. /etc/ssh/sshd_config")
+    parser.add_argument(
+        "--no-diff",
+        dest="diff",
+        action="store_false",
+        help="only list the groups of hosts",
+    )
+    parser.add_argument(
+        "--no-fetch",
+        dest="fetch",
+        action="store_false",
+        help="don't fetch the host branches from the remote first",
+    )
+    return parser.parse_args(argv)
+
+
+def find_versions(repo_path, tips, path):
+    """Return {host: object id of path on its branch, or None if the host doesn't have it}.
+
+    Hosts store path under the trailing part of it they track (see path_suffixes), the longest one present is used.
+    Branches without a directory of their host, like the one created by bootstrap, are left out.
+    """
+    entries = [""] + ["/" + suffix for suffix in path_suffixes(path)]
+    hosts = sorted(tips)
+    requests = "".join(
+        f"{tips[host]}:{host}{entry}\n" for host in hosts for entry in entries
+    )
+    out = subprocess.run(
+        ["git", "cat-file", "--batch-check=%(objectname)"],
+        cwd=repo_path,
+        input=requests.encode(),
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout.decode()
+    answers = iter(out.splitlines())
+    versions = {}
+    for host in hosts:
+        directory, *found = [next(answers) for _ in entries]
+        if directory.endswith(" missing"):
+            continue
+        versions[host] = next(
+            (answer for answer in found if not answer.endswith(" missing")), None
+        )
+    return versions
+
+
+def group_hosts(versions):
+    """Return ([(object id, hosts)] with the largest group first, hosts without the path)."""
+    groups = {}
+    missing = []
+    for host, version in sorted(versions.items()):
+        if version is None:
+            missing.append(host)
+        else:
+            groups.setdefault(version, []).append(host)
+    ordered = sorted(groups.items(), key=lambda group: (-len(group[1]), group[0]))
+    return ordered, missing
+
+
+def report(ckwrapper, path, own_host, show_diff):
+    """Return the drift report of path as a list of lines."""
+    tips = branch_tips(ckwrapper, own_host)
+    groups, missing = group_hosts(find_versions(ckwrapper.repo_path, tips, path))
+    if not groups:
+        return [f"No host has {path}."]
+    lines = [
+        f"{path}: {sum(len(hosts) for _, hosts in groups)} host(s), {len(groups)} version(s)"
+    ]
+    reference, reference_hosts = groups[0]
+    lines.append(
+        f"{len(reference_hosts)} host(s) have {reference[:SHORT_ID]}: {', '.join(reference_hosts)}"
+    )
+    for version, hosts in groups[1:]:
+        lines.append("")
+        lines.append(
+            f"{len(hosts)} host(s) have {version[:SHORT_ID]}: {', '.join(hosts)}"
+        )
+        if show_diff:
+            try:
+                diff = ckwrapper.git_command(
+                    "diff", "--no-color", reference, version, get_stdout=True
+                )
+                lines.append(diff.decode(errors="replace").rstrip("\n"))
+            except subprocess.CalledProcessError:
+                lines.append(
+                    "Can't be diffed, it is a file on some hosts and a directory on others."
+                )
+    if missing:
+        lines.append("")
+        lines.append(f"Not found on {len(missing)} host(s): {', '.join(missing)}")
+    return lines
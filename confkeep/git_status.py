@@ -0,0 +1,131 @@
+"""Incremental parser for `git status --porcelain=v2 -z` and the commit messages built from it."""
+
+import os
+import subprocess
+
+ADDED = "added"
+MODIFIED = "modified"
+DELETED = "deleted"
+RENAMED = "renamed"
+TYPE_CHANGED = "type changed"
+UNKNOWN = "unknown"
+CHANGES = (ADDED, MODIFIED, DELETED, RENAMED, TYPE_CHANGED, UNKNOWN)
+# Letters of `git diff --name-status --no-renames`
+NAME_STATUS = {b"A": ADDED, b"M": MODIFIED, b"D": DELETED, b"T": TYPE_CHANGED}
+
+CHUNK_SIZE = 1 << 16
+
+
+def iter_status(repo_path, *pathspecs):
+    """Yield (change, path, original path) for every entry reported by git status in repo_path.
+
+    The output is read from the pipe as it is produced, so memory use doesn't depend on the number of changes. The
+    original path is only set for renames.
+    """
+    command = ["git", "status", "--porcelain=v2", "-z"]
+    if pathspecs:
+        command += ["--"] + [str(pathspec) for pathspec in pathspecs]
+    process = subprocess.Popen(command, cwd=repo_path, stdout=subprocess.PIPE)
+    try:
+        yield from parse_status(_split_records(process.stdout))
+    finally:
+        process.stdout.close()
+        return_code = process.wait()
+    if return_code:
+        raise subprocess.CalledProcessError(return_code, command)
+
+
+def _split_records(stream):
+    remainder = b""
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+        records = (remainder + chunk).split(b"\0")
+        remainder = records.pop()
+        yield from records
+    if remainder:
+        yield remainder
+
+
+def parse_status(records):
+    """Turn NUL separated porcelain v2 records into (change, path, original path) tuples."""
+    records = iter(records)
+    for record in records:
+        kind = record[:2]
+        if kind == b"1 ":
+            fields = record.split(b" ", 8)
+            yield _classify(fields[1]), os.fsdecode(fields[8]), None
+        elif kind == b"2 ":
+            fields = record.split(b" ", 9)
+            original = os.fsdecode(next(records))
+            yield _classify(fields[1]), os.fsdecode(fields[9]), original
+        elif kind == b"u ":
+            yield UNKNOWN, os.fsdecode(record.split(b" ", 10)[10]), None
+        elif kind == b"? ":
+            yield ADDED, os.fsdecode(record[2:]), None
+        # Ignored files ("! ") and headers ("# ") aren't changes
+
+
+def _classify(xy):
+    if b"D" in xy:
+        return DELETED
+    if b"R" in xy:
+        return RENAMED
+    if b"T" in xy:
+        return TYPE_CHANGED
+    if b"A" in xy or b"C" in xy:
+        return ADDED
+    if b"M" in xy:
+        return MODIFIED
+    return UNKNOWN
+
+
+class StatusSummary:
+    """Running counters and the first few entries of a change set, enough to write its commit message."""
+
+    def __init__(self, limit=5):
+        self.limit = limit
+        self.counts = dict.fromkeys(CHANGES, 0)
+        self.total = 0
+        self.lines = []
+
+    def add(self, change, path, original=None):
+        self.counts[change] += 1
+        self.total += 1
+        if len(self.lines) >= self.limit:
+            return
+        if change == ADDED:
+            self.lines.append(f"File {path} added to the repository")
+        elif change == MODIFIED:
+            self.lines.append(f"File {path} was changed")
+        elif change == DELETED:
+            self.lines.append(f"File {path} was deleted")
+        elif change == RENAMED:
+            self.lines.append(f"File {original} was renamed to {path}")
+        elif change == TYPE_CHANGED:
+            self.lines.append(f"File {path} changed type")
+        else:
+            self.lines.append(
+                f"Something happened to {path} but conf-keep doesn't know what it was"
+            )
+
+    @property
+    def head(self):
+        kinds = [change for change in CHANGES if self.counts[change]]
+        if len(kinds) > 1:
+            return "Several files were changed added or deleted"
+        elif not kinds:
+            return None
+        return {
+            ADDED: "Some file(s) were added",
+            MODIFIED: "Some file(s) were changed",
+            DELETED: "Some file(s) were deleted",
+            RENAMED: "Some file(s) were renamed",
+            TYPE_CHANGED: "Some file(s) changed type",
+            UNKNOWN: "Some file(s) changed in an unexpected way",
+        }[kinds[0]]
+
+    @property
+    def body(self):
+        body = "".join("\n" + line for line in self.lines)
+        if self.total > self.limit:
+            body += f"\nThere are more {self.total - self.limit} changes..."
+        return body
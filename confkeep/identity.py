@@ -0,0 +1,187 @@
+"""Host identity fingerprint used to detect clones of a configured machine.
+
+The addresses of the network interfaces are read straight from the kernel through rtnetlink instead of running and
+parsing `ip a`, and reduced to a short hash that is stored in original-ip.txt.
+"""
+
+import hashlib
+import json
+import re
+import socket
+import struct
+import subprocess
+
+IP_SOURCE = "ip"
+MACHINE_ID_SOURCE = "machine-id"
+MACHINE_ID_PATH = "/etc/machine-id"
+
+NETLINK_ROUTE = 0
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+
+NLMSG_HEADER = struct.Struct("=IHHII")
+IFADDRMSG = struct.Struct("=BBBBI")
+RTATTR = struct.Struct("=HH")
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def netlink_interfaces():
+    """Return {interface name: sorted addresses with prefix length}, the same information `ip a` shows."""
+    names = dict(socket.if_nameindex())
+    interfaces = {name: [] for name in names.values()}
+    with socket.socket(
+        socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_CLOEXEC, NETLINK_ROUTE
+    ) as sock:
+        request = IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        sock.send(
+            NLMSG_HEADER.pack(
+                NLMSG_HEADER.size + len(request),
+                RTM_GETADDR,
+                NLM_F_REQUEST | NLM_F_DUMP,
+                1,
+                0,
+            )
+            + request
+        )
+        done = False
+        while not done:
+            data = sock.recv(1 << 16)
+            offset = 0
+            while offset < len(data):
+                length, kind, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+                if kind == NLMSG_DONE:
+                    done = True
+                    break
+                if kind == NLMSG_ERROR:
+                    raise OSError("rtnetlink address dump failed")
+                if kind == RTM_NEWADDR:
+                    family, prefix, address = _parse_address(
+                        data[offset + NLMSG_HEADER.size : offset + length]
+                    )
+                    name = names.get(prefix[1])
+                    if name is not None and address is not None:
+                        interfaces.setdefault(name, []).append(
+                            f"{socket.inet_ntop(family, address)}/{prefix[0]}"
+                        )
+                offset += _align(length)
+    return {name: sorted(addresses) for name, addresses in interfaces.items()}
+
+
+def _parse_address(message):
+    family, prefix_length, _, _, index = IFADDRMSG.unpack_from(message)
+    attributes = {}
+    offset = IFADDRMSG.size
+    while offset + RTATTR.size <= len(message):
+        length, kind = RTATTR.unpack_from(message, offset)
+        if length < RTATTR.size:
+            break
+        attributes[kind] = message[offset + RTATTR.size : offset + length]
+        offset += _align(length)
+    # Like ip, prefer the local address, IFA_ADDRESS is the peer on point to point links
+    address = attributes.get(IFA_LOCAL, attributes.get(IFA_ADDRESS))
+    return family, (prefix_length, index), address
+
+
+def get_ip_interfaces():
+    """Parse the output of `ip a`. Used where rtnetlink isn't available and to read fingerprints of older versions."""
+    out = subprocess.run(["ip", "a"], stdout=subprocess.PIPE, encoding="utf-8").stdout
+    interfaces = {}
+    ips = None
+    for line in out.splitlines():
+        line = line.strip()
+        match = re.match(r"\d+: (\w+): ", line)
+        if match:
+            ips = []
+            interfaces[match.group(1)] = ips
+        else:
+            if line.startswith("inet"):
+                ips.append(line.split(maxsplit=2)[1])
+    return interfaces
+
+
+def fingerprint(description):
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+class AddressMonitor:
+    """Subscription to the kernel's interface and address change notifications.
+
+    Long running processes use it to only recompute the fingerprint after the interfaces changed.
+    """
+
+    def __init__(self):
+        self.sock = socket.socket(
+            socket.AF_NETLINK,
+            socket.SOCK_RAW | socket.SOCK_CLOEXEC | socket.SOCK_NONBLOCK,
+            NETLINK_ROUTE,
+        )
+        self.sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+
+    def changed(self):
+        """Return True if any notification arrived since the last call."""
+        changed = False
+        while True:
+            try:
+                self.sock.recv(1 << 16)
+            except BlockingIOError:
+                return changed
+            except OSError:
+                return True  # Notifications were dropped (ENOBUFS), assume the worst
+            changed = True
+
+
+class HostIdentity:
+    """Computes the fingerprint of this host from its network addresses or from /etc/machine-id."""
+
+    def __init__(self, source=IP_SOURCE):
+        self.source = source
+        self._description = None
+        self._monitor = None
+
+    def description(self):
+        """Human readable data the fingerprint is computed from."""
+        if (
+            self._description is not None
+            and self._monitor
+            and not self._monitor.changed()
+        ):
+            return self._description
+        if self.source == MACHINE_ID_SOURCE:
+            with open(MACHINE_ID_PATH) as machine_id:
+                self._description = {MACHINE_ID_SOURCE: machine_id.read().strip()}
+            return self._description
+        try:
+            if self._monitor is None:
+                self._monitor = AddressMonitor()
+            self._description = netlink_interfaces()
+        except (AttributeError, OSError):
+            # No rtnetlink (not Linux or restricted sandbox)
+            self._monitor = None
+            interfaces = get_ip_interfaces()
+            self._description = {
+                name: sorted(addresses) for name, addresses in interfaces.items()
+            }
+        return self._description
+
+    def fingerprint(self):
+        return fingerprint(self.description())
+
+    @staticmethod
+    def matches_legacy(stored):
+        """Whether stored is the `ip a` json written by older versions and still matches this host."""
+        try:
+            return json.loads(stored) == get_ip_interfaces()
+        except ValueError:
+            return False
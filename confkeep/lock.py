@@ -0,0 +1,124 @@
+"""Lock that keeps conf-keep commands from running concurrently on the same local repository.
+
+The lock is a kernel flock on conf-keep.lock, so it is released as soon as its holder exits, even if it crashes or is
+killed. The file itself is never removed and only carries information about the holder for error messages.
+"""
+
+import fcntl
+import json
+import os
+import signal
+import time
+
+
+class RepositoryLock:
+    def __init__(self, path, rerun_path):
+        self.path = path
+        self.rerun_path = rerun_path
+        self.fd = None
+
+    def acquire(self, command):
+        """Try to take the lock without waiting. Return False if another process holds it."""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(
+            fd,
+            json.dumps(
+                {
+                    "pid": os.getpid(),
+                    "start_time": process_start_time(os.getpid()),
+                    "command": command,
+                    "since": time.time(),
+                }
+            ).encode(),
+        )
+        self.fd = fd
+        return True
+
+    def release(self):
+        os.ftruncate(self.fd, 0)
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def holder(self):
+        """Return the {"pid", "command", "since"} information left by the current holder, or None."""
+        try:
+            return json.loads(self.path.read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def describe_holder(self):
+        holder = self.holder()
+        if not holder:
+            return "Another command is running in this repository."
+        return (
+            f"Another command ({holder['command']}, pid {holder['pid']}) is running in this repository since "
+            f"{int(time.time() - holder['since'])} seconds."
+        )
+
+    def recover_stale(self, stale_after):
+        """Terminate a holder that has been running for longer than stale_after seconds, if it is still the process that
+        took the lock: its pid must not have been reused since, which is told by the start time of the process.
+
+        Crashed holders never need this, the kernel releases their lock. This is for runs that hang, e.g. on a network
+        filesystem or a remote that never answers.
+        """
+        holder = self.holder()
+        if not stale_after or not holder or time.time() - holder["since"] < stale_after:
+            return
+        try:
+            if "start_time" in holder:
+                if process_start_time(holder["pid"]) != holder["start_time"]:
+                    return
+            else:
+                # Written by an older version, which ran from the source tree
+                with open(f"/proc/{holder['pid']}/cmdline", "rb") as cmdline:
+                    if b"confkeep" not in cmdline.read():
+                        return
+            os.kill(holder["pid"], signal.SIGTERM)
+        except (OSError, ValueError):
+            return
+        print(f"Terminated pid {holder['pid']}, it held the lock for too long.")
+
+    def request_rerun(self):
+        self.rerun_path.parent.mkdir(parents=True, exist_ok=True)
+        self.rerun_path.touch()
+
+    def acquire_or_request_rerun(self, command):
+        """Take the lock, or else request a sync from its holder. Return True if the lock was taken.
+
+        The holder checks for requests after releasing the lock, so it may release it between a failed acquire and the
+        request, which would then never be seen. The lock is tried again after requesting: if it is free now, the
+        request is taken back and the caller runs the sync itself.
+        """
+        if self.acquire(command):
+            return True
+        self.request_rerun()
+        if not self.acquire(command):
+            return False
+        self.take_rerun_request()
+        return True
+
+    def take_rerun_request(self):
+        """Return True, and clear the request, if a sync was requested while the lock was held."""
+        try:
+            os.remove(self.rerun_path)
+            return True
+        except FileNotFoundError:
+            return False
+
+
+def process_start_time(pid):
+    """When the process started, in clock ticks since boot, or None if that isn't known (no /proc)."""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as stat:
+            # The command name, in parentheses, can hold spaces, the start time is the 20th field after it
+            return int(stat.read().rsplit(b")", 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
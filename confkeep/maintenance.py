@@ -0,0 +1,117 @@
+"""Upkeep of the local repository, which gets a new commit every minute something changes.
+
+Left alone such a repository accumulates loose objects and packs that slow down every status, add and push. This stage
+packs them incrementally, keeps a commit-graph with changed-path Bloom filters for history walks and enables the index
+features that make status cheaper. With COMPACT_HISTORY it first folds old commits, see confkeep/compaction.py. It
+is run by sync every MAINTENANCE_INTERVAL seconds, after the commit and push, and by the maintenance command. With
+SHARED_OBJECT_STORE it also fetches the store, see confkeep/object_store.py.
+"""
+
+import subprocess
+
+from confkeep import settings
+
+# Written once, the rest of the stage is incremental
+CONFIG = (
+    ("core.untrackedCache", "true"),
+    ("core.splitIndex", "true"),
+    ("index.version", "4"),
+    ("core.commitGraph", "true"),
+)
+
+
+def count_objects(ckwrapper):
+    """Return the counters of `git count-objects -v` (count, in-pack, packs, size-pack...) as integers."""
+    out = ckwrapper.git_command("count-objects", "-v", get_stdout=True).decode()
+    counters = {}
+    for line in out.splitlines():
+        name, _, value = line.partition(":")
+        try:
+            counters[name.strip()] = int(value)
+        except ValueError:
+            pass
+    return counters
+
+
+def _first_supported(ckwrapper, *commands):
+    """Run the first command this version of git accepts. Return it, or None if every one failed."""
+    for command in commands:
+        try:
+            ckwrapper.git_command(*command)
+            return command
+        except subprocess.CalledProcessError:
+            continue
+    return None
+
+
+def run_maintenance(ckwrapper, metrics):
+    """Run every step of the stage and return a line describing what was done."""
+    report = []
+    if settings.COMPACT_HISTORY:
+        with metrics.phase("maintenance_compact"):
+            compacted = ckwrapper.compact_history()
+        if compacted:
+            report.append(
+                f"history compacted from {compacted[0]} to {compacted[1]} commits"
+            )
+            metrics.count("maintenance_commits_folded", compacted[0] - compacted[1])
+    with metrics.phase("maintenance_config"):
+        for name, value in CONFIG:
+            ckwrapper.git_command("config", name, value)
+        ckwrapper.git_command("update-index", "--split-index", "--untracked-cache")
+    shared = False
+    if settings.SHARED_OBJECT_STORE:
+        from confkeep.object_store import refresh
+
+        with metrics.phase("maintenance_object_store"):
+            shared = ckwrapper.attach_object_store()
+            try:
+                # Instances sharing the store take turns, it is fetched at most once per MAINTENANCE_INTERVAL
+                if refresh(settings.SHARED_OBJECT_STORE, settings.MAINTENANCE_INTERVAL):
+                    report.append("shared object store fetched")
+            except subprocess.CalledProcessError:
+                report.append("shared object store fetch failed")
+    before = count_objects(ckwrapper)
+    with metrics.phase("maintenance_repack"):
+        if shared:
+            # Rewrites the local packs without the objects the store has by now, which the repository's own commits
+            # are once the store fetched them from the REMOTE. Local objects are few, so this stays cheap.
+            repacked = _first_supported(ckwrapper, ("repack", "-a", "-d", "-l", "-q"))
+        else:
+            # Geometric repacks (git 2.32+) merge small packs into larger ones without rewriting the big ones, older
+            # versions only pack the loose objects
+            repacked = _first_supported(
+                ckwrapper,
+                ("repack", "-d", "-l", "-q", "--geometric=2"),
+                ("repack", "-d", "-l", "-q"),
+            )
+    after = count_objects(ckwrapper)
+    packed = before.get("count", 0) - after.get("count", 0)
+    metrics.count("maintenance_objects_packed", packed)
+    metrics.count("maintenance_packs", after.get("packs", 0))
+    if repacked:
+        # This stage packs the objects instead of git gc --auto in the middle of a commit, now that it is known to work
+        ckwrapper.git_command("config", "gc.auto", "0")
+        report.append(
+            f"packed {packed} loose object(s), {after.get('packs', 0)} pack(s) of {after.get('size-pack', 0)} KiB"
+        )
+    with metrics.phase("maintenance_commit_graph"):
+        # Changed-path Bloom filters need git 2.27
+        graph = _first_supported(
+            ckwrapper,
+            ("commit-graph", "write", "--reachable", "--changed-paths", "--split"),
+            ("commit-graph", "write", "--reachable", "--split"),
+        )
+    if graph:
+        report.append(
+            "commit-graph written"
+            + (" with changed-path filters" if "--changed-paths" in graph else "")
+        )
+    failed = [
+        step
+        for step, done in (("repack", repacked), ("commit-graph", graph))
+        if not done
+    ]
+    if failed:
+        report.append(f"{' and '.join(failed)} failed")
+    return "Maintenance: " + ", ".join(report) + "."
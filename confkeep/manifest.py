@@ -0,0 +1,192 @@
+"""Persisted stat index of the tracked paths.
+
+sync compares the live tree against the index saved by the last successful run and only copies the tracked paths that
+differ, skipping rsync and git entirely when nothing does.
+"""
+
+import json
+import os
+import stat
+import time
+
+MANIFEST_VERSION = 1
+# Files modified this close to a scan may be written again without their timestamps changing, so their content is
+# hashed as well.
+RACY_WINDOW_NS = 2 * 10**9
+
+INODE, SIZE, MTIME, CTIME, DIGEST = range(5)
+
+
+def file_digest(path):
+    import hashlib  # Only needed for recently modified files, keep it out of the startup
+
+    digest = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan(root, tracked=None):
+    """Return {relative path: [inode, size, mtime_ns, ctime_ns, digest]} for root and everything under it.
+
+    The root itself is stored as ".". Missing roots produce an empty dict. Symlinks are not followed. Entries the
+    filters of tracked (a TrackedPath) exclude are left out, excluded directories aren't traversed.
+    """
+    filtered = tracked is not None and tracked.has_filters
+    entries = {}
+    try:
+        st = os.lstat(root)
+    except FileNotFoundError:
+        return entries
+    entries["."] = _entry(st)
+    if not stat.S_ISDIR(st.st_mode):
+        return entries
+    pending = [(str(root), "")]
+    while pending:
+        path, prefix = pending.pop()
+        try:
+            iterator = os.scandir(path)
+        except OSError:
+            continue  # Unreadable directories are reported by the copy phase
+        with iterator:
+            for dir_entry in iterator:
+                try:
+                    st = dir_entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                relative = prefix + dir_entry.name
+                if filtered and tracked.excludes_stat(relative, st):
+                    continue
+                entries[relative] = _entry(st)
+                if stat.S_ISDIR(st.st_mode):
+                    pending.append((dir_entry.path, relative + "/"))
+    return entries
+
+
+def _entry(st):
+    return [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns, None]
+
+
+def _is_racy(entry, scan_start_ns):
+    return entry[MTIME] >= scan_start_ns - RACY_WINDOW_NS
+
+
+def _join(root, relative):
+    return str(root) if relative == "." else os.path.join(str(root), relative)
+
+
+class StatManifest:
+    """Stat index of every tracked path, stored as json in the repository's conf-keep state directory."""
+
+    def __init__(self, path):
+        self.path = path
+        self.roots = {}
+        self.pending = None
+
+    def load(self):
+        try:
+            data = json.loads(self.path.read_text())
+        except (FileNotFoundError, ValueError):
+            return self
+        if data.get("version") == MANIFEST_VERSION:
+            self.roots = data["roots"]
+        return self
+
+    def refresh(self, roots, filters=None):
+        """Scan roots and return the ones that differ from the saved index.
+
+        filters maps roots to the TrackedPath whose filters apply to them. The fresh scan is kept aside and only
+        replaces the saved index once save is called, so a run that fails before committing is retried in full.
+        """
+        filters = filters or {}
+        self.pending = {}
+        changed = []
+        for root in roots:
+            root = str(root)
+            scan_start = time.time_ns()
+            entries = scan(root, filters.get(root))
+            for relative, entry in entries.items():
+                if _is_racy(entry, scan_start):
+                    entry[DIGEST] = self._digest(root, relative)
+            self.pending[root] = entries
+            if self._differs(root, self.roots.get(root), entries):
+                changed.append(root)
+        return changed
+
+    def _differs(self, root, old, new):
+        if old is None or old.keys() != new.keys():
+            return True
+        return any(
+            self._entry_differs(root, relative, old[relative], entry)
+            for relative, entry in new.items()
+        )
+
+    def _entry_differs(self, root, relative, previous, entry):
+        if previous[:DIGEST] != entry[:DIGEST]:
+            return True
+        if previous[DIGEST] is not None:
+            if entry[DIGEST] is None:
+                entry[DIGEST] = self._digest(root, relative)
+            return entry[DIGEST] != previous[DIGEST]
+        return False
+
+    def diff(self, root):
+        """Compare the last refresh of root with the saved index.
+
+        Return (relative paths that are new or changed, relative paths that are gone), or None if root wasn't in the
+        saved index.
+        """
+        root = str(root)
+        old = self.roots.get(root)
+        if old is None:
+            return None
+        new = self.pending[root]
+        changed = [
+            relative
+            for relative, entry in new.items()
+            if relative not in old
+            or self._entry_differs(root, relative, old[relative], entry)
+        ]
+        removed = [relative for relative in old if relative not in new]
+        return changed, removed
+
+    @staticmethod
+    def _digest(root, relative):
+        path = _join(root, relative)
+        try:
+            if not stat.S_ISREG(os.lstat(path).st_mode):
+                return None
+            return file_digest(path)
+        except OSError:
+            return ""  # Unreadable files are hashed as empty so that they become readable counts as a change
+
+    def discard(self, root, relative):
+        """Leave relative out of the last refresh of root, so that the next refresh finds it changed."""
+        self.pending[root].pop(relative, None)
+
+    def save(self, tracked=None, failed=()):
+        """Store the last refresh, forgetting about the roots that are no longer in tracked.
+
+        Roots in failed, whose copy had errors, keep their previous index so that the next refresh syncs them again.
+        """
+        if self.pending is None:
+            return
+        failed = {str(root) for root in failed}
+        self.roots.update(
+            (root, entries)
+            for root, entries in self.pending.items()
+            if root not in failed
+        )
+        self.pending = None
+        if tracked is not None:
+            tracked = {str(root) for root in tracked}
+            self.roots = {
+                root: entries for root, entries in self.roots.items() if root in tracked
+            }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_name(self.path.name + ".tmp")
+        temporary.write_text(
+            json.dumps({"version": MANIFEST_VERSION, "roots": self.roots})
+        )
+        os.replace(temporary, self.path)
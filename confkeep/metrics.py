@@ -0,0 +1,112 @@
+"""Timings and counters of a sync run.
+
+Every run prints a one line summary. The full data can also be appended as json lines to METRICS_LOG and written as a
+Prometheus textfile (for node_exporter's textfile collector) to METRICS_TEXTFILE.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class SyncMetrics:
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.paths = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the time spent inside the with block to the phase name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add(self.phases, name, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def path(self, name):
+        """Like phase, for the copy of a tracked path."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add(self.paths, name, time.perf_counter() - start)
+
+    def count(self, name, value=1):
+        self._add(self.counters, name, value)
+
+    def _add(self, values, name, value):
+        with self._lock:
+            values[name] = values.get(name, 0) + value
+
+    def as_dict(self, success):
+        return {
+            "time": self.started,
+            "duration": time.time() - self.started,
+            "success": success,
+            "phases": self.phases,
+            "paths": self.paths,
+            "counters": self.counters,
+        }
+
+    def summary(self):
+        phases = ", ".join(
+            f"{name} {seconds:.3f}s" for name, seconds in self.phases.items()
+        )
+        counters = ", ".join(f"{name} {value}" for name, value in self.counters.items())
+        return f"Sync took {time.time() - self.started:.3f}s ({phases}) {counters}".rstrip()
+
+    def write(self, success, log_path=None, textfile_path=None):
+        data = self.as_dict(success)
+        if log_path:
+            with open(log_path, "a") as log:
+                log.write(json.dumps(data) + "\n")
+        if textfile_path:
+            # node_exporter may read the file at any moment, replace it atomically
+            temporary = f"{textfile_path}.{os.getpid()}.tmp"
+            with open(temporary, "w") as textfile:
+                textfile.write(prometheus_text(data))
+            os.replace(temporary, textfile_path)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text(data):
+    lines = [
+        "# HELP conf_keep_sync_last_run_timestamp_seconds When the last sync started.",
+        "# TYPE conf_keep_sync_last_run_timestamp_seconds gauge",
+        f"conf_keep_sync_last_run_timestamp_seconds {data['time']}",
+        "# HELP conf_keep_sync_duration_seconds How long the last sync took.",
+        "# TYPE conf_keep_sync_duration_seconds gauge",
+        f"conf_keep_sync_duration_seconds {data['duration']}",
+        "# HELP conf_keep_sync_success Whether the last sync succeeded.",
+        "# TYPE conf_keep_sync_success gauge",
+        f"conf_keep_sync_success {int(data['success'])}",
+        "# HELP conf_keep_sync_phase_seconds Time spent in each phase of the last sync.",
+        "# TYPE conf_keep_sync_phase_seconds gauge",
+    ]
+    lines += [
+        f'conf_keep_sync_phase_seconds{{phase="{_escape(name)}"}} {seconds}'
+        for name, seconds in data["phases"].items()
+    ]
+    lines += [
+        "# HELP conf_keep_sync_path_seconds Time spent copying each tracked path in the last sync.",
+        "# TYPE conf_keep_sync_path_seconds gauge",
+    ]
+    lines += [
+        f'conf_keep_sync_path_seconds{{path="{_escape(name)}"}} {seconds}'
+        for name, seconds in data["paths"].items()
+    ]
+    for name, value in data["counters"].items():
+        lines += [
+            f"# TYPE conf_keep_sync_{name} gauge",
+            f"conf_keep_sync_{name} {value}",
+        ]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,64 @@
+"""Object store shared by the repositories of several conf-keep instances on one machine, see SHARED_OBJECT_STORE.
+
+The store is a bare repository fetching every branch of the REMOTE. Each local repository lists the store's objects
+directory in .git/objects/info/alternates, so git reads the objects found there instead of fetching and keeping its
+own copy: the history of the fleet is downloaded and stored once per machine instead of once per instance. Commits made
+by an instance are still written to its own repository, the store gets them from the REMOTE.
+
+A repository whose objects are borrowed breaks if they disappear from the store, so the store is never cleaned up:
+gc.auto is disabled, gc.pruneExpire is set to never in case someone runs git gc there and fetches never delete
+branches. Commits replaced by a compacted history (see confkeep/compaction.py) are kept in it for the same reason. The
+maintenance stage of each instance repacks with -l, which leaves out of its packs the objects the store has.
+"""
+
+import os
+import subprocess
+import time
+
+CONFIG = (
+    ("gc.auto", "0"),
+    ("gc.pruneExpire", "never"),
+    ("fetch.prune", "false"),
+    ("remote.origin.fetch", "+refs/heads/*:refs/heads/*"),
+)
+
+
+def _git(store, *args):
+    subprocess.run(["git", *args], cwd=store, check=True, stdout=subprocess.DEVNULL)
+
+
+def init_store(store, remote_url):
+    """Create the store if it doesn't exist yet and make it fetch from remote_url."""
+    store.mkdir(parents=True, exist_ok=True)
+    # Reinitializing an existing repository leaves its objects and refs alone
+    _git(store, "init", "-q", "--bare")
+    _git(store, "config", "remote.origin.url", str(remote_url))
+    for name, value in CONFIG:
+        _git(store, "config", name, value)
+
+
+def refresh(store, min_age=0):
+    """Fetch the REMOTE into the store unless it was fetched less than min_age seconds ago. Return whether it was."""
+    try:
+        if time.time() - (store / "FETCH_HEAD").stat().st_mtime < min_age:
+            return False
+    except FileNotFoundError:
+        pass
+    _git(store, "fetch", "-q", "origin")
+    return True
+
+
+def attach(repo_path, store):
+    """Add the store's objects to the alternates of the repository at repo_path. Return False if they already were."""
+    alternates = repo_path / ".git" / "objects" / "info" / "alternates"
+    objects = os.path.realpath(store / "objects")
+    try:
+        listed = alternates.read_text().splitlines()
+    except FileNotFoundError:
+        listed = []
+    if any(os.path.realpath(line) == objects for line in listed if line.strip()):
+        return False
+    alternates.parent.mkdir(parents=True, exist_ok=True)
+    with alternates.open("a") as file:
+        file.write(objects + "\n")
+    return True
@@ -0,0 +1,99 @@
+"""Concurrent copy stage of sync, used instead of the sequential one when SYNC_PIPELINE is set.
+
+The sequential sync checks the host's identity, then copies every tracked path, then asks git status what changed and
+adds it. With the pipeline the identity check started by with_test_repo runs in the background while the paths are
+copied, and every path is staged with git add as soon as its copy is done, while the others are still being copied.
+git add runs one path at a time since git locks the index. The status and commit that follow are the same as in the
+sequential sync, they only find the paths already staged, and nothing is committed before the identity check passed.
+
+If a copy, a git add or the identity check fails, or everything takes more than SYNC_TIMEOUT seconds, the copies that
+haven't started are cancelled, the git add in progress is terminated and the error is raised once the copies already
+running are done, threads can't be interrupted. rsync calls are killed after SYNC_TIMEOUT seconds themselves.
+"""
+
+import asyncio
+import concurrent.futures
+import subprocess
+
+from confkeep import settings
+from confkeep.sync import _sync_group, copy_engine, copy_groups
+from confkeep.util import ConfKeepError
+
+# Marks the end of the paths to stage
+DONE = None
+
+
+def copy_and_stage(ckwrapper, paths):
+    """Copy the tracked paths into the host's directory and stage them, see the module's documentation. Return the
+    paths whose copy had errors that were ignored, like sync_paths."""
+    return asyncio.run(_copy_and_stage(ckwrapper, paths))
+
+
+async def _copy_and_stage(ckwrapper, paths):
+    loop = asyncio.get_event_loop()
+    work_path = ckwrapper.work_path
+    copy = copy_engine()
+    groups, concurrency = copy_groups(paths, work_path)
+    to_stage = asyncio.Queue()
+    executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+
+    failed = []
+
+    async def copy_group(group):
+        failed.extend(
+            await loop.run_in_executor(
+                executor, _sync_group, copy, group, work_path, ckwrapper.metrics
+            )
+        )
+        for tracked in group:
+            await to_stage.put(tracked.path.name)
+
+    async def copy_all(copies):
+        await asyncio.gather(*copies)
+        await to_stage.put(DONE)
+
+    async def stage():
+        while True:
+            name = await to_stage.get()
+            if name is DONE:
+                return
+            # Copies of paths that disappeared are removed from the index by the add that follows the status
+            if (work_path / name).exists():
+                await git_add(ckwrapper.repo_path, f"{work_path.name}/{name}")
+
+    copies = [asyncio.ensure_future(copy_group(group)) for group in groups]
+    tasks = [
+        asyncio.ensure_future(copy_all(copies)),
+        asyncio.ensure_future(stage()),
+        loop.run_in_executor(None, ckwrapper.await_identity),
+    ]
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*tasks), timeout=settings.SYNC_TIMEOUT or None
+        )
+        return failed
+    except BaseException as error:
+        for task in copies + tasks:
+            task.cancel()
+        await asyncio.gather(*copies, *tasks, return_exceptions=True)
+        if isinstance(error, asyncio.TimeoutError):
+            raise ConfKeepError(
+                f"Copying and staging the tracked paths took more than {int(settings.SYNC_TIMEOUT)} seconds."
+            )
+        raise
+    finally:
+        executor.shutdown(wait=True)
+
+
+async def git_add(repo_path, pathspec):
+    command = ["git", "add", "--all", "--", pathspec]
+    process = await asyncio.create_subprocess_exec(*command, cwd=repo_path)
+    try:
+        return_code = await process.wait()
+    except asyncio.CancelledError:
+        # Not killed, git removes its index.lock when terminated
+        process.terminate()
+        await process.wait()
+        raise
+    if return_code:
+        raise subprocess.CalledProcessError(return_code, command)
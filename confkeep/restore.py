@@ -0,0 +1,240 @@
+"""Bring a tracked path back as it was at a given commit or time, used by the restore command.
+
+The subtree is streamed out of git with `git archive` and extracted member by member, so nothing is checked out and
+large files are copied in chunks instead of being loaded in memory. Every file and symlink is written to a temporary
+name next to its target and renamed over it: readers never see a partial file and existing symlinks are replaced
+instead of being written through. git only records whether files are executable, so files that already exist keep
+their mode and owner and new ones get 644 or 755. Files that exist now but didn't at that commit are left in place,
+unless --delete is given. Files left out by the filters of the tracked path are never deleted, they weren't recorded.
+"""
+
+import argparse
+import datetime
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+
+from confkeep.tracked import TrackedPath
+from confkeep.util import ConfKeepError
+
+CHUNK_SIZE = 1 << 20
+SHORT_ID = 10
+
+
+def parse_arguments(argv, prog):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description="Restore a tracked file or directory as it was at a commit or time.",
+    )
+    parser.add_argument(
+        "path", help="tracked path, or a path under a tracked directory"
+    )
+    parser.add_argument(
+        "--host", help="host whose copy is restored, this one by default"
+    )
+    when = parser.add_mutually_exclusive_group()
+    when.add_argument(
+        "--at",
+        help="last version before this date or duration ago, e.g. 2h or 2026-01-31",
+    )
+    when.add_argument("--commit", help="version of this commit of the host branch")
+    parser.add_argument(
+        "--to",
+        help="directory to restore into instead of the original location",
+    )
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="also delete the files that didn't exist at that commit",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only show the differences between the path now and the version that would be restored",
+    )
+    parser.add_argument(
+        "--no-fetch",
+        dest="fetch",
+        action="store_false",
+        help="don't fetch the host branch from the remote first",
+    )
+    return parser.parse_args(argv)
+
+
+def resolve_commit(ckwrapper, tip, before=None, commit=None):
+    """The commit to restore from: commit, the last one of the branch at tip before the timestamp before, or tip."""
+    if commit:
+        revision = f"{commit}^{{commit}}"
+    elif before is not None:
+        revision = (
+            ckwrapper.git_command(
+                "rev-list",
+                "-1",
+                "--first-parent",
+                f"--before=@{int(before)}",
+                tip,
+                "--",
+                get_stdout=True,
+            )
+            .decode()
+            .strip()
+        )
+        if not revision:
+            raise ConfKeepError("The host has no commit that old.")
+    else:
+        revision = tip
+    try:
+        return (
+            ckwrapper.git_command(
+                "rev-parse", "--verify", "-q", revision, get_stdout=True
+            )
+            .decode()
+            .strip()
+        )
+    except subprocess.CalledProcessError:
+        raise ConfKeepError(f"Unknown commit {commit}.")
+
+
+def find_source(ckwrapper, commit, host, path):
+    """Return where path is stored in the tree of commit, according to the host's tracked.txt at that commit, the
+    TrackedPath it is under and its path relative to it."""
+    try:
+        tracked_txt = ckwrapper.git_command(
+            "show", f"{commit}:{host}/tracked.txt", get_stdout=True
+        ).decode()
+    except subprocess.CalledProcessError:
+        raise ConfKeepError(f"{host} has no tracked.txt at {commit[:SHORT_ID]}.")
+    path = os.path.normpath(path)
+    for line in tracked_txt.splitlines():
+        if not line:
+            continue
+        entry = TrackedPath.parse(line)
+        tracked = str(entry.path)
+        if path == tracked or path.startswith(tracked.rstrip("/") + "/"):
+            relative = os.path.relpath(path, tracked)
+            source = f"{host}/{os.path.basename(tracked)}"
+            if relative != ".":
+                source = f"{source}/{relative}"
+            return source, entry, relative
+    raise ConfKeepError(f"{path} wasn't tracked by {host} at {commit[:SHORT_ID]}.")
+
+
+def extract(repo_path, commit, source, destination, written=None):
+    """Write source (a path in the tree of commit) to destination. Return the number of files and symlinks written.
+    The paths written, directories included, are added relative to destination to the set written if given.
+    """
+    command = ["git", "-c", "tar.umask=0022", "archive", "--format=tar", commit]
+    command += ["--", source]
+    process = subprocess.Popen(command, cwd=repo_path, stdout=subprocess.PIPE)
+    count = 0
+    written = set() if written is None else written
+    try:
+        with tarfile.open(fileobj=process.stdout, mode="r|") as archive:
+            for member in archive:
+                if member.name == source:
+                    target = destination
+                elif member.name.startswith(source + "/"):
+                    relative = member.name[len(source) + 1 :]
+                    if relative.startswith("/") or ".." in relative.split("/"):
+                        raise ConfKeepError(
+                            f"Unsafe path {member.name} in the archive."
+                        )
+                    target = os.path.join(destination, relative)
+                else:
+                    continue  # Directories above source
+                if member.isdir():
+                    _make_directory(target)
+                    written.add(os.path.relpath(target, destination))
+                elif member.isfile() or member.issym():
+                    _write_member(archive, member, target)
+                    written.add(os.path.relpath(target, destination))
+                    count += 1
+    except tarfile.ReadError:
+        pass  # git failed before writing anything, reported below
+    finally:
+        process.stdout.close()
+        return_code = process.wait()
+    if return_code:
+        raise ConfKeepError(f"Could not read {source} from {commit[:SHORT_ID]}.")
+    return count
+
+
+def delete_extra(destination, written, tracked, relative, dry_run=False):
+    """Delete what is under the directory destination but isn't in written (paths relative to it), except what the
+    filters of tracked leave out. relative is where destination is under the tracked path. Return the paths deleted, or
+    that would be.
+    """
+    deleted = []
+    for directory, directories, files in os.walk(destination):
+        for names, is_dir in ((directories, True), (files, False)):
+            for name in list(names):
+                path = os.path.join(directory, name)
+                path_relative = os.path.relpath(path, destination)
+                if path_relative in written:
+                    continue
+                if is_dir:
+                    names.remove(name)  # Not walked into
+                entry_relative = os.path.normpath(os.path.join(relative, path_relative))
+                if tracked.has_filters and tracked.excludes_stat(
+                    entry_relative, os.lstat(path)
+                ):
+                    continue
+                deleted.append(path)
+                if dry_run:
+                    continue
+                if is_dir and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+    return deleted
+
+
+def _make_directory(target):
+    try:
+        if not stat.S_ISDIR(os.lstat(target).st_mode):
+            os.remove(target)
+    except FileNotFoundError:
+        pass
+    os.makedirs(target, exist_ok=True)
+
+
+def _write_member(archive, member, target):
+    directory, name = os.path.split(target)
+    os.makedirs(directory, exist_ok=True)
+    try:
+        current = os.lstat(target)
+    except FileNotFoundError:
+        current = None
+    temporary = os.path.join(directory, f".{name}.conf-keep-restore~")
+    if os.path.lexists(temporary):
+        os.remove(temporary)
+    if member.issym():
+        os.symlink(member.linkname, temporary)
+    else:
+        with archive.extractfile(member) as contents, open(temporary, "wb") as file:
+            shutil.copyfileobj(contents, file, CHUNK_SIZE)
+        if current and stat.S_ISREG(current.st_mode):
+            mode = stat.S_IMODE(current.st_mode)
+            # git only recorded whether the file was executable
+            if member.mode & 0o100:
+                mode |= (mode & 0o444) >> 2
+            else:
+                mode &= ~0o111
+            os.chmod(temporary, mode)
+            if os.geteuid() == 0:
+                os.chown(temporary, current.st_uid, current.st_gid)
+        else:
+            os.chmod(temporary, member.mode & 0o777)
+    if current and stat.S_ISDIR(current.st_mode):
+        shutil.rmtree(target)
+    os.replace(temporary, target)
+
+
+def describe(ckwrapper, commit):
+    timestamp = int(
+        ckwrapper.git_command("show", "-s", "--format=%ct", commit, get_stdout=True)
+    )
+    when = datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+    return f"{commit[:SHORT_ID]} ({when})"
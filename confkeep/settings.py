@@ -1,6 +1,5 @@
 import os
 import pathlib
-import platform
 from confkeep.util import get_path_environ
 from os import environ
 
@@ -13,13 +12,21 @@ from os import environ
 
 # Trying to guess the hostname correctly is extremely important for conf-keep as it avoid multiple hosts mixing their
 # histories.
-HOST_NAME = environ.get("HOST_NAME", platform.node())
+HOST_NAME = environ.get("HOST_NAME", os.uname().nodename)
 # You must set this one if you want to configure conf-keep non-interactively.
 ASSUME_YES = environ.get("ASSUME_YES", False)
 # Conserviative version of the above variable. Mostly used for debugging.
 ASSUME_NO = environ.get("ASSUME_YES", False)
 # By default conf-keep runs every minute. Change this to however you like.
 CRON_SCHEDULE = environ.get("CRON_SCHEDULE", "* * * * *")
+# install-cron delays each run of the sync by up to CRON_SPREAD seconds, an offset derived from the host name, so that
+# hosts sharing a schedule don't all push to the REMOTE at the same second. 0 disables it.
+CRON_SPREAD = int(environ.get("CRON_SPREAD", 50))
+# If set the sync run by cron backs off on hosts where nothing changes: every sync that finds no change doubles the time
+# until the next one, up to ADAPTIVE_MAX_INTERVAL seconds, and finding a change goes back to syncing on every run.
+# Changes are then committed at most ADAPTIVE_MAX_INTERVAL seconds (plus the cron period) after they are made.
+ADAPTIVE_SYNC = environ.get("ADAPTIVE_SYNC", False)
+ADAPTIVE_MAX_INTERVAL = float(environ.get("ADAPTIVE_MAX_INTERVAL", 900))
 # This is the user that will run the sync under cron.
 CK_USER = environ.get("CONFKEEP_USER", "conf-keep")
 # If set rsync will ignore errors. Useful for testing or when you only want to commit "world-readable" files
@@ -31,6 +38,91 @@ IGNORE_SYNC_ERRORS = environ.get("IGNORE_SYNC_ERRORS", False)
 # Setting this variable to True disables that checking. That's useful for machines that don't have fixed ips like, one
 # that uses DNS or wifi.
 IGNORE_IP_CHANGES = environ.get("IGNORE_IP_CHANGES", False)
+# What the clone check fingerprints. "ip" uses the addresses of the network interfaces, read from the kernel. Hosts that
+# change addresses but have a stable /etc/machine-id (systemd) can use "machine-id" instead.
+IDENTITY_SOURCE = environ.get("IDENTITY_SOURCE", "ip")
+# sync keeps a stat index (inode, size and timestamps) of every tracked file and does nothing when none of them
+# changed. Set this to always copy everything and ask git for the changes, like older versions did.
+DISABLE_MANIFEST = environ.get("DISABLE_MANIFEST", False)
+# How many tracked paths are copied at the same time. Raise it on hosts with many independent tracked paths.
+SYNC_CONCURRENCY = int(environ.get("SYNC_CONCURRENCY", 1))
+# If set all tracked paths (or all paths of each worker, see SYNC_CONCURRENCY) are copied by a single rsync call
+# instead of one call per path.
+SYNC_BATCH = environ.get("SYNC_BATCH", False)
+# If set sync copies the tracked paths while checking the host's identity and stages every path with git add as soon as
+# its copy is done, instead of doing one step after the other, see confkeep/pipeline.py. The daemon command also pushes
+# in the background while it waits for the next change. Only the copies of SNAPSHOT_MODE "mirror" are pipelined.
+SYNC_PIPELINE = environ.get("SYNC_PIPELINE", False)
+# A sync whose copies (and with SYNC_PIPELINE the staging of them) take longer than SYNC_TIMEOUT seconds is stopped and
+# fails, instead of holding the repository lock until LOCK_STALE_AFTER. rsync calls are killed, copies of the builtin
+# engine can't be interrupted and only stop the sync once they return. 0 disables it.
+SYNC_TIMEOUT = float(environ.get("SYNC_TIMEOUT", 1800))
+# Which program copies the tracked paths. "rsync" calls the rsync binary, "builtin" does the copy inside conf-keep, only
+# copying files whose size or modification time changed and using reflinks or in-kernel copies when available. Use
+# "builtin" on hosts without rsync.
+SYNC_ENGINE = environ.get("SYNC_ENGINE", "rsync")
+# A command that has been holding the repository lock for more than LOCK_STALE_AFTER seconds is considered hung and is
+# terminated by the next command that needs the lock. 0 disables this.
+LOCK_STALE_AFTER = float(environ.get("LOCK_STALE_AFTER", 3600))
+# sync prints how long each of its phases took. Set these to also append the timings and counters of every run as json
+# lines to METRICS_LOG and/or write them as a Prometheus textfile to METRICS_TEXTFILE, e.g.
+# /var/lib/prometheus/node-exporter/conf-keep.prom for node_exporter's textfile collector.
+METRICS_LOG = get_path_environ("METRICS_LOG", None)
+METRICS_TEXTFILE = get_path_environ("METRICS_TEXTFILE", None)
+# Set this to a file path to profile a sync run with cProfile and write the stats there. Inspect them with
+# python -m pstats <file>.
+PROFILE_PATH = get_path_environ("CONFKEEP_PROFILE", None)
+# How sync records the tracked paths. "mirror" copies them into the host's directory of the local repository and commits
+# the copy. "direct" writes the changed files straight from their original location into git's object store and builds
+# the commit from there, without a second copy on disk. In direct mode the host's directory only holds tracked.txt, so
+# `git status` in the local repository shows the snapshot files as deleted. That is expected.
+SNAPSHOT_MODE = environ.get("SNAPSHOT_MODE", "mirror")
+# The daemon command waits until tracked paths have been quiet for DAEMON_DEBOUNCE seconds before syncing them, but
+# never delays a sync for longer than DAEMON_MAX_DELAY seconds. Every DAEMON_RESCAN_INTERVAL seconds it syncs every
+# tracked path, in case an event was missed.
+DAEMON_DEBOUNCE = float(environ.get("DAEMON_DEBOUNCE", 2))
+DAEMON_MAX_DELAY = float(environ.get("DAEMON_MAX_DELAY", 30))
+DAEMON_RESCAN_INTERVAL = float(environ.get("DAEMON_RESCAN_INTERVAL", 3600))
+# sync commits locally every time something changes but pushes to the REMOTE at most once every PUSH_INTERVAL seconds.
+# Failed pushes don't fail the sync, they are retried after PUSH_RETRY_DELAY seconds, doubling the delay after each
+# failure up to PUSH_RETRY_MAX seconds. Pushes taking longer than PUSH_TIMEOUT seconds are aborted.
+PUSH_INTERVAL = float(environ.get("PUSH_INTERVAL", 0))
+PUSH_RETRY_DELAY = float(environ.get("PUSH_RETRY_DELAY", 60))
+PUSH_RETRY_MAX = float(environ.get("PUSH_RETRY_MAX", 3600))
+PUSH_TIMEOUT = float(environ.get("PUSH_TIMEOUT", 300))
+# If set sync packs the objects of the local repository, updates its commit-graph and enables git's index caches once
+# every MAINTENANCE_INTERVAL seconds (e.g. 86400), after committing and pushing. Once it has packed the repository the
+# stage turns off git gc --auto there, run `git config --unset gc.auto` in it if you disable the stage afterwards.
+MAINTENANCE_INTERVAL = float(environ.get("MAINTENANCE_INTERVAL", 0))
+# If set the maintenance stage also rewrites the history of the host branch: commits older than COMPACT_FULL_DAYS days
+# are folded into one commit per hour, and those older than COMPACT_HOURLY_DAYS days into one commit per day. The next
+# push replaces the remote branch (only if nobody else changed it), so other clones of the host branch must be reset to
+# it afterwards.
+COMPACT_HISTORY = environ.get("COMPACT_HISTORY", False)
+COMPACT_FULL_DAYS = float(environ.get("COMPACT_FULL_DAYS", 7))
+COMPACT_HOURLY_DAYS = float(environ.get("COMPACT_HOURLY_DAYS", 30))
+# add-host clones the REMOTE without file contents (fetched on demand), only fetches the host branch and only checks out
+# the host's directory. Set this to clone every branch with its full history instead, e.g. if the remote doesn't allow
+# partial clones.
+FULL_CLONE = environ.get("FULL_CLONE", False)
+# Set this to the path of a bare repository (created if needed) to share objects between several conf-keep instances on
+# the same machine, e.g. one per container. bootstrap and add-host make the local repository borrow the objects of this
+# store instead of fetching and keeping its own copy, and the maintenance stage fetches the REMOTE into it. See
+# confkeep/object_store.py: never delete the store or prune it while repositories use it.
+SHARED_OBJECT_STORE = get_path_environ("SHARED_OBJECT_STORE", None)
+# The collect command fetches the tracked paths of the hosts listed in the COLLECT_INVENTORY file (see
+# confkeep/collect.py) with the COLLECT_TRANSPORT: "ssh" runs rsync over COLLECT_SSH_COMMAND, "local" copies them from
+# local directories holding each host's root filesystem. COLLECT_CONCURRENCY hosts are collected at the same time and
+# a host taking longer than COLLECT_TIMEOUT seconds is reported as failed.
+COLLECT_INVENTORY = get_path_environ("COLLECT_INVENTORY", None)
+COLLECT_TRANSPORT = environ.get("COLLECT_TRANSPORT", "ssh")
+COLLECT_SSH_COMMAND = environ.get(
+    "COLLECT_SSH_COMMAND", "ssh -o BatchMode=yes -o ConnectTimeout=10"
+)
+COLLECT_CONCURRENCY = int(environ.get("COLLECT_CONCURRENCY", 32))
+COLLECT_TIMEOUT = float(environ.get("COLLECT_TIMEOUT", 300))
+# If set install-cron installs a systemd unit that runs the daemon command instead of the cron job.
+INSTALL_SYSTEMD = environ.get("INSTALL_SYSTEMD", False)
 
 # * Settings without sane defaults
 # These must be changed either interactively or through environment variables.
@@ -41,3 +133,12 @@ REPO_PATH = get_path_environ("REPO_PATH", None)
 REMOTE = os.environ.get("REMOTE", None)
 # The local file/directory that you want to track
 MONITORED_PATH = get_path_environ("MONITORED_PATH", None)
+# Space separated glob patterns of what to leave out of MONITORED_PATH (e.g. "*.swp *.log.* cache/") and of exceptions
+# to them, and the size (in bytes or with a K, M or G suffix) over which files are left out. They are stored with the
+# path by the watch command, see confkeep/tracked.py for the pattern rules.
+MONITORED_EXCLUDE = environ.get("MONITORED_EXCLUDE", "").split()
+MONITORED_INCLUDE = environ.get("MONITORED_INCLUDE", "").split()
+MONITORED_MAX_SIZE = environ.get("MONITORED_MAX_SIZE", None)
+# How often MONITORED_PATH is synced, in seconds or with an m, h or d suffix (e.g. "1h" for a bulky tree that rarely
+# changes). By default it is synced on every run of sync.
+MONITORED_INTERVAL = environ.get("MONITORED_INTERVAL", None)
@@ -0,0 +1,196 @@
+"""Direct snapshot mode: commit tracked paths straight from their original location.
+
+Instead of copying the tracked paths into the repository and letting `git add` hash the copies, the files that changed
+since the last run are written into git's object store with one long running `git hash-object --stdin-paths` and the
+commit is built by `git fast-import`. There is no second copy of the tracked files on disk.
+"""
+
+import os
+import stat
+import subprocess
+
+from confkeep.git_status import ADDED, DELETED, MODIFIED, StatusSummary
+from confkeep.util import ConfKeepError
+
+MIRROR_MODE = "mirror"
+DIRECT_MODE = "direct"
+# Temporary ref fast-import writes to, so that commits without changes can be dropped
+SNAPSHOT_REF = "refs/conf-keep/snapshot"
+SYMLINK_MODE = "120000"
+
+
+def quote_path(path):
+    """Quote path the way fast-import expects when it contains characters with a special meaning."""
+    if not any(character in path for character in '"\\\n') and path[:1] != '"':
+        return path
+    escaped = path.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{escaped}"'
+
+
+class ObjectWriter:
+    """Writes files into the object store through a single `git hash-object -w --stdin-paths` process.
+
+    The files are stored as blobs unless another object_type is given.
+    """
+
+    def __init__(self, repo_path, object_type="blob"):
+        self.repo_path = repo_path
+        self.command = ["git", "hash-object", "-w", "-t", object_type, "--no-filters"]
+        self.process = subprocess.Popen(
+            self.command + ["--stdin-paths"],
+            cwd=repo_path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def write(self, path):
+        if "\n" in path:
+            # Can't be passed through --stdin-paths
+            return self._write_single(path)
+        self.process.stdin.write(os.fsencode(path) + b"\n")
+        self.process.stdin.flush()
+        object_id = self.process.stdout.readline().strip()
+        if not object_id:
+            raise ConfKeepError(f"git hash-object failed on {path}")
+        return object_id.decode()
+
+    def _write_single(self, path):
+        return (
+            subprocess.run(
+                self.command + ["--", path],
+                cwd=self.repo_path,
+                stdout=subprocess.PIPE,
+                check=True,
+            )
+            .stdout.strip()
+            .decode()
+        )
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def snapshot_changes(host, manifest, roots, ignore_errors):
+    """Yield (change, repository path, mode, object source) for every change under roots since the last saved index.
+
+    The object source is the file to hash for regular files and the target of symlinks. Roots the manifest didn't know
+    about are replaced as a whole, which starts with a delete of their directory whose change is None.
+    """
+    for root in roots:
+        prefix = f"{host}/{os.path.basename(root)}"
+        old = manifest.roots.get(root, {})
+        diff = manifest.diff(root)
+        if diff is None:
+            yield None, prefix, None, None
+            changed, removed = list(manifest.pending[root]), []
+        else:
+            changed, removed = diff
+        for relative in removed:
+            yield DELETED, _repository_path(prefix, relative), None, None
+        for relative in changed:
+            path = _repository_path(prefix, relative)
+            change = MODIFIED if relative in old else ADDED
+            source = root if relative == "." else os.path.join(root, relative)
+            try:
+                mode = os.lstat(source).st_mode
+                if stat.S_ISLNK(mode):
+                    yield change, path, SYMLINK_MODE, os.readlink(source)
+                elif stat.S_ISREG(mode):
+                    with open(source, "rb"):
+                        pass  # Fail here rather than inside hash-object
+                    git_mode = "100755" if mode & stat.S_IXUSR else "100644"
+                    yield change, path, git_mode, source
+                # Directories are implied by their contents, other file types can't be stored in git
+            except FileNotFoundError:
+                yield DELETED, path, None, None
+            except OSError as error:
+                print(f"Failed to read {source}: {error.strerror}")
+                if not ignore_errors:
+                    raise ConfKeepError(f"Could not read {source}.")
+                # Not committed, it has to be read again by the next run
+                manifest.discard(root, relative)
+
+
+def _repository_path(prefix, relative):
+    return prefix if relative == "." else f"{prefix}/{relative}"
+
+
+def commit_snapshot(ckwrapper, manifest, roots, ignore_errors):
+    """Commit the changes of roots to the host branch without touching the working tree.
+
+    Return the StatusSummary of the commit, whose total is 0 if nothing changed.
+    """
+    branch = ckwrapper.hostname
+    summary = StatusSummary()
+    operations = []
+    writer = ObjectWriter(ckwrapper.repo_path)
+    try:
+        for change, path, mode, source in snapshot_changes(
+            branch, manifest, [str(root) for root in roots], ignore_errors
+        ):
+            if change is not None:
+                summary.add(change, path)
+            if mode is None:
+                operations.append(f"D {quote_path(path)}\n".encode())
+            elif mode == SYMLINK_MODE:
+                target = os.fsencode(source)
+                operations.append(
+                    f"M {mode} inline {quote_path(path)}\ndata {len(target)}\n".encode()
+                    + target
+                    + b"\n"
+                )
+            else:
+                object_id = writer.write(source)
+                operations.append(f"M {mode} {object_id} {quote_path(path)}\n".encode())
+    finally:
+        writer.close()
+    if not summary.total:
+        return summary
+    parent = (
+        ckwrapper.git_command(
+            "rev-parse", "--verify", f"refs/heads/{branch}", get_stdout=True
+        )
+        .decode()
+        .strip()
+    )
+    committer = ckwrapper.git_command(
+        "var", "GIT_COMMITTER_IDENT", get_stdout=True
+    ).strip()
+    message = f"{summary.head}\n{summary.body}\n".encode()
+    stream = b"".join(
+        [
+            f"commit {SNAPSHOT_REF}\n".encode(),
+            b"committer " + committer + b"\n",
+            f"data {len(message)}\n".encode() + message,
+            f"from {parent}\n".encode(),
+        ]
+        + operations
+        + [b"\ndone\n"]
+    )
+    subprocess.run(
+        ["git", "fast-import", "--quiet", "--done", "--force"],
+        cwd=ckwrapper.repo_path,
+        input=stream,
+        check=True,
+    )
+    new_tree, parent_tree = (
+        ckwrapper.git_command(
+            "rev-parse",
+            f"{SNAPSHOT_REF}^{{tree}}",
+            f"{parent}^{{tree}}",
+            get_stdout=True,
+        )
+        .decode()
+        .split()
+    )
+    if new_tree == parent_tree:
+        summary = StatusSummary()  # Only timestamps changed
+    else:
+        ckwrapper.git_command(
+            "update-ref", f"refs/heads/{branch}", SNAPSHOT_REF, parent
+        )
+        # Otherwise the index still describes the previous commit and the next commit would revert this one
+        ckwrapper.git_command("reset", "-q")
+    ckwrapper.git_command("update-ref", "-d", SNAPSHOT_REF)
+    return summary
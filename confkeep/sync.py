@@ -0,0 +1,397 @@
+"""Copies the tracked paths into the host's directory of the repository.
+
+Two engines are available: the rsync binary and a builtin one that does the same local mirroring in-process.
+"""
+
+import errno
+import os
+import stat
+import subprocess
+import sys
+import time
+
+from confkeep import settings
+from confkeep.metrics import SyncMetrics
+from confkeep.util import ConfKeepError
+
+RSYNC_ENGINE = "rsync"
+BUILTIN_ENGINE = "builtin"
+# ioctl request that shares the data blocks of one file with another on filesystems with reflinks (btrfs, xfs...)
+FICLONE = 0x40049409
+# Starts the lines listing the entries rsync updated
+OUTPUT_MARKER = "conf-keep:"
+
+
+def sync_paths(paths, work_path, metrics=None):
+    """Mirror every tracked path (TrackedPath) into work_path, removing the copies of paths that no longer exist.
+
+    Depending on the settings the paths are passed to a single rsync invocation (SYNC_BATCH) and/or spread over
+    SYNC_CONCURRENCY workers. Paths with filters are always copied on their own. Errors are raised once every path has
+    been attempted, unless IGNORE_SYNC_ERRORS is set. Return the paths whose copy had errors that were ignored.
+    """
+    metrics = metrics or SyncMetrics()
+    copy = copy_engine()
+    groups, concurrency = copy_groups(paths, work_path)
+    failed, errors = [], []
+    if concurrency == 1:
+        for group in groups:
+            try:
+                failed += _sync_group(copy, group, work_path, metrics)
+            except (subprocess.CalledProcessError, ConfKeepError) as error:
+                errors.append(error)
+    else:
+        import concurrent.futures
+
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            futures = [
+                executor.submit(_sync_group, copy, group, work_path, metrics)
+                for group in groups
+            ]
+        for future in futures:
+            try:
+                failed += future.result()
+            except (subprocess.CalledProcessError, ConfKeepError) as error:
+                errors.append(error)
+    raise_errors(errors)
+    return failed
+
+
+def copy_engine():
+    """Return the function of SYNC_ENGINE copying a group of tracked paths."""
+    if settings.SYNC_ENGINE == RSYNC_ENGINE:
+        return rsync
+    if settings.SYNC_ENGINE == BUILTIN_ENGINE:
+        return mirror_all
+    raise ConfKeepError(f"Unknown SYNC_ENGINE {settings.SYNC_ENGINE}.")
+
+
+def copy_groups(paths, work_path):
+    """Remove the copies of the paths that no longer exist. Return the groups the others are copied in and how many
+    groups are copied at the same time."""
+    present = []
+    filtered = []
+    for tracked in paths:
+        if not tracked.path.exists():
+            remove_mirror(tracked.path, work_path)
+        elif tracked.has_filters:
+            filtered.append(tracked)
+        else:
+            present.append(tracked)
+    concurrency = max(1, min(settings.SYNC_CONCURRENCY, len(present) + len(filtered)))
+    if settings.SYNC_BATCH and present:
+        batches = min(concurrency, len(present))
+        groups = [present[i::batches] for i in range(batches)]
+    else:
+        groups = [[tracked] for tracked in present]
+    groups += [[tracked] for tracked in filtered]
+    return groups, concurrency
+
+
+def remove_mirror(path, work_path):
+    try:
+        os.remove(work_path / path.name)
+    except IsADirectoryError:
+        import shutil
+
+        shutil.rmtree(work_path / path.name)
+    except FileNotFoundError:
+        pass  # No problem if what you tried to remove is already gone
+
+
+def _sync_group(copy, group, work_path, metrics):
+    """Copy a group of tracked paths. Return those whose copy had errors that were ignored."""
+    try:
+        with metrics.path(",".join(str(tracked) for tracked in group)):
+            return copy(group, work_path, metrics)
+    except (subprocess.CalledProcessError, ConfKeepError):
+        if len(group) == 1:
+            raise
+        # Retry one path at a time so that the error points to the path that caused it
+        failed, errors = [], []
+        for tracked in group:
+            try:
+                with metrics.path(str(tracked)):
+                    failed += copy([tracked], work_path, metrics)
+            except (subprocess.CalledProcessError, ConfKeepError) as error:
+                errors.append(error)
+        raise_errors(errors)
+        return failed
+
+
+def raise_errors(errors):
+    """Raise the error of the only path that failed, or one for all of them."""
+    if len(errors) == 1:
+        raise errors[0]
+    if errors:
+        for error in errors:
+            print(error)
+        raise ConfKeepError(f"The copy of {len(errors)} tracked path(s) failed.")
+
+
+def rsync(paths, work_path, metrics):
+    options = []
+    sources = [str(tracked) for tracked in paths]
+    destination = work_path
+    if len(paths) == 1 and paths[0].has_filters and paths[0].path.is_dir():
+        # Make the tracked directory the transfer root so that anchored patterns are relative to it
+        options = ["--delete-excluded"] + paths[0].rsync_options()
+        sources = [f"{paths[0].path}/"]
+        destination = work_path / paths[0].path.name
+    # Every updated entry is listed as "<OUTPUT_MARKER> <itemized changes> <size> <name>"
+    try:
+        completed = subprocess.run(
+            ["rsync", "-EWavz", "--delete", f"--out-format={OUTPUT_MARKER} %i %l %n"]
+            + options
+            + sources
+            + [destination],
+            check=not settings.IGNORE_SYNC_ERRORS,
+            stdout=subprocess.PIPE,
+            timeout=settings.SYNC_TIMEOUT or None,
+        )
+    except subprocess.TimeoutExpired:
+        message = f"Copying {' '.join(sources)} took more than {int(settings.SYNC_TIMEOUT)} seconds."
+        if not settings.IGNORE_SYNC_ERRORS:
+            raise ConfKeepError(message)
+        print(message)
+        return list(paths)
+    output = completed.stdout.decode(errors="replace")
+    count_transfers(output, metrics)
+    sys.stdout.write(output)
+    if options and paths[0].max_size is not None:
+        remove_oversize(paths[0], destination)
+    # The transfer doesn't tell which path the errors came from
+    return list(paths) if completed.returncode else []
+
+
+def count_transfers(output, metrics):
+    """Count the files rsync copied and their size, like the builtin engine does, from its --out-format lines."""
+    for line in output.splitlines():
+        fields = line.split(" ", 3)
+        if len(fields) < 4 or fields[0] != OUTPUT_MARKER:
+            continue
+        itemized, size = fields[1], fields[2]
+        # > is a file received, f a regular file
+        if itemized.startswith(">f"):
+            metrics.count("files_copied")
+            # Newer versions of rsync group the digits, e.g. 1,048,576
+            metrics.count("bytes_copied", int("".join(filter(str.isdigit, size)) or 0))
+
+
+def remove_oversize(tracked, destination):
+    """Remove the copies of the files of tracked that are over its max-size.
+
+    rsync's --max-size only stops the transfer of these files, unlike excluded ones their existing copies, made before
+    they grew or before the limit was set, aren't deleted.
+    """
+    for directory, _, names in os.walk(destination):
+        relative_directory = os.path.relpath(directory, destination)
+        for name in names:
+            relative = os.path.normpath(os.path.join(relative_directory, name))
+            try:
+                source_stat = os.lstat(tracked.path / relative)
+            except OSError:
+                continue  # Gone, --delete takes care of it
+            if stat.S_ISREG(source_stat.st_mode) and tracked.excludes(
+                relative, False, source_stat.st_size
+            ):
+                os.remove(os.path.join(directory, name))
+
+
+def mirror_all(paths, work_path, metrics):
+    return [tracked for tracked in paths if not mirror(tracked, work_path, metrics)]
+
+
+def mirror(tracked, work_path, metrics, deadline=None):
+    """Make work_path/name a copy of the tracked path the way rsync -a --delete does, without compressing anything.
+
+    Only regular files whose size or modification time differ are copied. Modes, timestamps, symlinks and, when
+    running as root, owners are preserved. Entries that are gone from the tracked path or excluded by its filters are
+    removed from the copy. Return False if there were errors and IGNORE_SYNC_ERRORS is set. Raise ConfKeepError if the
+    copy is still running at deadline (a time.monotonic() value), checked before every directory entry.
+    """
+    errors = []
+    path = tracked.path
+    filters = tracked if tracked.has_filters else None
+    _mirror_entry(
+        str(path), str(work_path / path.name), errors, metrics, filters, "", deadline
+    )
+    if errors:
+        for error in errors:
+            print(f"Failed to copy {error.filename}: {error.strerror}")
+        if not settings.IGNORE_SYNC_ERRORS:
+            raise ConfKeepError(f"{len(errors)} error(s) while copying {path}.")
+    return not errors
+
+
+def _mirror_entry(source, destination, errors, metrics, filters, prefix, deadline):
+    try:
+        source_stat = os.lstat(source)
+    except FileNotFoundError:
+        return  # Removed while copying, the next run takes care of it
+    except OSError as error:
+        errors.append(error)
+        return
+    try:
+        destination_stat = os.lstat(destination)
+    except FileNotFoundError:
+        destination_stat = None
+    try:
+        if destination_stat and stat.S_IFMT(destination_stat.st_mode) != stat.S_IFMT(
+            source_stat.st_mode
+        ):
+            _remove(destination, destination_stat)
+            destination_stat = None
+        mode = source_stat.st_mode
+        if stat.S_ISDIR(mode):
+            if not destination_stat:
+                os.mkdir(destination, 0o700)
+            _mirror_directory(
+                source, destination, errors, metrics, filters, prefix, deadline
+            )
+        elif stat.S_ISLNK(mode):
+            target = os.readlink(source)
+            if destination_stat and os.readlink(destination) == target:
+                return
+            if destination_stat:
+                os.remove(destination)
+            os.symlink(target, destination)
+        elif stat.S_ISREG(mode):
+            if (
+                not destination_stat
+                or destination_stat.st_size != source_stat.st_size
+                or destination_stat.st_mtime_ns != source_stat.st_mtime_ns
+            ):
+                _copy_file(source, destination)
+                metrics.count("files_copied")
+                metrics.count("bytes_copied", source_stat.st_size)
+            elif destination_stat.st_mode == source_stat.st_mode and (
+                os.geteuid() != 0
+                or (destination_stat.st_uid, destination_stat.st_gid)
+                == (source_stat.st_uid, source_stat.st_gid)
+            ):
+                return  # Nothing to do
+        elif not destination_stat or destination_stat.st_rdev != source_stat.st_rdev:
+            if destination_stat:
+                os.remove(destination)
+            os.mknod(destination, mode, source_stat.st_rdev)
+        _copy_attributes(source_stat, destination)
+    except OSError as error:
+        if not error.filename:
+            error.filename = source
+        errors.append(error)
+
+
+def _mirror_directory(source, destination, errors, metrics, filters, prefix, deadline):
+    with os.scandir(source) as entries:
+        names = {
+            entry.name
+            for entry in entries
+            if not filters or not filters.excludes_entry(prefix + entry.name, entry)
+        }
+    for name in names:
+        if deadline is not None and time.monotonic() > deadline:
+            raise ConfKeepError(f"Copying {source} took too long.")
+        _mirror_entry(
+            os.path.join(source, name),
+            os.path.join(destination, name),
+            errors,
+            metrics,
+            filters,
+            prefix + name + "/",
+            deadline,
+        )
+    with os.scandir(destination) as entries:
+        extra = [entry for entry in entries if entry.name not in names]
+    for entry in extra:
+        _remove(entry.path, entry.stat(follow_symlinks=False))
+
+
+def _remove(path, path_stat):
+    if stat.S_ISDIR(path_stat.st_mode):
+        import shutil
+
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def _copy_attributes(source_stat, destination):
+    if os.geteuid() == 0:
+        os.chown(
+            destination,
+            source_stat.st_uid,
+            source_stat.st_gid,
+            follow_symlinks=False,
+        )
+    if not stat.S_ISLNK(source_stat.st_mode):
+        os.chmod(destination, stat.S_IMODE(source_stat.st_mode))
+    os.utime(
+        destination,
+        ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns),
+        follow_symlinks=False,
+    )
+
+
+def _copy_file(source, destination):
+    """Copy through a temporary file that replaces destination, so readers never see a partial copy."""
+    directory, name = os.path.split(destination)
+    temporary = os.path.join(directory, f".{name}.conf-keep~")
+    with open(source, "rb") as source_file, open(temporary, "wb") as temporary_file:
+        try:
+            _copy_contents(source_file.fileno(), temporary_file.fileno())
+        except BaseException:
+            os.remove(temporary)
+            raise
+    os.replace(temporary, destination)
+
+
+def _copy_contents(source_fd, destination_fd):
+    """Copy using the cheapest method the kernel and filesystem support, falling back to plain reads and writes."""
+    try:
+        import fcntl
+
+        fcntl.ioctl(destination_fd, FICLONE, source_fd)
+        return
+    except (ImportError, OSError):
+        pass
+    copied = 0
+    for kernel_copy in (_copy_file_range, _sendfile):
+        try:
+            copied = kernel_copy(source_fd, destination_fd)
+            break
+        except OSError as error:
+            unsupported = error.errno in (
+                errno.EXDEV,
+                errno.ENOSYS,
+                errno.EINVAL,
+                errno.EOPNOTSUPP,
+            )
+            if not unsupported or os.lseek(destination_fd, 0, os.SEEK_CUR) > 0:
+                raise
+    if copied == 0:
+        # Some pseudo-files report a size of 0 and can only be read
+        while True:
+            chunk = os.read(source_fd, 1 << 16)
+            if not chunk:
+                break
+            os.write(destination_fd, chunk)
+
+
+def _copy_file_range(source_fd, destination_fd):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+    copied = 0
+    while True:
+        count = os.copy_file_range(source_fd, destination_fd, 1 << 30)
+        if count == 0:
+            return copied
+        copied += count
+
+
+def _sendfile(source_fd, destination_fd):
+    copied = 0
+    while True:
+        count = os.sendfile(destination_fd, source_fd, None, 1 << 30)
+        if count == 0:
+            return copied
+        copied += count
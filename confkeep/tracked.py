@@ -0,0 +1,232 @@
+"""Entries of tracked.txt: a tracked path and the filters applied to what is under it.
+
+Each line holds the absolute path, optionally followed by tab separated options:
+
+    /etc	exclude=*.swp	exclude=cache/	include=important.swp	max-size=1048576	interval=3600
+
+Patterns follow rsync's rules with one difference: a pattern with a slash (other than a trailing one) is anchored to
+the tracked directory, `a/b` only matches the path a/b relative to it where rsync would match it at any depth. Both
+engines apply this, the rsync engine by adding a leading slash to these patterns. A pattern without a slash matches the
+name of an entry at any depth, a trailing slash only matches directories, `*` and `?` don't match slashes and `**`
+does. Include patterns take precedence over exclude patterns. Files larger than max-size bytes are skipped. Excluded
+directories aren't even traversed. The tracked path itself is never excluded.
+
+A path with an interval is only synced by runs that happen at least interval seconds after its last sync. Lines without
+options, as written by older versions, track the path with no filters on every run.
+"""
+
+import os
+import pathlib
+import re
+import stat
+
+from confkeep.util import ConfKeepError
+
+EXCLUDE = "exclude"
+INCLUDE = "include"
+MAX_SIZE = "max-size"
+INTERVAL = "interval"
+SIZE_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+INTERVAL_SUFFIXES = {"S": 1, "M": 60, "H": 3600, "D": 86400}
+GLOB_CHARACTERS = re.compile(r"[*?[]")
+
+
+def parse_size(size):
+    """Convert sizes like 512, 100K or 2M to bytes."""
+    size = str(size).strip().upper()
+    multiplier = SIZE_SUFFIXES.get(size[-1:], 1)
+    if size[-1:] in SIZE_SUFFIXES:
+        size = size[:-1]
+    try:
+        return int(size) * multiplier
+    except ValueError:
+        raise ConfKeepError(f"Invalid size {size}.")
+
+
+def parse_interval(interval):
+    """Convert intervals like 90, 30m, 1h or 1d to seconds."""
+    interval = str(interval).strip().upper()
+    multiplier = INTERVAL_SUFFIXES.get(interval[-1:], 1)
+    if interval[-1:] in INTERVAL_SUFFIXES:
+        interval = interval[:-1]
+    try:
+        return int(interval) * multiplier
+    except ValueError:
+        raise ConfKeepError(f"Invalid interval {interval}.")
+
+
+def _translate(pattern):
+    """Compile a glob into a regular expression with rsync's meaning of *, ** and ?."""
+    regex = []
+    index = 0
+    while index < len(pattern):
+        character = pattern[index]
+        if pattern.startswith("**", index):
+            regex.append(".*")
+            index += 2
+            continue
+        if character == "*":
+            regex.append("[^/]*")
+        elif character == "?":
+            regex.append("[^/]")
+        elif character == "[" and pattern.find("]", index + 2) != -1:
+            end = pattern.find("]", index + 2)
+            body = pattern[index + 1 : end].replace("\\", "\\\\")
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            regex.append(f"[{body}]")
+            index = end + 1
+            continue
+        else:
+            regex.append(re.escape(character))
+        index += 1
+    return re.compile("".join(regex) + r"\Z")
+
+
+class Pattern:
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.directory_only = pattern.endswith("/")
+        stripped = pattern.rstrip("/")
+        self.anchored = "/" in stripped
+        self.regex = _translate(stripped.lstrip("/"))
+
+    def matches(self, relative, is_dir):
+        if self.directory_only and not is_dir:
+            return False
+        if self.anchored:
+            return bool(self.regex.match(relative))
+        return bool(self.regex.match(relative.rpartition("/")[2]))
+
+
+class TrackedPath:
+    def __init__(self, path, exclude=(), include=(), max_size=None, interval=None):
+        self.path = pathlib.Path(path)
+        self.exclude = list(exclude)
+        self.include = list(include)
+        self.max_size = max_size
+        self.interval = interval
+        self._exclude = [Pattern(pattern) for pattern in self.exclude]
+        self._include = [Pattern(pattern) for pattern in self.include]
+
+    @classmethod
+    def parse(cls, line):
+        path, *options = line.split("\t")
+        exclude, include, max_size, interval = [], [], None, None
+        for option in options:
+            name, _, value = option.partition("=")
+            if name == EXCLUDE:
+                exclude.append(value)
+            elif name == INCLUDE:
+                include.append(value)
+            elif name == MAX_SIZE:
+                max_size = parse_size(value)
+            elif name == INTERVAL:
+                interval = parse_interval(value)
+            else:
+                raise ConfKeepError(f"Unknown option {name} for {path} in tracked.txt.")
+        return cls(path, exclude, include, max_size, interval)
+
+    def format(self):
+        options = [f"{EXCLUDE}={pattern}" for pattern in self.exclude]
+        options += [f"{INCLUDE}={pattern}" for pattern in self.include]
+        if self.max_size is not None:
+            options.append(f"{MAX_SIZE}={self.max_size}")
+        if self.interval:
+            options.append(f"{INTERVAL}={self.interval}")
+        return "\t".join([str(self.path)] + options)
+
+    def __str__(self):
+        return str(self.path)
+
+    def __eq__(self, other):
+        return isinstance(other, TrackedPath) and self.format() == other.format()
+
+    def __hash__(self):
+        return hash(self.format())
+
+    @property
+    def has_filters(self):
+        return bool(self.exclude or self.max_size is not None)
+
+    def excludes(self, relative, is_dir, size=None):
+        """Whether the entry at relative (to the tracked directory) is left out. size is only checked for files."""
+        if not is_dir and size is not None and self.max_size is not None:
+            if size > self.max_size:
+                return True
+        if not self._exclude:
+            return False
+        if any(pattern.matches(relative, is_dir) for pattern in self._include):
+            return False
+        return any(pattern.matches(relative, is_dir) for pattern in self._exclude)
+
+    def excludes_entry(self, relative, dir_entry):
+        """excludes for an os.scandir entry, only calling stat when the size matters."""
+        is_dir = dir_entry.is_dir(follow_symlinks=False)
+        size = None
+        if self.max_size is not None and dir_entry.is_file(follow_symlinks=False):
+            try:
+                size = dir_entry.stat(follow_symlinks=False).st_size
+            except FileNotFoundError:
+                return True
+        return self.excludes(relative, is_dir, size)
+
+    def excludes_stat(self, relative, st):
+        regular = stat.S_ISREG(st.st_mode)
+        return self.excludes(
+            relative, stat.S_ISDIR(st.st_mode), st.st_size if regular else None
+        )
+
+    def rsync_options(self):
+        """The filters as rsync options, for a transfer whose root is the tracked directory."""
+        options = []
+        for name, patterns in ((INCLUDE, self.include), (EXCLUDE, self.exclude)):
+            for pattern in patterns:
+                # rsync matches patterns with a slash at any depth, ours are anchored to the tracked directory, which
+                # is the transfer root
+                if "/" in pattern.rstrip("/") and not pattern.startswith("/"):
+                    pattern = "/" + pattern
+                options.append(f"--{name}={pattern}")
+        if self.max_size is not None:
+            options.append(f"--max-size={self.max_size}")
+        return options
+
+
+def read_tracked(path):
+    """Return the TrackedPath of every line of the tracked.txt at path."""
+    return [TrackedPath.parse(line) for line in path.read_text().splitlines() if line]
+
+
+def write_tracked(path, tracked):
+    path.write_text("".join(entry.format() + "\n" for entry in tracked))
+
+
+def read_path_list(lines):
+    """Paths listed one per line, skipping blank lines and # comments."""
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            yield line
+
+
+def expand_paths(arguments):
+    """Return the absolute, normalized paths matched by arguments, in order and without duplicates.
+
+    Arguments with glob characters are expanded and must match something, the others are kept even if they don't exist
+    (yet). Relative arguments raise ConfKeepError, the sync doesn't run from a fixed directory.
+    """
+    import glob
+
+    paths = {}
+    for argument in arguments:
+        if not os.path.isabs(argument):
+            raise ConfKeepError(f"The path {argument} must be an absolute path.")
+        if GLOB_CHARACTERS.search(argument):
+            matches = sorted(glob.glob(argument))
+            if not matches:
+                raise ConfKeepError(f"No path matches {argument}.")
+        else:
+            matches = [argument]
+        for match in matches:
+            paths.setdefault(os.path.normpath(match), None)
+    return [pathlib.Path(path) for path in paths]
@@ -2,6 +2,10 @@ import os
 import pathlib
 
 
+class ConfKeepError(Exception):
+    pass
+
+
 def get_path_environ(variable, default):
     return (
         pathlib.Path(os.environ[variable]).absolute()
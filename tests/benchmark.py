@@ -0,0 +1,227 @@
+"""Benchmark of sync on synthetic configuration trees.
+
+For each tree size it measures a cold sync, a sync without changes, a sync after changing one file and a sync after
+changing a large part of the tree, against a local bare remote like tests.py does. Every sync runs in a fresh
+interpreter and reports one json line with its wall time, the number of subprocesses it started, its peak RSS and the
+time spent in each phase, so results can be compared across releases.
+
+The peak RSS (of the interpreter, and of the largest subprocess it waited for) is also recorded at the end of every
+phase. The kernel only keeps the peak of the whole run, it can't be reset, so the value of a phase is the peak reached
+by its end: the phases that raised it are those whose value is higher than that of the phases that ran before them.
+
+    python tests/benchmark.py --sizes 1000,10000 --output results.jsonl
+
+Settings are taken from the environment like for any other conf-keep run (e.g. SYNC_ENGINE=builtin).
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import pathlib
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+project_dir = pathlib.Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(project_dir))
+
+from confkeep import VERSION  # noqa: E402
+
+FILES_PER_DIRECTORY = 16
+DEEP_NESTING = 32
+LARGE_FILES = 3
+SCENARIOS = ("cold", "noop", "small-change", "mass-change")
+
+
+def file_path(tree, index):
+    """Spread files over nested directories, eight subdirectories per level."""
+    directory = index // FILES_PER_DIRECTORY
+    parts = []
+    while directory:
+        parts.append(f"d{directory % 8}")
+        directory //= 8
+    return tree.joinpath(*parts, f"file{index}.conf")
+
+
+def generate_tree(tree, size, large_file_size):
+    for index in range(size):
+        path = file_path(tree, index)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f"# generated file {index}\noption_{index} = {index * 7}\n" * 4)
+    deep = tree.joinpath(*(f"n{level}" for level in range(DEEP_NESTING)))
+    deep.mkdir(parents=True)
+    (deep / "deep.conf").write_text("deep = true\n")
+    chunk = os.urandom(1 << 16)
+    for index in range(LARGE_FILES):
+        with open(tree / f"large{index}.bin", "wb") as large:
+            remaining = large_file_size
+            while remaining:
+                remaining -= large.write(chunk[:remaining])
+
+
+def change_files(tree, indexes, run):
+    for index in indexes:
+        with open(file_path(tree, index), "a") as file:
+            file.write(f"changed = {run}\n")
+
+
+def run_sync(result_path):
+    """Child process side: run one sync and write its measurements to result_path."""
+    from confkeep.confkeep_commands import CKWrapper
+    from confkeep.metrics import SyncMetrics
+
+    spawned = []
+    original_init = subprocess.Popen.__init__
+
+    def counting_init(self, *args, **kwargs):
+        spawned.append(args[0] if args else kwargs.get("args"))
+        original_init(self, *args, **kwargs)
+
+    subprocess.Popen.__init__ = counting_init
+    phase_peak_rss = {}
+    original_phase = SyncMetrics.phase
+
+    @contextlib.contextmanager
+    def measured_phase(self, name):
+        with original_phase(self, name):
+            yield
+        phase_peak_rss[name] = [
+            max(resource.getrusage(who).ru_maxrss, previous)
+            for who, previous in zip(
+                (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN),
+                phase_peak_rss.get(name, (0, 0)),
+            )
+        ]
+
+    SyncMetrics.phase = measured_phase
+    ckwrapper = CKWrapper()
+    start = time.perf_counter()
+    ckwrapper.watchdog()
+    wall = time.perf_counter() - start
+    metrics = ckwrapper.metrics.as_dict(True)
+    pathlib.Path(result_path).write_text(
+        json.dumps(
+            {
+                "wall": wall,
+                "subprocesses": len(spawned),
+                "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                "children_peak_rss_kb": resource.getrusage(
+                    resource.RUSAGE_CHILDREN
+                ).ru_maxrss,
+                "phases": metrics["phases"],
+                "phase_peak_rss_kb": {
+                    name: peaks[0] for name, peaks in phase_peak_rss.items()
+                },
+                "phase_children_peak_rss_kb": {
+                    name: peaks[1] for name, peaks in phase_peak_rss.items()
+                },
+                "counters": metrics["counters"],
+            }
+        )
+    )
+
+
+def confkeep(environment, *args):
+    subprocess.run(
+        [sys.executable, "-m", "confkeep"] + list(args),
+        cwd=project_dir,
+        env=environment,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def measure(environment, work_dir):
+    result_path = work_dir / "result.json"
+    subprocess.run(
+        [sys.executable, __file__, "--run-sync", str(result_path)],
+        cwd=project_dir,
+        env=environment,
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    return json.loads(result_path.read_text())
+
+
+def benchmark(size, work_dir, large_file_size):
+    shutil.rmtree(work_dir, ignore_errors=True)
+    tree = work_dir / "tree"
+    remote = work_dir / "remote"
+    remote.mkdir(parents=True)
+    subprocess.run(["git", "init", "-q", "--bare"], cwd=remote, check=True)
+    generate_tree(tree, size, large_file_size)
+    environment = dict(
+        os.environ,
+        ASSUME_YES="TRUE",
+        IGNORE_IP_CHANGES="TRUE",
+        REPO_PATH=str(work_dir / "repo"),
+        REMOTE=str(remote),
+        MONITORED_PATH=str(tree),
+        HOST_NAME="benchmark",
+        GIT_AUTHOR_NAME="conf-keep benchmark",
+        GIT_AUTHOR_EMAIL="benchmark@example.com",
+        GIT_COMMITTER_NAME="conf-keep benchmark",
+        GIT_COMMITTER_EMAIL="benchmark@example.com",
+    )
+    # Measure the maintenance stage only when asked to, it would otherwise run as part of the cold sync if it is enabled
+    environment.setdefault("MAINTENANCE_INTERVAL", "0")
+    confkeep(environment, "bootstrap")
+    confkeep(environment, "add-host")
+    confkeep(environment, "watch")
+    for scenario in SCENARIOS:
+        if scenario == "small-change":
+            change_files(tree, [size // 2], scenario)
+        elif scenario == "mass-change":
+            change_files(tree, range(0, size, 2), scenario)
+        result = measure(environment, work_dir)
+        result.update(version=VERSION, size=size, scenario=scenario)
+        yield result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default="1000,10000,100000",
+        help="Comma separated numbers of files of the synthetic trees.",
+    )
+    parser.add_argument(
+        "--large-file-size",
+        type=int,
+        default=8 << 20,
+        help="Size in bytes of each of the large files added to every tree.",
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=pathlib.Path,
+        default=project_dir / "benchmark-work",
+        help="Where trees and repositories are created. It is removed at the end.",
+    )
+    parser.add_argument(
+        "--output", type=pathlib.Path, help="Append results here instead of stdout."
+    )
+    parser.add_argument("--run-sync", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_sync:
+        run_sync(args.run_sync)
+        return
+    output = args.output.open("a") if args.output else sys.stdout
+    try:
+        for size in (int(size) for size in args.sizes.split(",")):
+            for result in benchmark(
+                size, args.work_dir.absolute() / str(size), args.large_file_size
+            ):
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+    finally:
+        shutil.rmtree(args.work_dir, ignore_errors=True)
+        if args.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,33 @@
+import io
+import json
 import os
 
 import confkeep.confkeep_commands
-from confkeep.confkeep_commands import CKWrapper, settings
+from confkeep import VERSION
+from confkeep.build_zipapp import build
+from confkeep.collect import LocalTransport
+from confkeep.change_index import ChangeIndex, branch_tips
+import confkeep.identity
+import confkeep.maintenance
+import confkeep.pipeline
+import confkeep.sync
+from confkeep.confkeep_commands import CKWrapper, host_delay, next_interval, settings
+from confkeep.daemon import Daemon
+from confkeep.drift import find_versions, group_hosts, report
+from confkeep.git_status import StatusSummary, parse_status
+from confkeep.lock import process_start_time
+from confkeep.manifest import StatManifest
+from confkeep.metrics import SyncMetrics
+from confkeep.sync import count_transfers, remove_oversize
+from confkeep.tracked import TrackedPath, read_tracked
 import pathlib
+import threading
+import time
 import unittest
 import subprocess
 import shutil
+import signal
+import sys
 
 module_dir = pathlib.Path(__file__).parent
 
@@ -35,6 +57,24 @@ class MyTestCase(unittest.TestCase):
     def setUp(self):
         settings.ASSUME_YES = True
         settings.ASSUME_NO = False
+        settings.SYNC_BATCH = False
+        settings.SYNC_CONCURRENCY = 1
+        settings.SYNC_ENGINE = "rsync"
+        settings.DAEMON_DEBOUNCE = 2
+        settings.PUSH_RETRY_DELAY = 60
+        settings.SNAPSHOT_MODE = "mirror"
+        settings.MONITORED_EXCLUDE = []
+        settings.MONITORED_INCLUDE = []
+        settings.MONITORED_MAX_SIZE = None
+        settings.MONITORED_INTERVAL = None
+        settings.MAINTENANCE_INTERVAL = 0
+        settings.COMPACT_HISTORY = False
+        settings.FULL_CLONE = False
+        settings.ADAPTIVE_SYNC = False
+        settings.COLLECT_TRANSPORT = "ssh"
+        settings.SHARED_OBJECT_STORE = None
+        settings.SYNC_PIPELINE = False
+        settings.SYNC_TIMEOUT = 1800
         self.tearDown()
         settings.REMOTE.mkdir()
         subprocess.run(["git", "init", "--bare"], cwd=settings.REMOTE)
@@ -71,6 +111,131 @@ class MyTestCase(unittest.TestCase):
             settings.ASSUME_NO = True
             self.ckwrapper.config_host()
 
+    def test_partial_clone(self):
+        """add-host on a new machine only fetches and checks out what the host needs"""
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        self.ckwrapper.track_dir()
+        self.ckwrapper.watchdog()
+        repo_path, remote, host_name = (
+            settings.REPO_PATH,
+            settings.REMOTE,
+            settings.HOST_NAME,
+        )
+        # Bare repositories only serve partial clones when allowed
+        subprocess.run(
+            ["git", "config", "uploadpack.allowFilter", "true"], cwd=remote, check=True
+        )
+        settings.REPO_PATH = pathlib.Path("repo-clone").absolute()
+        settings.REMOTE = f"file://{remote}"
+        settings.HOST_NAME = "other-host"
+        try:
+            other = CKWrapper()
+            other.config_host()
+            config = other.git_command("config", "--list", get_stdout=True).decode()
+            self.assertIn("remote.origin.partialclonefilter=blob:none", config)
+            self.assertIn(
+                "remote.origin.fetch=+refs/heads/other-host:refs/remotes/origin/other-host",
+                config,
+            )
+            self.assertEqual(
+                b"other-host",
+                other.git_command("sparse-checkout", "list", get_stdout=True).strip(),
+            )
+            other.git_command("fetch", "origin")
+            self.assertNotIn(
+                b"origin/" + host_name.encode(),
+                other.git_command("branch", "-r", get_stdout=True),
+            )
+            self.assertTrue(other.tracked_file_path.is_file())
+        finally:
+            shutil.rmtree(settings.REPO_PATH, ignore_errors=True)
+            settings.REPO_PATH, settings.REMOTE, settings.HOST_NAME = (
+                repo_path,
+                remote,
+                host_name,
+            )
+
+    def test_shared_object_store(self):
+        """Instances sharing an object store only keep the objects the store doesn't have"""
+        store = pathlib.Path("repo-objects").absolute()
+        shutil.rmtree(store, ignore_errors=True)
+        settings.SHARED_OBJECT_STORE = store
+        repo_path, remote, host_name = (
+            settings.REPO_PATH,
+            settings.REMOTE,
+            settings.HOST_NAME,
+        )
+        try:
+            self.ckwrapper.bootstrap_repository()
+            alternates = settings.REPO_PATH / ".git" / "objects" / "info" / "alternates"
+            self.assertEqual(str(store / "objects"), alternates.read_text().strip())
+            self.assertEqual(
+                b"never",
+                subprocess.run(
+                    ["git", "config", "gc.pruneExpire"],
+                    cwd=store,
+                    stdout=subprocess.PIPE,
+                    check=True,
+                ).stdout.strip(),
+            )
+            self.ckwrapper.config_host()
+            self.ckwrapper.track_dir()
+            self.ckwrapper.watchdog()
+            self.ckwrapper.maintenance()
+            # The store fetched the host branch, so its objects were dropped from the local packs
+            self.assertEqual(
+                0, confkeep.maintenance.count_objects(self.ckwrapper)["in-pack"]
+            )
+            self.ckwrapper.git_command("fsck", "--connectivity-only")
+            self.ckwrapper.git_command("show", f"HEAD:{host_name}/tracked.txt")
+
+            settings.REPO_PATH = pathlib.Path("repo-clone").absolute()
+            settings.HOST_NAME = "other-host"
+            # Clones of local paths copy every object
+            settings.REMOTE = f"file://{remote}"
+            other = CKWrapper()
+            other.config_host()
+            self.assertTrue(
+                (
+                    settings.REPO_PATH / ".git" / "objects" / "info" / "alternates"
+                ).is_file()
+            )
+            other.git_command("fsck", "--connectivity-only")
+            local = confkeep.maintenance.count_objects(other)
+            # Only the commit adding the host, its trees and its two files were written or fetched
+            self.assertLess(local["count"] + local["in-pack"], 10)
+        finally:
+            shutil.rmtree(pathlib.Path("repo-clone").absolute(), ignore_errors=True)
+            shutil.rmtree(store, ignore_errors=True)
+            settings.REPO_PATH, settings.REMOTE, settings.HOST_NAME = (
+                repo_path,
+                remote,
+                host_name,
+            )
+
+    def test_ip_fingerprint(self):
+        self.ckwrapper.config_host()
+        original = self.ckwrapper.original_ip_path.read_text()
+        self.assertEqual(64, len(original))
+        self.assertFalse(self.ckwrapper.is_ip_changed())
+        self.ckwrapper.original_ip_path.write_text("0" * 64)
+        self.assertTrue(self.ckwrapper.is_ip_changed())
+        self.assertTrue(self.ckwrapper.new_ip_path.is_file())
+        os.remove(self.ckwrapper.original_ip_path)
+        self.assertFalse(self.ckwrapper.is_ip_changed())
+        self.assertEqual(original, self.ckwrapper.original_ip_path.read_text())
+
+    def test_ip_fingerprint_legacy(self):
+        """The ip a output saved by older versions is converted"""
+        self.ckwrapper.config_host()
+        original = self.ckwrapper.original_ip_path.read_text()
+        self.ckwrapper.original_ip_path.write_text(
+            json.dumps(confkeep.identity.get_ip_interfaces())
+        )
+        self.assertFalse(self.ckwrapper.is_ip_changed())
+        self.assertEqual(original, self.ckwrapper.original_ip_path.read_text())
+
     def test_track_dir(self):
         self.ckwrapper.bootstrap_repository()
         self.ckwrapper.config_host()
@@ -159,6 +324,105 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(self.test_single_file.read_text(), single.read_text())
         self.assertEqual(self.test_child.read_text(), child.read_text())
 
+    def test_multiple_tracked_batched_concurrent(self):
+        settings.SYNC_BATCH = True
+        settings.SYNC_CONCURRENCY = 2
+        self.test_multiple_tracked()
+
+    def test_copy_error(self):
+        """A path whose copy fails doesn't stop the copy of the others, the error is raised afterwards"""
+        settings.SYNC_ENGINE = "builtin"
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        settings.MONITORED_PATH = self.test_single_file
+        self.ckwrapper.track_dir()
+        self.ckwrapper.track_dir([self.test_dir_parent])
+        mirror_all = confkeep.sync.mirror_all
+
+        def failing_mirror_all(paths, work_path, metrics):
+            if any(tracked.path == self.test_single_file for tracked in paths):
+                raise confkeep.confkeep_commands.ConfKeepError("Copy failed.")
+            return mirror_all(paths, work_path, metrics)
+
+        child = self.ckwrapper.work_path / self.test_dir_parent.name / "child"
+        confkeep.sync.mirror_all = failing_mirror_all
+        try:
+            for batch, concurrency in ((False, 1), (True, 1), (False, 2)):
+                shutil.rmtree(child.parent, ignore_errors=True)
+                settings.SYNC_BATCH, settings.SYNC_CONCURRENCY = batch, concurrency
+                with self.assertRaises(confkeep.confkeep_commands.ConfKeepError):
+                    self.ckwrapper.watchdog()
+                self.assertEqual(self.test_child.read_text(), child.read_text())
+        finally:
+            confkeep.sync.mirror_all = mirror_all
+
+    def test_multiple_tracked_pipeline(self):
+        settings.SYNC_PIPELINE = True
+        settings.SYNC_CONCURRENCY = 2
+        self.test_multiple_tracked()
+        self.assertEqual(
+            b"", self.ckwrapper.git_command("status", "--porcelain", get_stdout=True)
+        )
+
+    def test_pipeline_identity_changed(self):
+        """The copies overlap the identity check but nothing is committed if it fails"""
+        settings.SYNC_PIPELINE = True
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        self.ckwrapper.track_dir()
+        head = self.ckwrapper.git_command("rev-parse", "HEAD", get_stdout=True)
+        self.ckwrapper.original_ip_path.write_text("0" * 64)
+        self.test_child.write_text("second text child")
+        with self.assertRaises(confkeep.confkeep_commands.ConfKeepError):
+            self.ckwrapper.watchdog()
+        self.assertEqual(
+            head, self.ckwrapper.git_command("rev-parse", "HEAD", get_stdout=True)
+        )
+
+    def test_pipeline_timeout(self):
+        """A copy that hangs fails the sync after SYNC_TIMEOUT instead of holding the lock"""
+        settings.SYNC_PIPELINE = True
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        self.ckwrapper.track_dir()
+        head = self.ckwrapper.git_command("rev-parse", "HEAD", get_stdout=True)
+        settings.SYNC_TIMEOUT = 0.2
+        copy_engine = confkeep.pipeline.copy_engine
+
+        def hanging_copy(paths, work_path, metrics):
+            time.sleep(1)
+            return []
+
+        confkeep.pipeline.copy_engine = lambda: hanging_copy
+        try:
+            with self.assertRaises(confkeep.confkeep_commands.ConfKeepError):
+                self.ckwrapper.watchdog()
+        finally:
+            confkeep.pipeline.copy_engine = copy_engine
+        self.assertEqual(
+            head, self.ckwrapper.git_command("rev-parse", "HEAD", get_stdout=True)
+        )
+        lock = self.ckwrapper.lock
+        self.assertTrue(lock.acquire("test"))
+        lock.release()
+
+    def test_background_push(self):
+        """The daemon's pushes run while it waits and only the commits that were pushed are cleared"""
+        settings.SYNC_PIPELINE = True
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        self.ckwrapper.track_dir()
+        self.ckwrapper.background_push = True
+        self.test_child.write_text("second text child")
+        self.assertTrue(self.ckwrapper.watchdog())
+        self.assertIsNotNone(self.ckwrapper._push_process)
+        self.test_child.write_text("third text child")
+        # Waits for the previous push before pushing the new commit
+        self.assertTrue(self.ckwrapper.watchdog())
+        self.ckwrapper.finish_push()
+        self.assertFalse(self.ckwrapper.load_push_state()["pending"])
+        self.assertEqual(0, self.ckwrapper.queued_commits())
+
     def test_watchdog_delete(self):
         self.ckwrapper.bootstrap_repository()
         self.ckwrapper.config_host()
@@ -179,8 +443,1009 @@ class MyTestCase(unittest.TestCase):
         self.assertFalse(child.is_file())
         self.assertFalse(single.is_file())
 
+    def test_builtin_engine(self):
+        settings.SYNC_ENGINE = "builtin"
+        self.test_watchdog_sync_dir()
+        self.test_single_file.write_text("first text single")
+        settings.MONITORED_PATH = self.test_single_file
+        self.ckwrapper.track_dir()
+        link = self.test_dir_parent / "link"
+        link.symlink_to(self.test_child.name)
+        self.test_child.chmod(0o750)
+        self.ckwrapper.watchdog()
+        parent = self.ckwrapper.work_path / self.test_dir_parent.name
+        self.assertEqual(self.test_child.name, os.readlink(parent / "link"))
+        self.assertEqual(0o750, (parent / self.test_child.name).stat().st_mode & 0o777)
+        self.assertEqual(
+            self.test_single_file.read_text(),
+            (self.ckwrapper.work_path / self.test_single_file.name).read_text(),
+        )
+        os.remove(link)
+        os.remove(self.test_single_file)
+        self.ckwrapper.watchdog()
+        self.assertFalse(os.path.lexists(parent / "link"))
+        self.assertFalse(
+            (self.ckwrapper.work_path / self.test_single_file.name).exists()
+        )
+
+    def test_filters(self):
+        """Excluded and large files are neither copied nor committed"""
+        settings.SYNC_ENGINE = "builtin"
+        settings.MONITORED_EXCLUDE = ["*.swp", "cache/"]
+        settings.MONITORED_INCLUDE = ["keep.swp"]
+        settings.MONITORED_MAX_SIZE = "1K"
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        self.ckwrapper.track_dir()
+        self.assertIn(
+            f"{self.test_dir_parent}\texclude=*.swp\texclude=cache/\tinclude=keep.swp\tmax-size=1024\n",
+            self.ckwrapper.tracked_file_path.read_text(),
+        )
+        (self.test_dir_parent / "child.swp").write_text("swap")
+        (self.test_dir_parent / "keep.swp").write_text("kept")
+        (self.test_dir_parent / "cache").mkdir()
+        (self.test_dir_parent / "cache" / "entry").write_text("cached")
+        (self.test_dir_parent / "large").write_text("x" * 2048)
+        for mode in ("mirror", "direct"):
+            settings.SNAPSHOT_MODE = mode
+            self.ckwrapper.watchdog()
+            committed = self.ckwrapper.git_command(
+                "ls-tree", "-r", "--name-only", "HEAD", get_stdout=True
+            ).decode()
+            self.assertIn(self.test_child.name, committed)
+            self.assertIn("keep.swp", committed)
+            for excluded in ("child.swp", "cache", "large"):
+                self.assertNotIn(excluded, committed)
+                self.assertFalse(
+                    (
+                        self.ckwrapper.work_path / self.test_dir_parent.name / excluded
+                    ).exists()
+                )
+            head = self.ckwrapper.git_command("rev-parse", "HEAD", get_stdout=True)
+            (self.test_dir_parent / "cache" / "entry").write_text("changed")
+            self.ckwrapper.watchdog()
+            self.assertEqual(
+                head, self.ckwrapper.git_command("rev-parse", "HEAD", get_stdout=True)
+            )
+            # The direct snapshot rebuilds the directory from scratch
+            shutil.rmtree(
+                self.ckwrapper.work_path / self.test_dir_parent.name,
+                ignore_errors=True,
+            )
+            os.remove(self.ckwrapper.manifest_path)
+
+    def test_rsync_counts(self):
+        metrics = SyncMetrics()
+        count_transfers(
+            "sending incremental file list\n"
+            "conf-keep: cd+++++++++ 4,096 test-dir/\n"
+            "conf-keep: >f+++++++++ 1,048,576 test-dir/child\n"
+            "conf-keep: >f.st...... 12 test-dir/other file\n"
+            "conf-keep: *deleting 0 test-dir/gone\n"
+            "sent 1,048,700 bytes  received 60 bytes\n",
+            metrics,
+        )
+        self.assertEqual({"files_copied": 2, "bytes_copied": 1048588}, metrics.counters)
+
+    def test_remove_oversize(self):
+        """Copies of files that grew past max-size are removed, rsync only stops transferring them"""
+        tracked = TrackedPath(self.test_dir_parent, max_size=1024)
+        mirror = self.test_dir_parent.parent / "test-mirror"
+        shutil.rmtree(mirror, ignore_errors=True)
+        shutil.copytree(self.test_dir_parent, mirror)
+        try:
+            (self.test_dir_parent / "sub").mkdir()
+            (self.test_dir_parent / "sub" / "large").write_text("x" * 2048)
+            (mirror / "sub").mkdir()
+            (mirror / "sub" / "large").write_text("small before")
+            remove_oversize(tracked, mirror)
+            self.assertFalse((mirror / "sub" / "large").exists())
+            self.assertTrue((mirror / self.test_child.name).is_file())
+        finally:
+            shutil.rmtree(mirror, ignore_errors=True)
+
+    def test_bulk_watch(self):
+        """Many paths are tracked with a single commit, and synced right away with --sync"""
+        settings.SYNC_ENGINE = "builtin"
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        self.ckwrapper.track_dir()
+        for name in ("a.conf", "b.conf", "c.txt"):
+            (self.test_dir_parent / name).write_text(name)
+        path_list = self.test_dir_parent / "paths"
+        path_list.write_text(
+            f"# From the config management\n{self.test_single_file}\n\n{self.test_dir_parent}\n"
+        )
+
+        def commits():
+            return int(
+                self.ckwrapper.git_command(
+                    "rev-list", "--count", "HEAD", get_stdout=True
+                )
+            )
+
+        count = commits()
+        self.ckwrapper.watch(
+            [
+                str(self.test_dir_parent / "*.conf"),
+                str(self.test_dir_parent / "a.conf"),
+                "--from-file",
+                str(path_list),
+                "--sync",
+            ]
+        )
+        self.assertEqual(count + 2, commits())  # The tracking and the first sync
+        self.assertEqual(
+            [
+                str(self.test_dir_parent),
+                str(self.test_dir_parent / "a.conf"),
+                str(self.test_dir_parent / "b.conf"),
+                str(self.test_single_file),
+            ],
+            [str(entry) for entry in read_tracked(self.ckwrapper.tracked_file_path)],
+        )
+        self.assertEqual("b.conf", (self.ckwrapper.work_path / "b.conf").read_text())
+        self.ckwrapper.watch([str(self.test_dir_parent / "*.conf")])
+        self.assertEqual(count + 2, commits())
+        # Options given replace those of tracked paths, re-running the same list without options keeps them
+        settings.MONITORED_INTERVAL = "1h"
+        self.ckwrapper.watch([str(self.test_dir_parent / "a.conf")])
+        self.assertEqual(count + 3, commits())
+        settings.MONITORED_INTERVAL = None
+        self.ckwrapper.watch([str(self.test_dir_parent / "*.conf")])
+        self.assertEqual(count + 3, commits())
+        self.assertIn(
+            f"{self.test_dir_parent / 'a.conf'}\tinterval=3600\n",
+            self.ckwrapper.tracked_file_path.read_text(),
+        )
+        with self.assertRaises(confkeep.confkeep_commands.ConfKeepError):
+            self.ckwrapper.watch([str(self.test_dir_parent / "*.none")])
+
+    def test_watch_stdin(self):
+        """Paths read from stdin are tracked without prompting, even without ASSUME_YES"""
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        settings.ASSUME_YES = False
+        stdin = sys.stdin
+        try:
+            sys.stdin = io.StringIO(f"{self.test_dir_parent}\n")
+            self.ckwrapper.watch(["-"])
+            self.assertEqual(
+                [str(self.test_dir_parent)],
+                [
+                    str(entry)
+                    for entry in read_tracked(self.ckwrapper.tracked_file_path)
+                ],
+            )
+            # Prompting with nothing left on stdin
+            with self.assertRaises(confkeep.confkeep_commands.ConfKeepError):
+                self.ckwrapper.ask_options(self.test_dir_parent)
+        finally:
+            sys.stdin = stdin
+
+    def test_sync_interval(self):
+        """Paths with an interval are skipped until they are due"""
+        settings.SYNC_ENGINE = "builtin"
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        self.ckwrapper.track_dir()
+        settings.MONITORED_PATH = self.test_single_file
+        settings.MONITORED_INTERVAL = "1h"
+        self.ckwrapper.track_dir()
+        self.assertIn(
+            f"{self.test_single_file}\tinterval=3600\n",
+            self.ckwrapper.tracked_file_path.read_text(),
+        )
+        child = self.ckwrapper.work_path / self.test_dir_parent.name / "child"
+        single = self.ckwrapper.work_path / self.test_single_file.name
+        self.ckwrapper.watchdog()
+        self.assertEqual("first text single", self.committed_text(single))
+        self.test_child.write_text("second text child")
+        self.test_single_file.write_text("second text single")
+        self.ckwrapper.watchdog()
+        self.assertEqual("second text child", self.committed_text(child))
+        self.assertEqual("first text single", self.committed_text(single))
+        # Explicit paths are synced even when they aren't due
+        self.ckwrapper.watchdog([str(self.test_single_file)])
+        self.assertEqual("second text single", self.committed_text(single))
+        state = json.loads(self.ckwrapper.sync_state_path.read_text())
+        # Due, give or take the jitter of cron start times
+        state[str(self.test_single_file)] -= 3600 - 2
+        self.ckwrapper.sync_state_path.write_text(json.dumps(state))
+        self.test_single_file.write_text("third text single")
+        self.ckwrapper.watchdog()
+        self.assertEqual("third text single", self.committed_text(single))
+
+    def test_adaptive_sync(self):
+        """Syncs that find nothing back off, a change goes back to syncing on every run"""
+        settings.SYNC_ENGINE = "builtin"
+        settings.ADAPTIVE_SYNC = True
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        self.ckwrapper.track_dir()
+        child = self.ckwrapper.work_path / self.test_dir_parent.name / "child"
+
+        def schedule():
+            return json.loads(self.ckwrapper.schedule_state_path.read_text())
+
+        self.ckwrapper.scheduled_sync()
+        self.assertEqual(0, schedule()["interval"])
+        self.ckwrapper.scheduled_sync()
+        self.assertEqual(60, schedule()["interval"])
+        # Backed off: a change waits for the next sync
+        self.test_child.write_text("second text child")
+        self.ckwrapper.scheduled_sync()
+        self.assertEqual("first text child", self.committed_text(child))
+        state = schedule()
+        state["next_run"] -= 60
+        self.ckwrapper.schedule_state_path.write_text(json.dumps(state))
+        self.ckwrapper.scheduled_sync()
+        self.assertEqual("second text child", self.committed_text(child))
+        self.assertEqual(0, schedule()["interval"])
+        self.assertEqual(
+            settings.ADAPTIVE_MAX_INTERVAL,
+            next_interval(
+                settings.ADAPTIVE_MAX_INTERVAL, False, settings.ADAPTIVE_MAX_INTERVAL
+            ),
+        )
+
+    def test_maintenance(self):
+        settings.SYNC_ENGINE = "builtin"
+        settings.MAINTENANCE_INTERVAL = 3600
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        self.ckwrapper.track_dir()
+        self.ckwrapper.watchdog()
+        self.assertEqual(
+            b"true",
+            self.ckwrapper.git_command(
+                "config", "core.untrackedCache", get_stdout=True
+            ).strip(),
+        )
+        self.assertTrue(
+            (settings.REPO_PATH / ".git/objects/info/commit-graphs").is_dir()
+        )
+        self.assertEqual(
+            b"0",
+            self.ckwrapper.git_command("config", "gc.auto", get_stdout=True).strip(),
+        )
+        count = confkeep.maintenance.count_objects
+        self.assertEqual(0, count(self.ckwrapper)["count"])
+        # Not due yet
+        self.test_child.write_text("second text child")
+        self.ckwrapper.watchdog()
+        self.assertGreater(count(self.ckwrapper)["count"], 0)
+        self.ckwrapper.maintenance()
+        self.assertEqual(0, count(self.ckwrapper)["count"])
+
+    def test_query(self):
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        self.ckwrapper.track_dir()
+        self.ckwrapper.watchdog()
+        self.test_child.write_text("second text child")
+        self.ckwrapper.watchdog()
+        # Another host pushes its own branch
+        clone = pathlib.Path("repo-clone").absolute()
+        try:
+            subprocess.run(["git", "clone", "-q", settings.REMOTE, clone], check=True)
+            subprocess.run(
+                ["git", "checkout", "-q", "--orphan", "other-host"],
+                cwd=clone,
+                check=True,
+            )
+            (clone / "other-host" / "etc").mkdir(parents=True)
+            (clone / "other-host" / "etc" / "child").write_text("other")
+            subprocess.run(["git", "add", "other-host"], cwd=clone, check=True)
+            subprocess.run(["git", "commit", "-qm", "other"], cwd=clone, check=True)
+            subprocess.run(
+                ["git", "push", "-q", "origin", "other-host"], cwd=clone, check=True
+            )
+        finally:
+            shutil.rmtree(clone, ignore_errors=True)
+        self.ckwrapper.query([str(self.test_child)])
+        host = self.ckwrapper.hostname
+        with ChangeIndex(self.ckwrapper.change_index_path) as index:
+            rows = index.query(str(self.test_child))
+            self.assertEqual(
+                [(host, "modified"), (host, "added")],
+                [(row[1], row[2]) for row in rows],
+            )
+            self.assertEqual(
+                "test-dir/child", index.query("/some/where/test-dir/child")[0][3]
+            )
+            self.assertEqual(
+                [("other-host", "etc/child")],
+                [
+                    (row[1], row[3])
+                    for row in index.query("/etc/child", host="other-host")
+                ],
+            )
+            self.assertEqual([], index.query("child", since=time.time() + 60))
+            self.assertEqual(2, len(index.query(str(self.test_dir_parent))))
+            self.assertEqual(1, len(index.query(str(self.test_dir_parent), limit=1)))
+            # Only the new commit is read
+            self.test_child.write_text("third text child")
+            self.ckwrapper.watchdog()
+            self.assertEqual(1, index.update(self.ckwrapper, host))
+            self.assertEqual(0, index.update(self.ckwrapper, host))
+            self.assertEqual(3, len(index.query(str(self.test_child))))
+
+    def test_collect(self):
+        """Hosts without conf-keep are collected into their own branches"""
+        settings.COLLECT_TRANSPORT = "local"
+        self.ckwrapper.bootstrap_repository()
+        roots = self.test_dir_parent / "roots"
+        for name in ("appliance-1", "appliance-2"):
+            (roots / name / "etc" / "app").mkdir(parents=True)
+            (roots / name / "etc" / "app" / "app.conf").write_text(name)
+        inventory = self.test_dir_parent / "inventory"
+        inventory.write_text(
+            "# name address paths\n"
+            f"appliance-1 {roots / 'appliance-1'} /etc/app /etc/missing\n"
+            f"appliance-2\t{roots / 'appliance-2'}\t/etc/app\n"
+            "unknown /nowhere\n"
+        )
+
+        def show(name, path):
+            return subprocess.run(
+                ["git", "show", f"{name}:{name}/{path}"],
+                cwd=settings.REMOTE,
+                stdout=subprocess.PIPE,
+                check=True,
+            ).stdout
+
+        with self.assertRaises(confkeep.confkeep_commands.ConfKeepError):
+            self.ckwrapper.collect([str(inventory)])
+        self.assertEqual(b"appliance-1", show("appliance-1", "app/app.conf"))
+        self.assertEqual(
+            b"/etc/app\n/etc/missing\n", show("appliance-1", "tracked.txt")
+        )
+        self.assertEqual(b"appliance-2", show("appliance-2", "app/app.conf"))
+        # Hosts already collected can rely on the tracked.txt of their branch
+        inventory.write_text(
+            f"appliance-1 {roots / 'appliance-1'}\nappliance-2 {roots / 'appliance-2'}\n"
+        )
+        tip = self.ckwrapper.git_command("rev-parse", "appliance-2", get_stdout=True)
+        (roots / "appliance-1" / "etc" / "app" / "app.conf").write_text("changed")
+        self.ckwrapper.collect([str(inventory)])
+        self.assertEqual(b"changed", show("appliance-1", "app/app.conf"))
+        self.assertEqual(
+            tip, self.ckwrapper.git_command("rev-parse", "appliance-2", get_stdout=True)
+        )
+        self.assertEqual(
+            b"master",
+            self.ckwrapper.git_command(
+                "symbolic-ref", "--short", "HEAD", get_stdout=True
+            ).strip(),
+        )
+
+    def test_collect_local_timeout(self):
+        """The local transport gives up once the collection timeout has passed"""
+        target = self.test_dir_parent / "collected"
+        target.mkdir()
+        root = self.test_dir_parent / "root"
+        (root / "etc" / "app").mkdir(parents=True)
+        (root / "etc" / "app" / "app.conf").write_text("app")
+        paths = [TrackedPath("/etc/app")]
+        with self.assertRaises(confkeep.confkeep_commands.ConfKeepError):
+            LocalTransport().fetch(str(root), paths, target, 0)
+        LocalTransport().fetch(str(root), paths, target, 60)
+        self.assertEqual("app", (target / "app" / "app.conf").read_text())
+
+    def test_drift(self):
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        self.ckwrapper.track_dir()
+        self.ckwrapper.watchdog()
+        clone = pathlib.Path("repo-clone").absolute()
+        try:
+            subprocess.run(["git", "clone", "-q", settings.REMOTE, clone], check=True)
+            for host, text in (
+                ("same", "first text child"),
+                ("other", "other text child"),
+                ("none", None),
+            ):
+                subprocess.run(
+                    ["git", "checkout", "-q", "--orphan", host], cwd=clone, check=True
+                )
+                subprocess.run(["git", "rm", "-rqf", "--cached", "."], cwd=clone)
+                # Tracked as the directory above test-dir
+                directory = (
+                    clone
+                    / host
+                    / self.test_dir_parent.parent.name
+                    / self.test_dir_parent.name
+                )
+                directory.mkdir(parents=True)
+                (clone / host / "tracked.txt").write_text("")
+                if text:
+                    (directory / "child").write_text(text)
+                subprocess.run(["git", "add", host], cwd=clone, check=True)
+                subprocess.run(["git", "commit", "-qm", host], cwd=clone, check=True)
+            subprocess.run(
+                ["git", "push", "-q", "origin", "same", "other", "none"],
+                cwd=clone,
+                check=True,
+            )
+        finally:
+            shutil.rmtree(clone, ignore_errors=True)
+        self.ckwrapper.drift([str(self.test_child)])
+        host = self.ckwrapper.hostname
+        tips = branch_tips(self.ckwrapper, host)
+        groups, missing = group_hosts(
+            find_versions(settings.REPO_PATH, tips, str(self.test_child))
+        )
+        self.assertEqual(
+            [sorted([host, "same"]), ["other"]], [hosts for _, hosts in groups]
+        )
+        self.assertEqual(["none"], missing)
+        lines = report(self.ckwrapper, str(self.test_child), host, True)
+        self.assertIn("+other text child", "\n".join(lines))
+
+    def test_restore(self):
+        settings.SYNC_ENGINE = "builtin"
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        self.ckwrapper.track_dir()
+        link = self.test_dir_parent / "link"
+        link.symlink_to("child")
+        self.test_child.chmod(0o600)
+        self.ckwrapper.watchdog()
+        version = (
+            self.ckwrapper.git_command("rev-parse", "HEAD", get_stdout=True)
+            .decode()
+            .strip()
+        )
+        self.test_child.write_text("second text child")
+        link.unlink()
+        self.ckwrapper.watchdog()
+        copy = self.test_dir_parent / "copy"
+        self.ckwrapper.restore(
+            [str(self.test_dir_parent), "--commit", version, "--to", str(copy)]
+        )
+        self.assertEqual(
+            "first text child", (copy / self.test_dir_parent.name / "child").read_text()
+        )
+        self.ckwrapper.restore([str(self.test_child), "--commit", version])
+        self.assertEqual("first text child", self.test_child.read_text())
+        self.assertEqual(0o600, self.test_child.stat().st_mode & 0o777)
+        self.ckwrapper.restore(
+            [str(self.test_dir_parent), "--commit", version, "--dry-run"]
+        )
+        self.assertFalse(link.is_symlink())
+        self.ckwrapper.restore([str(self.test_dir_parent)])
+        self.assertEqual("second text child", self.test_child.read_text())
+        self.ckwrapper.restore([str(self.test_dir_parent), "--commit", version])
+        self.assertEqual("child", os.readlink(link))
+        self.ckwrapper.restore([str(self.test_dir_parent), "--delete", "--dry-run"])
+        self.assertTrue(link.is_symlink())
+        self.ckwrapper.restore([str(self.test_dir_parent), "--delete"])
+        self.assertFalse(link.is_symlink())
+        self.assertEqual("second text child", self.test_child.read_text())
+        with self.assertRaises(confkeep.confkeep_commands.ConfKeepError):
+            self.ckwrapper.restore([str(self.test_dir_parent), "--at", "2000-01-01"])
+        with self.assertRaises(confkeep.confkeep_commands.ConfKeepError):
+            self.ckwrapper.restore(["/not/tracked"])
+
+    def test_compact_history(self):
+        settings.SYNC_ENGINE = "builtin"
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        self.ckwrapper.track_dir()
+        branch = self.ckwrapper.work_path.name
+        day = int(time.time()) // 86400 * 86400
+        daily = [day - 40 * 86400 + hour * 3600 for hour in (1, 2, 3)]
+        hourly = [day - 10 * 86400 + minute * 60 for minute in (1, 2, 3)]
+        try:
+            for index, timestamp in enumerate(daily + hourly):
+                os.environ["GIT_AUTHOR_DATE"] = os.environ["GIT_COMMITTER_DATE"] = (
+                    f"@{timestamp} +0000"
+                )
+                self.test_child.write_text(f"text {index}")
+                self.ckwrapper.watchdog()
+        finally:
+            del os.environ["GIT_AUTHOR_DATE"], os.environ["GIT_COMMITTER_DATE"]
+        self.test_child.write_text("recent text")
+        self.ckwrapper.watchdog()
+
+        def rev_parse(*args, cwd=settings.REPO_PATH):
+            return subprocess.run(
+                ["git", "rev-parse"] + list(args),
+                cwd=cwd,
+                stdout=subprocess.PIPE,
+                check=True,
+            ).stdout.strip()
+
+        tree = rev_parse("HEAD^{tree}")
+        count = int(
+            self.ckwrapper.git_command("rev-list", "--count", "HEAD", get_stdout=True)
+        )
+        settings.COMPACT_HISTORY = True
+        self.ckwrapper.maintenance()
+        self.assertEqual(
+            count - 4,
+            int(
+                self.ckwrapper.git_command(
+                    "rev-list", "--count", "HEAD", get_stdout=True
+                )
+            ),
+        )
+        self.assertEqual(tree, rev_parse("HEAD^{tree}"))
+        for revision, text in (("HEAD~1", b"text 5"), ("HEAD~2", b"text 2")):
+            self.assertEqual(
+                text,
+                self.ckwrapper.git_command(
+                    "show", f"{revision}:{branch}/test-dir/child", get_stdout=True
+                ),
+            )
+        self.assertIn(
+            b"3 commits from",
+            self.ckwrapper.git_command(
+                "log", "-1", "--format=%s", "HEAD~1", get_stdout=True
+            ),
+        )
+        # The compacted history replaced the remote branch right away, compacting again changes nothing
+        self.assertEqual(rev_parse("HEAD"), rev_parse(branch, cwd=settings.REMOTE))
+        self.assertNotIn("lease", self.ckwrapper.load_push_state())
+        self.assertIsNone(self.ckwrapper.compact_history())
+        # Later pushes of the branch are plain fast-forwards again
+        settings.MONITORED_PATH = self.test_single_file
+        self.ckwrapper.track_dir()
+        self.assertEqual(rev_parse("HEAD"), rev_parse(branch, cwd=settings.REMOTE))
+
+    def committed_text(self, path):
+        return self.ckwrapper.git_command(
+            "show", f"HEAD:{path.relative_to(settings.REPO_PATH)}", get_stdout=True
+        ).decode()
+
+    def test_direct_snapshot(self):
+        settings.SNAPSHOT_MODE = "direct"
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        self.ckwrapper.track_dir()
+        settings.MONITORED_PATH = self.test_single_file
+        self.ckwrapper.track_dir()
+        parent = self.ckwrapper.work_path / self.test_dir_parent.name
+        child = parent / self.test_child.name
+        single = self.ckwrapper.work_path / self.test_single_file.name
+        (self.test_dir_parent / "link").symlink_to(self.test_child.name)
+        self.ckwrapper.watchdog()
+        self.assertFalse(parent.exists())
+        self.assertEqual("first text child", self.committed_text(child))
+        self.assertEqual("first text single", self.committed_text(single))
+        self.assertEqual(self.test_child.name, self.committed_text(parent / "link"))
+        head = self.ckwrapper.git_command("rev-parse", "HEAD", get_stdout=True)
+        self.ckwrapper.watchdog()
+        self.assertEqual(
+            head, self.ckwrapper.git_command("rev-parse", "HEAD", get_stdout=True)
+        )
+        self.test_child.write_text("second text child")
+        os.remove(self.test_single_file)
+        self.ckwrapper.watchdog()
+        self.assertEqual("second text child", self.committed_text(child))
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.committed_text(single)
+        # Later commits keep the snapshot
+        settings.MONITORED_PATH = self.test_child
+        self.ckwrapper.track_dir()
+        self.assertEqual("second text child", self.committed_text(child))
+
+    def test_push_queue(self):
+        """Push failures don't fail the sync and are retried later"""
+        settings.SYNC_ENGINE = "builtin"
+        settings.PUSH_RETRY_DELAY = 0
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        self.ckwrapper.track_dir()
+        branch = self.ckwrapper.work_path.name
+        self.ckwrapper.git_command("remote", "set-url", "origin", "/nonexistent")
+        self.ckwrapper.watchdog()
+        self.assertEqual(1, self.ckwrapper.queued_commits())
+        self.ckwrapper.git_command("remote", "set-url", "origin", settings.REMOTE)
+        self.ckwrapper.watchdog()
+        self.assertEqual(0, self.ckwrapper.queued_commits())
+        self.assertEqual(
+            self.ckwrapper.git_command("rev-parse", branch, get_stdout=True),
+            subprocess.run(
+                ["git", "rev-parse", branch],
+                cwd=settings.REMOTE,
+                stdout=subprocess.PIPE,
+            ).stdout,
+        )
+
+    def test_lock(self):
+        """Commands fail while the lock is held, syncs are run once it is released"""
+        settings.SYNC_ENGINE = "builtin"
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        self.ckwrapper.track_dir()
+        parent = self.ckwrapper.work_path / self.test_dir_parent.name
+        lock = self.ckwrapper.lock
+        self.assertTrue(lock.acquire("test"))
+        try:
+            with self.assertRaises(confkeep.confkeep_commands.ConfKeepError):
+                self.ckwrapper.track_dir()
+            self.ckwrapper.watchdog()
+            self.assertFalse(parent.is_dir())
+        finally:
+            lock.release()
+        settings.MONITORED_PATH = self.test_single_file
+        self.ckwrapper.track_dir()
+        self.assertTrue(parent.is_dir())
+        self.assertTrue(
+            (self.ckwrapper.work_path / self.test_single_file.name).is_file()
+        )
+
+    def test_rerun_request_race(self):
+        """A sync requested just as the holder releases the lock is run by the requester"""
+        self.ckwrapper.bootstrap_repository()
+        holder = self.ckwrapper.lock
+        self.assertTrue(holder.acquire("test"))
+        lock = self.ckwrapper.lock
+        request_rerun = lock.request_rerun
+
+        def released_meanwhile():
+            holder.release()  # After a failed acquire, before the request
+            request_rerun()
+
+        lock.request_rerun = released_meanwhile
+        self.assertTrue(lock.acquire_or_request_rerun("test"))
+        lock.release()
+        self.assertFalse(lock.take_rerun_request())
+        self.assertTrue(holder.acquire("test"))
+        try:
+            self.assertFalse(self.ckwrapper.lock.acquire_or_request_rerun("test"))
+        finally:
+            holder.release()
+        self.assertTrue(holder.take_rerun_request())
+
+    def test_stale_lock_file(self):
+        """A lock file left behind by a crashed command doesn't block anything"""
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        (settings.REPO_PATH / "conf-keep.lock").write_text(
+            json.dumps({"pid": 1, "command": "watchdog", "since": 0})
+        )
+        self.ckwrapper.track_dir()
+
+    def test_recover_stale_lock(self):
+        """Hung holders are terminated whatever their command line, but not processes that got their pid since"""
+        self.ckwrapper.bootstrap_repository()
+        lock = self.ckwrapper.lock
+        holder = subprocess.Popen(["sleep", "60"])
+        try:
+            start_time = process_start_time(holder.pid)
+            self.assertIsNotNone(start_time)
+            metadata = {"pid": holder.pid, "command": "sync", "since": 0}
+            lock.path.write_text(json.dumps(dict(metadata, start_time=start_time + 1)))
+            lock.recover_stale(60)
+            with self.assertRaises(subprocess.TimeoutExpired):
+                holder.wait(timeout=0.2)
+            lock.path.write_text(json.dumps(dict(metadata, start_time=start_time)))
+            lock.recover_stale(60)
+            self.assertEqual(-signal.SIGTERM, holder.wait(timeout=5))
+        finally:
+            holder.kill()
+            holder.wait()
+
+    def test_metrics(self):
+        settings.SYNC_ENGINE = "builtin"
+        metrics_dir = pathlib.Path("test-metrics").absolute()
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        metrics_dir.mkdir()
+        settings.METRICS_LOG = metrics_dir / "metrics.jsonl"
+        settings.METRICS_TEXTFILE = metrics_dir / "conf-keep.prom"
+        settings.PROFILE_PATH = metrics_dir / "sync.prof"
+        try:
+            self.ckwrapper.bootstrap_repository()
+            self.ckwrapper.config_host()
+            self.ckwrapper.track_dir()
+            self.ckwrapper.watchdog()
+            self.ckwrapper.watchdog()
+            runs = [
+                json.loads(line)
+                for line in settings.METRICS_LOG.read_text().splitlines()
+            ]
+            self.assertEqual(2, len(runs))
+            self.assertIn("identity", runs[0]["phases"])
+            self.assertIn("copy", runs[0]["phases"])
+            self.assertIn(str(self.test_dir_parent), runs[0]["paths"])
+            self.assertEqual(1, runs[0]["counters"]["files_copied"])
+            self.assertEqual(1, runs[0]["counters"]["changes_added"])
+            self.assertNotIn("copy", runs[1]["phases"])
+            self.assertIn(
+                "conf_keep_sync_success 1", settings.METRICS_TEXTFILE.read_text()
+            )
+            self.assertTrue(settings.PROFILE_PATH.is_file())
+        finally:
+            settings.METRICS_LOG = None
+            settings.METRICS_TEXTFILE = None
+            settings.PROFILE_PATH = None
+            shutil.rmtree(metrics_dir)
+
     def test_install_cron(self):
         self.ckwrapper.install_cron()
+        delay = host_delay(settings.HOST_NAME, settings.CRON_SPREAD)
+        self.assertLessEqual(delay, settings.CRON_SPREAD)
+        self.assertEqual(delay, host_delay(settings.HOST_NAME, settings.CRON_SPREAD))
+        script = pathlib.Path("/usr/local/bin/conf-keep-sync").read_text()
+        self.assertEqual(bool(delay), f"sleep {delay}\n" in script)
+
+    def test_install_systemd(self):
+        unit_path = confkeep.confkeep_commands.SYSTEMD_UNIT_PATH
+        confkeep.confkeep_commands.SYSTEMD_UNIT_PATH = self.test_single_file
+        settings.INSTALL_SYSTEMD = True
+        try:
+            self.ckwrapper.install_cron()
+        finally:
+            confkeep.confkeep_commands.SYSTEMD_UNIT_PATH = unit_path
+            settings.INSTALL_SYSTEMD = False
+        unit = self.test_single_file.read_text()
+        self.assertIn("-m confkeep daemon", unit)
+        self.assertIn(f'Environment="REPO_PATH={settings.REPO_PATH}"', unit)
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 10
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+    def test_daemon(self):
+        settings.SYNC_ENGINE = "builtin"
+        settings.DAEMON_DEBOUNCE = 0.1
+        self.ckwrapper.bootstrap_repository()
+        self.ckwrapper.config_host()
+        self.ckwrapper.track_dir()
+        child = (
+            self.ckwrapper.work_path / self.test_dir_parent.name / self.test_child.name
+        )
+        stop = threading.Event()
+        thread = threading.Thread(target=Daemon(self.ckwrapper).run, args=(stop,))
+        thread.start()
+        try:
+            self.wait_for(child.is_file)
+            self.test_child.write_text("second text child")
+            self.wait_for(lambda: child.read_text() == "second text child")
+            (self.test_dir_parent / "new-dir").mkdir()
+            time.sleep(0.2)  # Give the daemon time to watch the new directory
+            (self.test_dir_parent / "new-dir" / "new").write_text("new")
+            self.wait_for((child.parent / "new-dir" / "new").is_file)
+            with self.ckwrapper.tracked_file_path.open("at") as tracked:
+                tracked.write(f"{self.test_single_file}\n")
+            single = self.ckwrapper.work_path / self.test_single_file.name
+            self.wait_for(single.is_file)
+        finally:
+            stop.set()
+            thread.join()
+
+    def test_daemon_pipeline(self):
+        settings.SYNC_PIPELINE = True
+        self.test_daemon()
+        self.assertFalse(self.ckwrapper.background_push)
+        self.assertEqual(0, self.ckwrapper.queued_commits())
+
+
+class StatManifestTestCase(unittest.TestCase):
+    test_dir = pathlib.Path("test-manifest").absolute()
+    manifest_path = test_dir / "manifest.json"
+    tracked = test_dir / "tracked"
+
+    def setUp(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+        (self.tracked / "child").mkdir(parents=True)
+        (self.tracked / "child" / "file").write_text("first")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_unchanged(self):
+        manifest = StatManifest(self.manifest_path).load()
+        self.assertEqual([str(self.tracked)], manifest.refresh([self.tracked]))
+        manifest.save()
+        manifest = StatManifest(self.manifest_path).load()
+        self.assertEqual([], manifest.refresh([self.tracked]))
+
+    def test_changes(self):
+        manifest = StatManifest(self.manifest_path).load()
+        manifest.refresh([self.tracked])
+        manifest.save()
+        (self.tracked / "new").write_text("new")
+        self.assertEqual([str(self.tracked)], manifest.refresh([self.tracked]))
+        manifest.save()
+        os.remove(self.tracked / "new")
+        self.assertEqual([str(self.tracked)], manifest.refresh([self.tracked]))
+
+    def test_failed_copy(self):
+        """Roots whose copy had ignored errors are synced again by the next run"""
+        manifest = StatManifest(self.manifest_path).load()
+        manifest.refresh([self.tracked])
+        manifest.save()
+        (self.tracked / "new").write_text("new")
+        manifest.refresh([self.tracked])
+        manifest.save(failed=[self.tracked])
+        manifest = StatManifest(self.manifest_path).load()
+        self.assertEqual([str(self.tracked)], manifest.refresh([self.tracked]))
+        manifest.discard(str(self.tracked), "new")
+        manifest.save()
+        self.assertEqual([str(self.tracked)], manifest.refresh([self.tracked]))
+
+    def test_same_stat_different_content(self):
+        """Rewrites that keep the size and timestamps are caught by hashing recent files"""
+        child = self.tracked / "child" / "file"
+        manifest = StatManifest(self.manifest_path).load()
+        manifest.refresh([self.tracked])
+        manifest.save()
+        st = os.stat(child)
+        with open(child, "r+") as file:
+            file.write("other")
+        os.utime(child, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual([str(self.tracked)], manifest.refresh([self.tracked]))
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_benchmark(self):
+        out = subprocess.run(
+            [
+                sys.executable,
+                module_dir / "benchmark.py",
+                "--sizes",
+                "20",
+                "--large-file-size",
+                "1024",
+                "--work-dir",
+                pathlib.Path("benchmark-work").absolute(),
+            ],
+            env=dict(os.environ, SYNC_ENGINE="builtin"),
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout
+        results = [
+            json.loads(line) for line in out.splitlines() if line.startswith(b"{")
+        ]
+        self.assertEqual(
+            ["cold", "noop", "small-change", "mass-change"],
+            [result["scenario"] for result in results],
+        )
+        self.assertEqual(0, results[1]["subprocesses"])
+        self.assertEqual(1, results[2]["counters"]["files_copied"])
+        for result in results:
+            self.assertGreater(result["peak_rss_kb"], 0)
+        self.assertGreater(results[0]["phase_peak_rss_kb"]["copy"], 0)
+
+
+class StartupTestCase(unittest.TestCase):
+    # Modules only some commands need, they must not slow down the sync that cron starts every minute
+    deferred_modules = (
+        "argparse",
+        "concurrent.futures",
+        "confkeep.daemon",
+        "confkeep.identity",
+        "hashlib",
+        "logging",
+        "platform",
+        "shlex",
+        "shutil",
+        "socket",
+        "sqlite3",
+    )
+    # Seconds to import everything `python -m confkeep sync` needs before doing anything useful
+    budget = 0.15
+
+    def startup(self):
+        out = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys, time\n"
+                "start = time.perf_counter()\n"
+                "import confkeep.__main__\n"
+                "print(time.perf_counter() - start)\n"
+                "print(' '.join(sys.modules))",
+            ],
+            cwd=module_dir.parent,
+            stdout=subprocess.PIPE,
+            check=True,
+            encoding="utf-8",
+        ).stdout.splitlines()
+        return float(out[0]), out[1].split()
+
+    def test_deferred_imports(self):
+        _, modules = self.startup()
+        for module in self.deferred_modules:
+            self.assertNotIn(module, modules)
+
+    def test_startup_budget(self):
+        self.assertLess(min(self.startup()[0] for _ in range(5)), self.budget)
+
+    def test_zipapp(self):
+        archive = pathlib.Path("conf-keep-test.pyz").absolute()
+        try:
+            build(archive)
+            out = subprocess.run(
+                [sys.executable, archive, "--version"],
+                stdout=subprocess.PIPE,
+                check=True,
+                encoding="utf-8",
+            ).stdout
+        finally:
+            os.remove(archive)
+        self.assertEqual(VERSION, out.strip())
+
+
+class TrackedPathTestCase(unittest.TestCase):
+    def test_parse_format(self):
+        line = "/etc\texclude=*.swp\texclude=cache/\tinclude=a.swp\tmax-size=2048\tinterval=60"
+        tracked = TrackedPath.parse(line)
+        self.assertEqual(["*.swp", "cache/"], tracked.exclude)
+        self.assertEqual(2048, tracked.max_size)
+        self.assertEqual(60, tracked.interval)
+        self.assertEqual(line, tracked.format())
+        self.assertEqual("/etc", str(TrackedPath.parse("/etc")))
+        self.assertFalse(TrackedPath.parse("/etc").has_filters)
+
+    def test_excludes(self):
+        tracked = TrackedPath(
+            "/etc", ["*.swp", "cache/", "logs/*.gz", "/top"], ["keep.swp"], 100
+        )
+        self.assertTrue(tracked.excludes("a/b/c.swp", False))
+        self.assertFalse(tracked.excludes("a/b/keep.swp", False))
+        self.assertTrue(tracked.excludes("a/cache", True))
+        self.assertFalse(tracked.excludes("a/cache", False))
+        self.assertTrue(tracked.excludes("logs/old.gz", False))
+        self.assertFalse(tracked.excludes("logs/sub/old.gz", False))
+        self.assertFalse(tracked.excludes("a/logs/old.gz", False))
+        self.assertTrue(tracked.excludes("top", False))
+        self.assertFalse(tracked.excludes("a/top", False))
+        self.assertTrue(tracked.excludes("big", False, 101))
+        self.assertFalse(tracked.excludes("big", True, 101))
+        self.assertEqual(
+            [
+                "--include=keep.swp",
+                "--exclude=*.swp",
+                "--exclude=cache/",
+                "--exclude=/logs/*.gz",
+                "--exclude=/top",
+                "--max-size=100",
+            ],
+            tracked.rsync_options(),
+        )
+
+
+class GitStatusTestCase(unittest.TestCase):
+    def test_parse_status(self):
+        records = [
+            b"? host/new file",
+            b"1 .M N... 100644 100644 100644 abc abc host/with space",
+            b"1 .D N... 100644 100644 000000 abc abc host/gone",
+            b"2 R. N... 100644 100644 100644 abc abc R100 host/new name",
+            b"host/old name",
+            b"1 .T N... 100644 100644 120000 abc abc host/link",
+            b"! host/ignored",
+        ]
+        self.assertEqual(
+            [
+                ("added", "host/new file", None),
+                ("modified", "host/with space", None),
+                ("deleted", "host/gone", None),
+                ("renamed", "host/new name", "host/old name"),
+                ("type changed", "host/link", None),
+            ],
+            list(parse_status(records)),
+        )
+
+    def test_summary(self):
+        summary = StatusSummary(limit=2)
+        for index in range(10):
+            summary.add("modified", f"file{index}")
+        self.assertEqual("Some file(s) were changed", summary.head)
+        self.assertEqual(
+            "\nFile file0 was changed\nFile file1 was changed\nThere are more 8 changes...",
+            summary.body,
+        )
+        summary.add("added", "other")
+        self.assertEqual("Several files were changed added or deleted", summary.head)
+        self.assertEqual(11, summary.total)
 
 
 if __name__ == "__main__":